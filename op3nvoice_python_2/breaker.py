@@ -0,0 +1,280 @@
+##
+##  This file contains a transport with per-endpoint circuit breakers.
+##  When an endpoint's recent error rate or slow call rate gets too
+##  high, its breaker opens and requests fail fast instead of tying up
+##  threads on a degraded API host.  After a cool down a few probe
+##  requests are let through to decide whether to close it again.
+##
+
+import sys
+import time
+import threading
+import collections
+from transport import Transport
+from transport import get_endpoint
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+DEFAULT_WINDOW = 30.0
+DEFAULT_MIN_REQUESTS = 20
+DEFAULT_ERROR_THRESHOLD = 0.5
+DEFAULT_SLOW_CALL_DURATION = 10.0
+DEFAULT_SLOW_CALL_THRESHOLD = 0.8
+DEFAULT_COOL_DOWN = 30.0
+DEFAULT_PROBES = 1
+
+###
+###  The breaker.
+###
+
+class CircuitBreaker(object):
+    """The circuit breaker of one endpoint.  Thread safe."""
+
+    def __init__(self, window=DEFAULT_WINDOW,
+                 min_requests=DEFAULT_MIN_REQUESTS,
+                 error_threshold=DEFAULT_ERROR_THRESHOLD,
+                 slow_call_duration=DEFAULT_SLOW_CALL_DURATION,
+                 slow_call_threshold=DEFAULT_SLOW_CALL_THRESHOLD,
+                 cool_down=DEFAULT_COOL_DOWN, probes=DEFAULT_PROBES):
+        """Initializer.
+
+        'window' the number of seconds of outcomes considered.
+        'min_requests' the number of outcomes in the window needed
+        before the breaker can open.
+        'error_threshold' the failed fraction of the window that opens
+        the breaker.
+        'slow_call_duration' the number of seconds after which a call is
+        slow.
+        'slow_call_threshold' the slow fraction of the window that opens
+        the breaker.
+        'cool_down' the number of seconds the breaker stays open before
+        letting probes through.
+        'probes' the number of concurrent probe requests while half
+        open."""
+
+        self.window = window
+        self.min_requests = min_requests
+        self.error_threshold = error_threshold
+        self.slow_call_duration = slow_call_duration
+        self.slow_call_threshold = slow_call_threshold
+        self.cool_down = cool_down
+        self.probes = probes
+        self._lock = threading.Lock()
+        self._outcomes = collections.deque()
+        self._state = CLOSED
+        self._opened_at = None
+        self._probing = 0
+        # Counts the HALF_OPEN periods, so that a probe completing after
+        # its period is over is ignored.
+        self._generation = 0
+
+    def get_state(self):
+        """Returns CLOSED, OPEN or HALF_OPEN."""
+
+        with self._lock:
+            self._refresh_state(time.time())
+            return self._state
+
+    def get_retry_after(self):
+        """Returns the number of seconds before the breaker lets probes
+        through, or 0 if it isn't open."""
+
+        with self._lock:
+            if self._state != OPEN:
+                return 0
+            return max(self._opened_at + self.cool_down - time.time(), 0)
+
+    def allow(self):
+        """Returns a true value, the permit, if a request may be sent,
+        and None otherwise.  Every allowed request must be followed by a
+        call to record() with its permit."""
+
+        with self._lock:
+            self._refresh_state(time.time())
+            if self._state == CLOSED:
+                return _Permit(False, self._generation)
+            if self._state == HALF_OPEN and self._probing < self.probes:
+                self._probing += 1
+                return _Permit(True, self._generation)
+            return None
+
+    def record(self, failed, duration, permit=None):
+        """Record the outcome of an allowed request.
+
+        'permit' what allow() returned for it.  Only the outcome of a
+        probe decides whether a HALF_OPEN breaker closes or opens again;
+        the outcomes of requests allowed while CLOSED that complete
+        after the breaker opened are ignored."""
+
+        now = time.time()
+        with self._lock:
+            if permit != None and permit.probe:
+                if (self._state != HALF_OPEN or
+                    permit.generation != self._generation):
+                    # From an earlier HALF_OPEN period.
+                    return
+                self._probing -= 1
+                if failed:
+                    self._open(now)
+                else:
+                    self._state = CLOSED
+                    self._outcomes.clear()
+                return
+            if self._state != CLOSED:
+                return
+
+            self._outcomes.append((now, failed,
+                                   duration >= self.slow_call_duration))
+            while self._outcomes and self._outcomes[0][0] < now - self.window:
+                self._outcomes.popleft()
+
+            n = len(self._outcomes)
+            if n < self.min_requests:
+                return
+            failures = len([o for o in self._outcomes if o[1]])
+            slow = len([o for o in self._outcomes if o[2]])
+            if (float(failures) / n >= self.error_threshold or
+                float(slow) / n >= self.slow_call_threshold):
+                self._open(now)
+
+    def _open(self, now):
+        self._state = OPEN
+        self._opened_at = now
+        self._outcomes.clear()
+
+    def _refresh_state(self, now):
+        if self._state == OPEN and now >= self._opened_at + self.cool_down:
+            self._state = HALF_OPEN
+            self._probing = 0
+            self._generation += 1
+
+class _Permit(object):
+    """Returned by CircuitBreaker.allow()."""
+
+    __slots__ = ['probe', 'generation']
+
+    def __init__(self, probe, generation):
+        self.probe = probe
+        self.generation = generation
+
+###
+###  The transport.
+###
+
+class BreakerTransport(Transport):
+    """Wraps another transport with a CircuitBreaker per endpoint (see
+    transport.get_endpoint()).
+
+    A request fails if it throws or gets a 5xx status.  While an
+    endpoint's breaker is open its requests throw a
+    CircuitOpenException without reaching the API, unless 'stale_cache'
+    is set and a previous response to the same GET is available, in
+    which case that response is returned."""
+
+    def __init__(self, transport, stale_cache=0, **breaker_args):
+        """Initializer.
+
+        'transport' the transport executing the requests.  May not be
+        None.
+        'stale_cache' the number of successful GET responses kept to be
+        served while a breaker is open.  0 disables the fallback.
+        'breaker_args' passed to each CircuitBreaker."""
+
+        assert transport != None
+        assert stale_cache >= 0
+
+        self._transport = transport
+        self._breaker_args = breaker_args
+        self._lock = threading.Lock()
+        self._breakers = {}
+        self._stale_cache = stale_cache
+        self._cache = collections.OrderedDict()
+
+    def get_breaker(self, method, path):
+        """Returns the CircuitBreaker of a request's endpoint."""
+
+        endpoint = get_endpoint(method, path)
+        with self._lock:
+            breaker = self._breakers.get(endpoint)
+            if breaker == None:
+                breaker = CircuitBreaker(**self._breaker_args)
+                self._breakers[endpoint] = breaker
+            return breaker
+
+    def get_states(self):
+        """Returns a dictionary mapping each endpoint seen to the state
+        of its breaker."""
+
+        with self._lock:
+            breakers = self._breakers.items()
+        return dict((e, b.get_state()) for e, b in breakers)
+
+    def request(self, method, path, body='', headers=None, timeout=None):
+        breaker = self.get_breaker(method, path)
+
+        permit = breaker.allow()
+        if not permit:
+            if method == 'GET':
+                with self._lock:
+                    cached = self._cache.get(path)
+                if cached != None:
+                    return cached
+            raise CircuitOpenException(get_endpoint(method, path),
+                                       breaker.get_retry_after())
+
+        start = time.time()
+        try:
+            result = self._transport.request(method, path, body, headers,
+                                             timeout)
+        except:
+            exc_info = sys.exc_info()
+            breaker.record(True, time.time() - start, permit)
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+        status = result[0]
+        breaker.record(status >= 500, time.time() - start, permit)
+
+        if method == 'GET' and self._stale_cache > 0 and 200 <= status < 300:
+            with self._lock:
+                self._cache.pop(path, None)
+                self._cache[path] = result
+                if len(self._cache) > self._stale_cache:
+                    self._cache.popitem(False)
+
+        return result
+
+    def prewarm(self, n):
+        return self._transport.prewarm(n)
+
+    def close(self):
+        self._transport.close()
+
+###
+###  Exceptions.
+###
+
+class CircuitOpenException(Exception):
+    """Thrown instead of sending a request while its endpoint's circuit
+    breaker is open."""
+
+    endpoint = None
+    retry_after = None
+
+    def __init__(self, endpoint, retry_after):
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+
+    def get_endpoint(self):
+        """Returns the endpoint whose breaker is open."""
+        return self.endpoint
+
+    def get_retry_after(self):
+        """Returns the number of seconds before the breaker lets probes
+        through."""
+        return self.retry_after
+
+    def get_message(self):
+        """Returns the error message."""
+        return 'The circuit breaker of ' + self.endpoint + ' is open.'
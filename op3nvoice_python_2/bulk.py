@@ -0,0 +1,398 @@
+##
+##  This file contains bulk operations covering a whole account.  They
+##  stream data one page or one line at a time so that memory use does
+##  not grow with the size of the account, and they keep enough state
+##  on disk to resume after an interruption.
+##
+
+import os
+import gzip
+import time
+import zlib
+import json
+import Queue
+import threading
+import collections
+import op3nvoice
+from deadline import Deadline
+
+DEFAULT_COMPRESSION = 'gzip'
+DEFAULT_IMPORT_CONCURRENCY = 8
+
+# This named tuple is passed to export progress callbacks and returned
+# by export_account().  'eta' is in seconds and is None when the API
+# doesn't report the total number of bundles.
+ExportProgress = collections.namedtuple('ExportProgress',
+                                        ['pages', 'items', 'bytes',
+                                         'items_per_sec', 'eta'])
+
+# This named tuple is returned by import_bundles().
+ImportResult = collections.namedtuple('ImportResult',
+                                      ['created', 'skipped', 'failed'])
+
+###
+###  Export.
+###
+
+def export_account(path, compression=DEFAULT_COMPRESSION,
+                   checkpoint_path=None, limit=None, progress=None,
+                   timeout=None):
+    """Export every bundle, with its tracks and metadata, to a JSONL file.
+
+    'path' the file to write, one bundle per line.  May not be None.
+    'compression' 'gzip', 'zstd' or None.  zstd requires the zstandard
+    package.  Each page is written as a separate gzip member or zstd
+    frame, and the standard tools read the concatenation transparently.
+    'checkpoint_path' the file recording the last completed page.  If
+    None, 'path' + '.checkpoint' is used.  If it exists when the export
+    starts, the export resumes after the last completed page.  It is
+    removed once the export is complete.
+    'limit' the number of bundles per page.  May be None.
+    'progress' may be None, or a function called with an ExportProgress
+    after every page.
+    'timeout' the number of seconds the whole export may take, or a
+    Deadline.  May be None.
+
+    Only one page is held in memory at any time.
+
+    Returns the final ExportProgress.
+
+    If a page retrieval fails, throws an APIException or an
+    APIDataException; if the timeout expires, throws a
+    DeadlineExceededException.  Either way the export can be resumed by
+    calling export_account() again with the same arguments."""
+
+    # Argument error checking.
+    assert path != None
+    assert compression in (None, 'gzip', 'zstd')
+
+    if checkpoint_path == None:
+        checkpoint_path = path + '.checkpoint'
+    compress = _get_compressor(compression)
+    deadline = Deadline.get(timeout)
+
+    # Pick up where the last run stopped, discarding anything written
+    # after the last checkpoint.
+    checkpoint = _read_checkpoint(checkpoint_path)
+    if checkpoint != None:
+        f = open(path, 'r+b')
+        f.truncate(checkpoint['bytes'])
+        f.seek(0, os.SEEK_END)
+        href = checkpoint['next_href']
+    else:
+        f = open(path, 'wb')
+        checkpoint = {'next_href': None, 'bytes': 0, 'pages': 0, 'items': 0}
+        href = None
+
+    start = time.time()
+    exported = 0
+    total = None
+    result = ExportProgress(pages=checkpoint['pages'],
+                            items=checkpoint['items'],
+                            bytes=checkpoint['bytes'],
+                            items_per_sec=0.0, eta=None)
+
+    try:
+        while True:
+            page = op3nvoice.get_bundle_list(href, limit, True, True, True,
+                                             deadline)
+            items = op3nvoice.get_page_items(page)
+
+            lines = [json.dumps(item, separators=(',', ':')) + '\n'
+                     for item in items]
+            data = compress(''.join(lines))
+            del lines
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+            href = op3nvoice.get_next_href(page)
+            total = page.get('total', total)
+            exported += len(items)
+            checkpoint['next_href'] = href
+            checkpoint['bytes'] += len(data)
+            checkpoint['pages'] += 1
+            checkpoint['items'] += len(items)
+            if href != None:
+                _write_checkpoint(checkpoint_path, checkpoint)
+
+            result = _get_progress(checkpoint, exported, start, total)
+            if progress != None:
+                progress(result)
+
+            if href == None:
+                break
+    finally:
+        f.close()
+
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    return result
+
+###
+###  Import.
+###
+
+def import_bundles(path, concurrency=DEFAULT_IMPORT_CONCURRENCY,
+                   journal_path=None, on_error=None, timeout=None,
+                   creator=None):
+    """Create a bundle, and its additional tracks, for every line of a
+    JSONL file.
+
+    'path' the file to read.  Each line is a JSON object holding the
+    arguments of create_bundle() ('name', 'media_url', 'audio_channel',
+    'metadata', 'notify_url'), plus an optional 'tracks' list of
+    objects holding the arguments of create_track() ('media_url',
+    'label', 'audio_channel', 'source').  Files ending in '.gz' are
+    decompressed.  Lines are read as they are needed.  May not be None.
+    'concurrency' the number of bundles created at the same time.  The
+    tracks of a bundle are always created one after the other, in
+    order.
+    'journal_path' the file recording the created hrefs.  If None,
+    'path' + '.journal' is used.  Lines the journal records as complete
+    are skipped, and partially imported lines continue with their next
+    track, so an interrupted import can be resumed by calling
+    import_bundles() again.
+    'on_error' may be None, or a function called with the line number,
+    the record and the exception when a line fails.  A line that isn't
+    valid JSON fails with a ValueError, and its record is the line
+    itself.  Failed lines are not recorded as complete and are retried
+    by the next run.
+    'timeout' the number of seconds the whole import may take, or a
+    Deadline.  May be None.  Once it expires, the remaining lines fail
+    with a DeadlineExceededException.
+    'creator' may be None, or an IdempotentCreator through which the
+    bundles and tracks having a 'media_url' are created.
+
+    The journal records a bundle or track once it has been created, so
+    if the import is interrupted between a creation and its journal
+    entry, the next run creates it again.  Pass a 'creator' to close
+    that window: a creation it has already recorded isn't repeated.
+
+    Returns an ImportResult with the number of lines created, skipped
+    and failed."""
+
+    # Argument error checking.
+    assert path != None
+    assert concurrency > 0
+
+    if journal_path == None:
+        journal_path = path + '.journal'
+    journal = _ImportJournal(journal_path)
+    deadline = Deadline.get(timeout)
+
+    lines = Queue.Queue(2 * concurrency)
+    lock = threading.Lock()
+    counts = {'created': 0, 'skipped': 0, 'failed': 0}
+
+    def count(key):
+        with lock:
+            counts[key] += 1
+
+    def work():
+        while True:
+            entry = lines.get()
+            if entry == None:
+                return
+            line_number, record = entry
+            try:
+                record = json.loads(record)
+                _import_bundle(line_number, record, journal, creator,
+                               deadline)
+                count('created')
+            except Exception, e:
+                count('failed')
+                if on_error != None:
+                    on_error(line_number, record, e)
+
+    workers = []
+    for n in range(concurrency):
+        t = threading.Thread(target=work)
+        t.daemon = True
+        t.start()
+        workers.append(t)
+
+    if path.endswith('.gz'):
+        f = gzip.open(path, 'rb')
+    else:
+        f = open(path, 'rb')
+
+    try:
+        for line_number, line in enumerate(f):
+            if line.strip() == '':
+                continue
+            if journal.is_done(line_number):
+                count('skipped')
+                continue
+            # Parsed by the workers, so that a bad line only fails
+            # itself.
+            lines.put((line_number, line))
+    finally:
+        for t in workers:
+            lines.put(None)
+        for t in workers:
+            t.join()
+        f.close()
+        journal.close()
+
+    return ImportResult(**counts)
+
+class _ImportJournal(object):
+    """An append-only record of import progress.  Each line is a JSON
+    object for a line of the import file: the bundle was created, a
+    track was created, or the line is complete."""
+
+    def __init__(self, journal_path):
+        self._lock = threading.Lock()
+        self._state = {}
+        torn = False
+
+        if os.path.exists(journal_path):
+            f = open(journal_path, 'rb')
+            try:
+                for line in f:
+                    torn = not line.endswith('\n')
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A torn last line from an interrupted run.
+                        continue
+                    self._apply(entry)
+            finally:
+                f.close()
+
+        self._f = open(journal_path, 'ab')
+        if torn:
+            self._f.write('\n')
+
+    def _apply(self, entry):
+        state = self._state.setdefault(entry['line'], {'tracks': 0})
+        if entry.has_key('done'):
+            # Nothing more is needed to skip a complete line.
+            self._state[entry['line']] = True
+        elif entry.has_key('bundle'):
+            state['bundle'] = entry['bundle']
+            state['tracks_href'] = entry['tracks_href']
+        elif entry.has_key('track'):
+            state['tracks'] = entry['track'] + 1
+
+    def is_done(self, line_number):
+        return self._state.get(line_number) == True
+
+    def get_state(self, line_number):
+        """Returns the recorded progress of a line that isn't done."""
+        with self._lock:
+            return dict(self._state.get(line_number, {'tracks': 0}))
+
+    def record(self, **entry):
+        with self._lock:
+            self._f.write(json.dumps(entry) + '\n')
+            self._f.flush()
+            self._apply(entry)
+
+    def close(self):
+        self._f.close()
+
+def _import_bundle(line_number, record, journal, creator, deadline):
+    """Creates the bundle and tracks of one import line, skipping what
+    the journal says was already created."""
+
+    state = journal.get_state(line_number)
+
+    if not state.has_key('bundle'):
+        create_bundle = op3nvoice.create_bundle
+        if creator != None and record.get('media_url') != None:
+            create_bundle = creator.create_bundle
+        br = create_bundle(name=record.get('name'),
+                           media_url=record.get('media_url'),
+                           audio_channel=record.get('audio_channel'),
+                           metadata=record.get('metadata'),
+                           notify_url=record.get('notify_url'),
+                           timeout=deadline)
+        state['bundle'] = br['_links']['self']['href']
+        state['tracks_href'] = br['_links']['o3v:tracks']['href']
+        journal.record(line=line_number, bundle=state['bundle'],
+                       tracks_href=state['tracks_href'])
+
+    tracks = record.get('tracks', [])
+    for i in range(state['tracks'], len(tracks)):
+        track = tracks[i]
+        create_track = op3nvoice.create_track
+        if creator != None:
+            create_track = creator.create_track
+        create_track(state['tracks_href'],
+                     media_url=track['media_url'],
+                     label=track.get('label'),
+                     audio_channel=track.get('audio_channel'),
+                     source=track.get('source'),
+                     timeout=deadline)
+        journal.record(line=line_number, track=i)
+
+    journal.record(line=line_number, done=True)
+
+###
+###  Utility functions.
+###
+
+def _get_compressor(compression):
+    """Returns a function compressing a string into a standalone gzip
+    member or zstd frame (or not at all)."""
+
+    if compression == 'gzip':
+        def compress(data):
+            # wbits 31 selects the gzip container.
+            c = zlib.compressobj(6, zlib.DEFLATED, 31)
+            return c.compress(data) + c.flush()
+        return compress
+
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise op3nvoice.APIConfigurationException(
+                'zstd compression requires the zstandard package.')
+        return zstandard.ZstdCompressor().compress
+
+    return lambda data: data
+
+def _read_checkpoint(checkpoint_path):
+    """Returns the checkpoint data, or None if there is no checkpoint."""
+
+    if not os.path.exists(checkpoint_path):
+        return None
+    f = open(checkpoint_path, 'rb')
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+def _write_checkpoint(checkpoint_path, checkpoint):
+    """Atomically replaces the checkpoint file."""
+
+    tmp_path = checkpoint_path + '.tmp'
+    f = open(tmp_path, 'wb')
+    try:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+    os.rename(tmp_path, checkpoint_path)
+
+def _get_progress(checkpoint, exported, start, total):
+    """Returns an ExportProgress.  The rate covers this run only."""
+
+    items_per_sec = 0.0
+    elapsed = time.time() - start
+    if elapsed > 0:
+        items_per_sec = exported / elapsed
+
+    eta = None
+    if total != None and items_per_sec > 0:
+        eta = max(total - checkpoint['items'], 0) / items_per_sec
+
+    return ExportProgress(pages=checkpoint['pages'],
+                          items=checkpoint['items'],
+                          bytes=checkpoint['bytes'],
+                          items_per_sec=items_per_sec, eta=eta)
@@ -0,0 +1,403 @@
+##
+##  This file contains the op3nvoice command line tool.  Every command
+##  streams JSON lines: records are read from stdin one at a time and
+##  results are written to stdout as soon as they are available, so the
+##  tool composes in pipelines without holding result sets in memory.
+##
+##      op3nvoice list --embed-tracks > bundles.jsonl
+##      op3nvoice search 'meeting' | op3nvoice purge
+##      op3nvoice create -c 16 < media.jsonl | op3nvoice add-track < ...
+##
+##  Errors are written to stderr as JSON lines holding the input record,
+##  and the exit status is 1 if any record failed.
+##
+##  Only the standard library modules needed to parse the command line
+##  are imported up front; the API modules are imported once a command
+##  actually runs.
+##
+
+import os
+import sys
+import json
+import errno
+import argparse
+
+KEY_ENVIRONMENT_VARIABLE = 'OP3NVOICE_KEY'
+DEFAULT_CONCURRENCY = 4
+
+###
+###  Entry point.
+###
+
+def main(argv=None):
+    """Run the command line tool.
+
+    'argv' the arguments, without the program name.  If None,
+    sys.argv is used.
+
+    Returns the exit status."""
+
+    args = _get_parser().parse_args(argv)
+
+    key = args.key or os.environ.get(KEY_ENVIRONMENT_VARIABLE)
+    if key == None:
+        sys.stderr.write('op3nvoice: an API key is required; use --key or '
+                         'set ' + KEY_ENVIRONMENT_VARIABLE + '.\n')
+        return 2
+
+    import op3nvoice
+    from deadline import Deadline
+
+    op3nvoice.set_key(key)
+    if args.http2:
+        op3nvoice.use_http2()
+
+    output = _Output()
+    try:
+        args.command(args, Deadline.get(args.timeout), output)
+    except KeyboardInterrupt:
+        return 130
+    except IOError, e:
+        # The reader went away (e.g. piped into head); not an error.
+        if e.errno != errno.EPIPE:
+            raise
+        return 0
+    except Exception, e:
+        output.error(None, e)
+
+    if output.failures > 0:
+        return 1
+    return 0
+
+###
+###  Commands.
+###
+
+def _list(args, deadline, output):
+    import op3nvoice
+
+    for page in op3nvoice.iter_bundle_list_pages(None, args.limit, True,
+                                                 args.embed_tracks,
+                                                 args.embed_metadata,
+                                                 deadline, args.fields):
+        for item in op3nvoice.get_page_items(page):
+            output.write(item)
+        output.flush()
+
+def _search(args, deadline, output):
+    import op3nvoice
+
+    for page in op3nvoice.iter_search_pages(None, args.query, args.field,
+                                            args.filter, args.limit, True,
+                                            args.embed_tracks,
+                                            args.embed_metadata, deadline,
+                                            args.fields):
+        for item in op3nvoice.get_page_items(page):
+            output.write(item)
+        output.flush()
+
+def _get(args, deadline, output):
+    import op3nvoice
+
+    def get(record):
+        return op3nvoice.get_bundle(_get_href(record), args.embed_tracks,
+                                    args.embed_metadata, deadline,
+                                    args.fields)
+
+    _run(get, _read_records(args.hrefs), args.concurrency, output)
+
+def _create(args, deadline, output):
+    import op3nvoice
+
+    def create(record):
+        return op3nvoice.create_bundle(record.get('name'),
+                                       record.get('media_url'),
+                                       record.get('audio_channel'),
+                                       record.get('metadata'),
+                                       record.get('notify_url'), deadline)
+
+    _run(create, _read_records(), args.concurrency, output)
+
+def _update_metadata(args, deadline, output):
+    import op3nvoice
+
+    def update(record):
+        return op3nvoice.update_metadata(_get_href(record, 'o3v:metadata'),
+                                         _get_field(record, 'metadata'),
+                                         record.get('version'), deadline)
+
+    _run(update, _read_records(), args.concurrency, output)
+
+def _add_track(args, deadline, output):
+    import op3nvoice
+
+    def add(record):
+        return op3nvoice.create_track(_get_href(record, 'o3v:tracks'),
+                                      _get_field(record, 'media_url'),
+                                      record.get('label'),
+                                      record.get('audio_channel'),
+                                      record.get('source'), deadline)
+
+    _run(add, _read_records(), args.concurrency, output)
+
+def _purge(args, deadline, output):
+    import op3nvoice
+
+    def purge(record):
+        href = _get_href(record)
+        op3nvoice.delete_bundle(href, deadline)
+        return {'href': href, 'deleted': True}
+
+    if not args.all:
+        _run(purge, _read_records(args.hrefs), args.concurrency, output)
+        return
+
+    # Deleting shifts the bundle list under a paging cursor, so keep
+    # emptying the first page instead of following 'next' links.
+    while True:
+        page = op3nvoice.get_bundle_list(None, args.limit, None, None, None,
+                                         deadline)
+        items = op3nvoice.get_page_items(page)
+        if len(items) == 0:
+            return
+        failures = output.failures
+        _run(purge, iter(items), args.concurrency, output)
+        if output.failures > failures:
+            # Undeletable bundles would come back on every page.
+            return
+
+###
+###  Command line parsing.
+###
+
+def _get_parser():
+    parser = argparse.ArgumentParser(
+        prog='op3nvoice',
+        description='Stream OP3Nvoice API operations as JSON lines.')
+    parser.add_argument('--key',
+                        help='the API key (default: $%s)'
+                        % KEY_ENVIRONMENT_VARIABLE)
+    parser.add_argument('-c', '--concurrency', type=int,
+                        default=DEFAULT_CONCURRENCY,
+                        help='the number of API calls in flight '
+                        '(default: %(default)s)')
+    parser.add_argument('--timeout', type=float,
+                        help='the number of seconds the whole command may '
+                        'take')
+    parser.add_argument('--http2', action='store_true',
+                        help='multiplex the API calls over HTTP/2')
+    commands = parser.add_subparsers(title='commands')
+
+    p = commands.add_parser('list', help='write every bundle')
+    _add_page_arguments(p)
+    p.set_defaults(command=_list)
+
+    p = commands.add_parser('search', help='write the bundles matching a '
+                            'query')
+    p.add_argument('query')
+    p.add_argument('--field', help='the field to search')
+    p.add_argument('--filter', help='the search filter')
+    _add_page_arguments(p)
+    p.set_defaults(command=_search)
+
+    p = commands.add_parser('get', help='write the bundles whose hrefs are '
+                            'given, or read from stdin')
+    p.add_argument('hrefs', nargs='*')
+    _add_embed_arguments(p)
+    p.set_defaults(command=_get)
+
+    p = commands.add_parser('create', help='create a bundle per stdin '
+                            'record {name, media_url, audio_channel, '
+                            'metadata, notify_url}')
+    p.set_defaults(command=_create)
+
+    p = commands.add_parser('update-metadata', help='replace the metadata '
+                            'per stdin record {href, metadata, version}; '
+                            'a bundle with an o3v:metadata link works too')
+    p.set_defaults(command=_update_metadata)
+
+    p = commands.add_parser('add-track', help='add a track per stdin '
+                            'record {href, media_url, label, audio_channel, '
+                            'source}; a bundle with an o3v:tracks link '
+                            'works too')
+    p.set_defaults(command=_add_track)
+
+    p = commands.add_parser('purge', help='delete the bundles whose hrefs '
+                            'are given, or read from stdin')
+    p.add_argument('hrefs', nargs='*')
+    p.add_argument('--all', action='store_true',
+                   help='delete every bundle of the account')
+    p.add_argument('--limit', type=int, help='the page size used by --all')
+    p.set_defaults(command=_purge)
+
+    return parser
+
+def _add_page_arguments(parser):
+    parser.add_argument('--limit', type=int, help='the page size')
+    _add_embed_arguments(parser)
+
+def _add_embed_arguments(parser):
+    parser.add_argument('--embed-tracks', action='store_true',
+                        help='embed the track data')
+    parser.add_argument('--embed-metadata', action='store_true',
+                        help='embed the metadata')
+    parser.add_argument('--fields',
+                        help='the comma separated dotted paths to keep in '
+                        'each bundle, e.g. id,name')
+
+###
+###  Input and output.
+###
+
+class _Output(object):
+    """Writes results to stdout and errors to stderr, one JSON document
+    per line."""
+
+    def __init__(self):
+        self.failures = 0
+
+    def write(self, data):
+        sys.stdout.write(json.dumps(data, separators=(',', ':')) + '\n')
+
+    def flush(self):
+        sys.stdout.flush()
+
+    def error(self, record, e):
+        self.failures += 1
+        error = {'error': _get_error_message(e)}
+        if record != None:
+            error['input'] = record
+        sys.stdout.flush()
+        sys.stderr.write(json.dumps(error, separators=(',', ':')) + '\n')
+
+def _read_records(hrefs=None):
+    """Generates the records given on the command line, or else read
+    from stdin.  A stdin line is either a JSON document or a bare
+    href.  A line that isn't valid JSON generates an _InvalidLine, so
+    that it fails on its own."""
+
+    if hrefs:
+        for href in hrefs:
+            yield href
+        return
+
+    while True:
+        line = sys.stdin.readline()
+        if line == '':
+            return
+        line = line.strip()
+        if line == '':
+            continue
+        if line[0] in '{["':
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = _InvalidLine(line, sys.exc_info())
+            yield record
+        else:
+            yield line
+
+class _InvalidLine(object):
+    """A stdin line that couldn't be parsed, and why."""
+
+    def __init__(self, line, exc_info):
+        self.line = line
+        self.exc_info = exc_info
+
+def _get_href(record, rel='self'):
+    """Returns the href of a record: the record itself if it is a
+    string, its 'href' field, or else its '_links' entry for 'rel'."""
+
+    if isinstance(record, basestring):
+        return record
+    if record.get('href') != None:
+        return record['href']
+    try:
+        return record['_links'][rel]['href']
+    except (KeyError, TypeError):
+        raise ValueError('The record has no href.')
+
+def _get_field(record, name):
+    """Returns a required field of a record."""
+
+    if record.get(name) == None:
+        raise ValueError('The record has no ' + name + '.')
+    return record[name]
+
+def _get_error_message(e):
+    try:
+        if hasattr(e, 'get_message'):
+            return e.get_message()
+        if hasattr(e, 'get_msg'):
+            return e.get_msg()
+    except Exception:
+        pass
+    return '%s: %s' % (e.__class__.__name__, e)
+
+###
+###  Concurrency.
+###
+
+def _run(func, records, concurrency, output):
+    """Call 'func' on every record with up to 'concurrency' calls in
+    flight, writing the results in input order."""
+
+    for record, future in _map_ordered(func, records, concurrency):
+        try:
+            output.write(future.result())
+        except Exception, e:
+            output.error(record, e)
+        output.flush()
+
+def _map_ordered(func, records, concurrency):
+    """Generates (record, Future) pairs in input order.  At most twice
+    'concurrency' records are read ahead of the output.  An
+    _InvalidLine isn't passed to 'func': its future fails with the
+    parse error, and its record is the line."""
+
+    import Queue
+    import threading
+    import collections
+    from concurrency import Future
+
+    work = Queue.Queue(concurrency)
+
+    def worker():
+        while True:
+            item = work.get()
+            if item == None:
+                return
+            record, future = item
+            try:
+                future.set_result(func(record))
+            except Exception:
+                future.set_exception()
+
+    threads = []
+    for i in range(max(concurrency, 1)):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    pending = collections.deque()
+    try:
+        for record in records:
+            future = Future()
+            if isinstance(record, _InvalidLine):
+                future.set_exception(record.exc_info)
+                pending.append((record.line, future))
+            else:
+                pending.append((record, future))
+                work.put((record, future))
+            while (len(pending) > 2 * concurrency or
+                   (len(pending) > 0 and pending[0][1].done())):
+                yield pending.popleft()
+        while len(pending) > 0:
+            yield pending.popleft()
+    finally:
+        for t in threads:
+            work.put(None)
+
+if __name__ == '__main__':
+    sys.exit(main())
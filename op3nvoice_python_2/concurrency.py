@@ -0,0 +1,260 @@
+##
+##  This file contains the concurrency primitives shared by the helpers
+##  that run API calls in the background.
+##
+
+import sys
+import zlib
+import threading
+import collections
+
+DEFAULT_WORKERS = 8
+
+###
+###  Futures.
+###
+
+class Future(object):
+    """The eventual result of an operation running in the background."""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def set_result(self, result):
+        """Resolve the future with 'result'.  Ignored if it is already
+        resolved."""
+
+        self._resolve(result, None)
+
+    def set_exception(self, exc_info=None):
+        """Resolve the future with an exception.
+
+        'exc_info' a (type, value, traceback) tuple.  If None, the
+        exception currently being handled is used."""
+
+        if exc_info == None:
+            exc_info = sys.exc_info()
+        self._resolve(None, exc_info)
+
+    def done(self):
+        """Returns True if the future is resolved."""
+
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """Wait for the future to be resolved and return its result.
+
+        'timeout' the maximum number of seconds to wait.  If None, wait
+        forever.
+
+        If the operation failed, re-throws its exception.  If the
+        timeout expires first, throws a FutureTimeoutException."""
+
+        if not self._done.wait(timeout):
+            raise FutureTimeoutException(
+                'The operation did not complete in time.')
+        if self._exc_info != None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        """Like result(), but returns the exception the operation failed
+        with, or None if it succeeded."""
+
+        if not self._done.wait(timeout):
+            raise FutureTimeoutException(
+                'The operation did not complete in time.')
+        if self._exc_info != None:
+            return self._exc_info[1]
+        return None
+
+    def add_done_callback(self, func):
+        """Call 'func' with this future once it is resolved.  If it is
+        already resolved, 'func' is called immediately."""
+
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(func)
+                return
+        func(self)
+
+    def _resolve(self, result, exc_info):
+        with self._lock:
+            if self._done.is_set():
+                return
+            self._result = result
+            self._exc_info = exc_info
+            self._done.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+        for func in callbacks:
+            func(self)
+
+###
+###  Ordered execution.
+###
+
+class OrderedExecutor(object):
+    """Runs functions on a pool of threads, in submission order per key.
+
+    Keys are hashed into a fixed number of serial lanes: functions in one
+    lane run one at a time, in the order they were submitted, and lanes
+    run in parallel.  With the default key function, the key is the
+    bundle of an href, so that positional track operations
+    (create_track(), update_track(), delete_track()) on one bundle stay
+    in order while different bundles are processed concurrently.
+
+        executor = OrderedExecutor()
+        f = executor.submit(tracks_href, op3nvoice.create_track,
+                            tracks_href, url)
+        executor.shutdown()"""
+
+    def __init__(self, workers=DEFAULT_WORKERS, lanes=None, key=None):
+        """Initializer.
+
+        'workers' the number of threads.
+        'lanes' the number of serial lanes.  If None, four per worker.
+        Keys sharing a lane wait for each other, so more lanes means
+        less blocking between unrelated keys.
+        'key' may be None, or a function mapping a submitted key to the
+        value hashed.  If None, get_bundle_href() is used."""
+
+        assert workers > 0
+        assert lanes == None or lanes > 0
+
+        if lanes == None:
+            lanes = 4 * workers
+        if key == None:
+            key = get_bundle_href
+        self._key = key
+        self._condition = threading.Condition()
+        self._lanes = [collections.deque() for i in range(lanes)]
+        # Whether each lane is queued in _ready or running.
+        self._busy = [False] * lanes
+        self._ready = collections.deque()
+        self._shutdown = False
+        self._threads = []
+        for i in range(workers):
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, key, func, *args, **kwargs):
+        """Queue 'func(*args, **kwargs)' behind the functions submitted
+        with the same key.
+
+        Returns a Future resolving with the result of 'func' or its
+        exception.  A failure doesn't stop the functions queued after
+        it.
+
+        If the executor is shut down, throws a RuntimeError."""
+
+        future = Future()
+        lane = self.get_lane(key)
+        with self._condition:
+            if self._shutdown:
+                raise RuntimeError('The executor is shut down.')
+            self._lanes[lane].append((future, func, args, kwargs))
+            if not self._busy[lane]:
+                self._busy[lane] = True
+                self._ready.append(lane)
+                self._condition.notify()
+        return future
+
+    def get_lane(self, key):
+        """Returns the lane functions submitted with 'key' run in."""
+
+        value = self._key(key)
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        # crc32 rather than hash(), so that lanes are stable across runs.
+        return (zlib.crc32(str(value)) & 0xffffffff) % len(self._lanes)
+
+    def get_queue_depths(self):
+        """Returns the number of functions queued or running in each
+        lane, as a list indexed by lane."""
+
+        with self._condition:
+            return [len(lane) for lane in self._lanes]
+
+    def shutdown(self, wait=True):
+        """Stop accepting functions.
+
+        'wait' whether to wait until every queued function has run."""
+
+        with self._condition:
+            self._shutdown = True
+            self._condition.notify_all()
+        if wait:
+            for t in self._threads:
+                t.join()
+
+    def _work(self):
+        """Runs in the background, taking turns on the ready lanes."""
+
+        while True:
+            with self._condition:
+                while len(self._ready) == 0:
+                    if self._shutdown:
+                        return
+                    self._condition.wait()
+                lane = self._ready.popleft()
+                # Left in the lane while it runs, so that it counts in
+                # the queue depth.
+                future, func, args, kwargs = self._lanes[lane][0]
+
+            try:
+                result = func(*args, **kwargs)
+            except Exception:
+                future.set_exception()
+            else:
+                future.set_result(result)
+
+            with self._condition:
+                self._lanes[lane].popleft()
+                if len(self._lanes[lane]) > 0:
+                    # One function per turn, so that a long lane doesn't
+                    # starve the others.
+                    self._ready.append(lane)
+                    self._condition.notify()
+                else:
+                    self._busy[lane] = False
+                    if self._shutdown:
+                        self._condition.notify_all()
+
+###
+###  Utility functions.
+###
+
+def get_bundle_href(href):
+    """Returns the href of the bundle 'href' belongs to (a bundle, its
+    tracks list, a track or its metadata), or 'href' itself if it
+    doesn't name a bundle."""
+
+    parts = href.split('?', 1)[0].rstrip('/').split('/')
+    if 'bundles' in parts:
+        i = parts.index('bundles')
+        if i + 1 < len(parts):
+            return '/'.join(parts[:i + 2])
+    return href
+
+###
+###  Exceptions.
+###
+
+class FutureTimeoutException(Exception):
+    """Thrown when waiting for a Future takes longer than allowed."""
+
+    msg = None
+
+    def __init__(self, msg):
+        self.msg = msg
+
+    def get_message(self):
+        """Returns the error message."""
+        return self.msg
@@ -0,0 +1,360 @@
+##
+##  This file contains the pool of persistent HTTP(S) connections used
+##  by the get(), post(), put() and delete() functions.  Connections are
+##  kept alive between requests and share one SSL context, so that most
+##  requests don't pay for a TCP connect and a TLS handshake.
+##
+
+import ssl
+import time
+import errno
+import socket
+import httplib
+import threading
+from transport import Transport
+from deadline import DeadlineExceededException
+from profiler import get_current_call
+from __init__ import __host__
+from __init__ import __debug_level__
+
+DEFAULT_MAX_IDLE = 10
+
+# The connect timeout of prewarm(), in seconds, when the pool has no
+# timeout of its own.
+DEFAULT_PREWARM_TIMEOUT = 10.0
+
+# Errors meaning a kept-alive connection was closed by the server while
+# idle.  A request failing this way on a reused connection is retried
+# once on a new connection: always if it failed while being sent, and
+# only for the methods that can safely be repeated if it failed while
+# waiting for the response, since the server may have processed it.
+# Timeouts are never retried.
+_STALE_CONNECTION_ERRORS = (httplib.BadStatusLine, httplib.CannotSendRequest,
+                            socket.error)
+_STALE_ERRNOS = (errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED)
+_REPLAYABLE_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE')
+
+###
+###  The pool.
+###
+
+class ConnectionPool(Transport):
+    """A thread safe pool of persistent connections to one host.  This is
+    the default transport."""
+
+    def __init__(self, host=__host__, secure=True, max_idle=DEFAULT_MAX_IDLE,
+                 context=None, timeout=None):
+        """Initializer.
+
+        'host' the host (and optional ':port') to connect to.
+        'secure' whether to use HTTPS.
+        'max_idle' the maximum number of idle connections kept open.
+        'context' the ssl.SSLContext used for HTTPS.  If None, a default
+        context verifying the server certificate is created.
+        'timeout' the socket timeout, in seconds.  If None, the default
+        socket timeout is used."""
+
+        assert host != None
+        assert max_idle >= 0
+
+        self.host = host
+        self.secure = secure
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._idle = []
+
+        if secure and context == None:
+            context = ssl.create_default_context()
+        self.context = context
+
+    def request(self, method, path, body='', headers=None, timeout=None):
+        """Execute a request on a pooled connection.
+
+        'timeout' bounds the whole request: the socket timeout of each
+        step (connect, TLS handshake, send, read) is set to the time
+        remaining.
+
+        Returns (status, body).
+
+        If the timeout expires, throws a DeadlineExceededException."""
+
+        deadline = None
+        if timeout != None:
+            deadline = time.time() + timeout
+
+        connection, reused = self._acquire()
+        try:
+            try:
+                sent = self._send(connection, method, path, body, headers,
+                                  deadline)
+            except _STALE_CONNECTION_ERRORS, e:
+                connection.close()
+                if not reused or not _is_stale(e) or _is_expired(deadline):
+                    raise
+                connection = self._new_connection()
+                sent = self._send(connection, method, path, body, headers,
+                                  deadline)
+                reused = False
+            try:
+                response = self._receive(connection, deadline, sent)
+            except _STALE_CONNECTION_ERRORS, e:
+                connection.close()
+                if (not reused or not _is_stale(e) or
+                    method not in _REPLAYABLE_METHODS or
+                    _is_expired(deadline)):
+                    raise
+                connection = self._new_connection()
+                sent = self._send(connection, method, path, body, headers,
+                                  deadline)
+                response = self._receive(connection, deadline, sent)
+            status = response.status
+            self._set_timeout(connection, deadline)
+            start = time.time()
+            data = response.read()
+            call = get_current_call()
+            if call != None:
+                call.add_phase('transfer', start, time.time())
+        except (socket.error, httplib.HTTPException):
+            connection.close()
+            if _is_expired(deadline):
+                raise DeadlineExceededException(
+                    'The request did not complete before its deadline.')
+            raise
+        except:
+            connection.close()
+            raise
+
+        if response.will_close:
+            connection.close()
+        else:
+            self._release(connection)
+
+        return status, data
+
+    def prewarm(self, n):
+        """Open and handshake 'n' connections in parallel, and add them
+        to the idle connections (up to 'max_idle').
+
+        Each connection is given the pool's timeout, or
+        DEFAULT_PREWARM_TIMEOUT seconds if it has none, to connect.
+
+        Returns the number of connections added to the idle
+        connections.  Connection failures are ignored; the requests that
+        follow open connections as usual."""
+
+        opened = []
+        timeout = self.timeout
+        if timeout == None:
+            timeout = DEFAULT_PREWARM_TIMEOUT
+
+        def connect():
+            connection = self._new_connection()
+            connection.timeout = timeout
+            try:
+                connection.connect()
+            except (socket.error, httplib.HTTPException):
+                connection.close()
+                return
+            # Back to the pool's timeout for the requests.
+            connection.timeout = self._get_timeout()
+            if self.timeout == None:
+                connection.sock.settimeout(socket.getdefaulttimeout())
+            else:
+                connection.sock.settimeout(self.timeout)
+            opened.append(connection)
+
+        threads = [threading.Thread(target=connect) for i in range(n)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        added = 0
+        for connection in opened:
+            if self._release(connection):
+                added += 1
+        return added
+
+    def get_idle_count(self):
+        """Returns the number of idle connections."""
+
+        with self._lock:
+            return len(self._idle)
+
+    def close(self):
+        """Close the idle connections."""
+
+        with self._lock:
+            idle = self._idle
+            self._idle = []
+        for connection in idle:
+            connection.close()
+
+    def _acquire(self):
+        """Returns (connection, reused)."""
+
+        with self._lock:
+            if len(self._idle) > 0:
+                return self._idle.pop(), True
+        return self._new_connection(), False
+
+    def _release(self, connection):
+        """Returns True if 'connection' was kept idle, False if it was
+        closed."""
+
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(connection)
+                return True
+        connection.close()
+        return False
+
+    def _send(self, connection, method, path, body, headers, deadline):
+        """Sends the request.  Returns the time it was sent."""
+
+        call = get_current_call()
+        self._set_timeout(connection, deadline)
+        if call == None:
+            connection.request(method, path, body, headers or {})
+            return time.time()
+
+        # Connect first, so that connecting isn't counted as sending.
+        if connection.sock == None:
+            connection.connect()
+        start = time.time()
+        connection.request(method, path, body, headers or {})
+        sent = time.time()
+        call.add_phase('send', start, sent)
+        return sent
+
+    def _receive(self, connection, deadline, sent):
+        """Returns the response to the request sent at 'sent'."""
+
+        self._set_timeout(connection, deadline)
+        response = connection.getresponse()
+        call = get_current_call()
+        if call != None:
+            call.add_phase('wait', sent, time.time())
+        return response
+
+    def _set_timeout(self, connection, deadline):
+        """Set the timeout of 'connection', and of its socket if open,
+        to the time remaining before 'deadline'."""
+
+        if deadline == None:
+            return
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise DeadlineExceededException(
+                'The request did not complete before its deadline.')
+        if self.timeout != None:
+            remaining = min(remaining, self.timeout)
+        connection.timeout = remaining
+        if connection.sock != None:
+            connection.sock.settimeout(remaining)
+
+    def _new_connection(self):
+        if self.secure:
+            connection = _HTTPSConnection(self, self.host,
+                                          timeout=self._get_timeout())
+        else:
+            connection = _HTTPConnection(self.host,
+                                         timeout=self._get_timeout())
+        if __debug_level__ > 0:
+            connection.set_debuglevel(__debug_level__)
+        return connection
+
+    def _get_timeout(self):
+        if self.timeout == None:
+            return socket._GLOBAL_DEFAULT_TIMEOUT
+        return self.timeout
+
+###
+###  Utility functions.
+###
+
+def _is_expired(deadline):
+    return deadline != None and time.time() >= deadline
+
+def _is_stale(e):
+    """Returns whether 'e' means the server closed the connection,
+    rather than e.g. a timeout."""
+
+    if isinstance(e, socket.timeout):
+        return False
+    if isinstance(e, (httplib.BadStatusLine, httplib.CannotSendRequest)):
+        return True
+    return isinstance(e, socket.error) and e.errno in _STALE_ERRNOS
+
+def _create_connection(address, timeout, source_address):
+    """Like socket.create_connection(), but reports the DNS and connect
+    phases when the current call is profiled."""
+
+    call = get_current_call()
+    if call == None:
+        return socket.create_connection(address, timeout, source_address)
+
+    host, port = address
+    start = time.time()
+    infos = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+    resolved = time.time()
+    call.add_phase('dns', start, resolved)
+
+    error = socket.error('getaddrinfo returned an empty list')
+    for family, socktype, proto, canonname, sockaddr in infos:
+        sock = None
+        try:
+            sock = socket.socket(family, socktype, proto)
+            if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                sock.settimeout(timeout)
+            if source_address:
+                sock.bind(source_address)
+            sock.connect(sockaddr)
+            call.add_phase('connect', resolved, time.time())
+            return sock
+        except socket.error, e:
+            error = e
+            if sock != None:
+                sock.close()
+    raise error
+
+###
+###  Connections.
+###
+
+class _HTTPConnection(httplib.HTTPConnection):
+    """An HTTP connection reporting its connect phases when
+    profiled."""
+
+    def connect(self):
+        self.sock = _create_connection((self.host, self.port), self.timeout,
+                                       self.source_address)
+        if self._tunnel_host:
+            self._tunnel()
+
+class _HTTPSConnection(httplib.HTTPSConnection):
+    """An HTTPS connection using its pool's SSL context, and reporting
+    its connect phases when profiled."""
+
+    def __init__(self, pool, host, timeout):
+        httplib.HTTPSConnection.__init__(self, host, timeout=timeout,
+                                         context=pool.context)
+        self._pool = pool
+
+    def connect(self):
+        sock = _create_connection((self.host, self.port), self.timeout,
+                                  self.source_address)
+        if self._tunnel_host:
+            self.sock = sock
+            self._tunnel()
+            server_hostname = self._tunnel_host
+        else:
+            server_hostname = self.host
+
+        start = time.time()
+        self.sock = self._pool.context.wrap_socket(
+            sock, server_hostname=server_hostname)
+        call = get_current_call()
+        if call != None:
+            call.add_phase('tls', start, time.time())
@@ -0,0 +1,453 @@
+##
+##  This file contains a multi-process crawler for whole-account scans.
+##  The bundle list, or the result of a search, is split into shards of
+##  consecutive bundles addressed by offset; each shard is retrieved by
+##  a worker process with its own connections, so that the decoding of
+##  the pages (and the processing of the bundles) isn't serialized by
+##  the GIL.
+##
+##      for bundle in crawl(processes=8, embed_tracks=True):
+##          ...
+##
+
+import os
+import time
+import select
+import urllib
+import collections
+import traceback
+import multiprocessing
+import op3nvoice
+from __init__ import __api_version__
+from deadline import Deadline, get_remaining
+
+DEFAULT_SHARD_SIZE = 1000
+DEFAULT_PAGE_SIZE = 100
+DEFAULT_RETRIES = 2
+
+# How often the parent checks that its workers are alive, in seconds.
+_POLL_INTERVAL = 0.5
+
+###
+###  The crawler.
+###
+
+def crawl(mapper=None, query=None, query_field=None, filter=None,
+          embed_tracks=None, embed_metadata=None, fields=None,
+          processes=None, ordered=True, shard_size=DEFAULT_SHARD_SIZE,
+          page_size=DEFAULT_PAGE_SIZE, total=None, max_rate=None,
+          retries=DEFAULT_RETRIES, transport_factory=None, timeout=None):
+    """Generates every bundle of the account, or of the result of a
+    search, retrieved by worker processes.
+
+    'mapper' may be None, or a function applied to each bundle (the
+    embedded bundle data) in the worker process; its results are
+    generated instead of the bundles.  It must be defined at module
+    level in order to be pickled.
+    'query', 'query_field', 'filter' if 'query' is not None, crawl the
+    result of search() instead of the whole bundle list.  See search()
+    for details.
+    'embed_tracks', 'embed_metadata', 'fields' see get_bundle_list().
+    'processes' the number of worker processes.  If None, the number of
+    CPUs is used.
+    'ordered' if True, bundles are generated in collection order, each
+    shard as soon as it and the ones before it are available.  If
+    False, they are generated as the shards arrive, which keeps every
+    worker busy when one shard is slow.
+    'shard_size' the number of bundles per shard.
+    'page_size' the number of bundles per page within a shard.
+    'total' the number of bundles, if known.  If None, shards are
+    handed out until one comes back short.
+    'max_rate' the maximum number of page requests per second, across
+    every worker process.  May be None.
+    'retries' the number of times a failed shard (API error, or crashed
+    worker) is retried.  A retry resumes after the bundles already
+    received, so none is generated twice.
+    'transport_factory' may be None, or a function returning the
+    Transport of a worker process.  If None, a worker replaces an
+    inherited ConnectionPool with a new one to the same host, and keeps
+    a MemoryTransport; any other transport (e.g. a wrapping one) can't
+    be rebuilt, and requires a factory.
+    'timeout' the number of seconds the whole crawl may take, or a
+    Deadline.  May be None.
+
+    Shards are addressed with the API's 'offset' parameter, so changes
+    to the collection during the crawl may cause bundles to be skipped
+    or repeated at shard boundaries.
+
+    If a shard is out of retries, throws a CrawlerException.  If the
+    timeout expires, throws a DeadlineExceededException.  If the
+    transport needs a 'transport_factory' and none is given, throws an
+    APIConfigurationException."""
+
+    # Argument error checking.
+    assert shard_size > 0
+    assert 0 < page_size <= shard_size
+    assert total == None or total >= 0
+    assert max_rate == None or max_rate > 0
+    assert retries >= 0
+
+    if transport_factory == None:
+        _check_transport(op3nvoice.get_transport())
+    if processes == None:
+        processes = multiprocessing.cpu_count()
+    deadline = Deadline.get(timeout)
+
+    spec = _Spec(mapper, query, query_field, filter, embed_tracks,
+                 embed_metadata, fields, page_size, transport_factory)
+    crawler = _Crawler(spec, processes, ordered, shard_size, total,
+                       max_rate, retries, deadline)
+    try:
+        for value in crawler.run():
+            yield value
+    finally:
+        crawler.stop()
+
+class _Spec(object):
+    """What the workers retrieve.  Pickled to the worker processes."""
+
+    def __init__(self, mapper, query, query_field, filter, embed_tracks,
+                 embed_metadata, fields, page_size, transport_factory):
+        self.mapper = mapper
+        self.query = query
+        self.query_field = query_field
+        self.filter = filter
+        self.embed_tracks = embed_tracks
+        self.embed_metadata = embed_metadata
+        self.fields = fields
+        self.page_size = page_size
+        self.transport_factory = transport_factory
+
+    def get_page(self, offset, limit, deadline):
+        """Returns the items of the page of 'limit' bundles at
+        'offset'."""
+
+        if self.query == None:
+            href = '/%s/%s?%s' % (__api_version__, op3nvoice.BUNDLES_PATH,
+                                  urllib.urlencode({'offset': offset}))
+            page = op3nvoice.get_bundle_list(href, limit, True,
+                                             self.embed_tracks,
+                                             self.embed_metadata, deadline,
+                                             self.fields)
+        else:
+            # A search href has to carry the query.
+            params = {'query': self.query, 'offset': offset}
+            if self.query_field != None:
+                params['query_field'] = self.query_field
+            if self.filter != None:
+                params['filter'] = self.filter
+            href = '/%s/%s?%s' % (__api_version__, op3nvoice.SEARCH_PATH,
+                                  urllib.urlencode(params))
+            page = op3nvoice.search(href, self.query, self.query_field,
+                                    self.filter, limit, True,
+                                    self.embed_tracks, self.embed_metadata,
+                                    deadline, self.fields)
+        return op3nvoice.get_page_items(page)
+
+class _Shard(object):
+    __slots__ = ['received', 'failures', 'chunks', 'done']
+
+    def __init__(self):
+        # The number of bundles received, where a retry resumes.
+        self.received = 0
+        self.failures = 0
+        # Received but not generated yet (ordered crawls only).
+        self.chunks = []
+        self.done = False
+
+class _Worker(object):
+    __slots__ = ['process', 'conn', 'shard']
+
+    def __init__(self, process, conn):
+        self.process = process
+        self.conn = conn
+        # The index of the shard being retrieved, or None if idle.
+        self.shard = None
+
+    def fileno(self):
+        """For select()."""
+        return self.conn.fileno()
+
+class _Crawler(object):
+    """Hands shards out to the worker processes and merges what they
+    send back.
+
+    Each worker has a pipe of its own, written synchronously, so that a
+    worker dying can't lose or corrupt the messages of the others, and
+    shows up as the end of its pipe."""
+
+    def __init__(self, spec, processes, ordered, shard_size, total,
+                 max_rate, retries, deadline):
+        self.spec = spec
+        self.processes = processes
+        self.ordered = ordered
+        self.shard_size = shard_size
+        self.total = total
+        self.retries = retries
+        self.deadline = deadline
+
+        self._limiter = None
+        if max_rate != None:
+            self._limiter = _RateLimiter(max_rate)
+        self._workers = []
+        # shard index -> _Shard, for shards handed out and not passed by
+        # the head
+        self._shards = {}
+        self._next_shard = 0
+        # Failed shards waiting for a worker.
+        self._failed = collections.deque()
+        # The index of the last shard, once known.
+        self._last = None
+        if total != None:
+            self._last = (total - 1) // shard_size
+        # The first shard not done (and, in ordered crawls, the next to
+        # generate).
+        self._head = 0
+
+    def run(self):
+        for i in range(self.processes):
+            self._start_worker()
+
+        while self._last == None or self._head <= self._last:
+            get_remaining(self.deadline)
+            self._dispatch()
+            for worker in self._wait():
+                try:
+                    message = worker.conn.recv()
+                except (EOFError, IOError):
+                    self._replace_worker(worker)
+                    continue
+                for value in self._handle(worker, message):
+                    yield value
+
+    def stop(self):
+        for worker in self._workers:
+            try:
+                worker.conn.send(None)
+            except IOError:
+                pass
+        for worker in self._workers:
+            worker.process.join(_POLL_INTERVAL)
+            if worker.process.is_alive():
+                worker.process.terminate()
+                worker.process.join()
+            worker.conn.close()
+        self._workers = []
+
+    def _dispatch(self):
+        """Hand a shard to every idle worker.  An ordered crawl doesn't
+        run too far ahead of the shard being generated, to bound what it
+        buffers."""
+
+        for worker in self._workers:
+            if worker.shard != None:
+                continue
+            if len(self._failed) > 0:
+                index = self._failed.popleft()
+            else:
+                index = self._next_shard
+                if self._last != None and index > self._last:
+                    return
+                if self.ordered and index >= self._head + 2 * self.processes:
+                    return
+                self._shards[index] = _Shard()
+                self._next_shard += 1
+            shard = self._shards[index]
+            worker.shard = index
+            offset = index * self.shard_size
+            size = self.shard_size
+            if self.total != None:
+                size = min(size, self.total - offset)
+            worker.conn.send((offset + shard.received, size - shard.received))
+
+    def _wait(self):
+        """Returns the workers with something to read, waiting up to
+        _POLL_INTERVAL (or the time remaining) for one."""
+
+        timeout = _POLL_INTERVAL
+        remaining = get_remaining(self.deadline)
+        if remaining != None:
+            timeout = min(remaining, timeout)
+        busy = [w for w in self._workers if w.shard != None]
+        if os.name == 'posix':
+            ready = select.select(busy, [], [], timeout)[0]
+        else:
+            # Pipes can't be selected on Windows.
+            end = time.time() + timeout
+            ready = [w for w in busy if w.conn.poll()]
+            while len(ready) == 0 and time.time() < end:
+                time.sleep(0.01)
+                ready = [w for w in busy if w.conn.poll()]
+        if len(ready) == 0:
+            # Workers killed without closing their pipe.
+            for worker in busy:
+                if not worker.process.is_alive():
+                    self._replace_worker(worker)
+        return ready
+
+    def _handle(self, worker, message):
+        """Generates the values made available by 'message'."""
+
+        index = worker.shard
+        shard = self._shards[index]
+        kind = message[0]
+        if kind == 'items':
+            items = message[1]
+            shard.received += len(items)
+            if not self.ordered or index == self._head:
+                for item in items:
+                    yield item
+            else:
+                shard.chunks.append(items)
+        elif kind == 'done':
+            shard.done = True
+            worker.shard = None
+            if message[1] and (self._last == None or index < self._last):
+                # The collection ends in this shard.
+                self._last = index
+            for item in self._advance():
+                yield item
+        elif kind == 'error':
+            worker.shard = None
+            self._retry(index, message[1])
+
+    def _advance(self):
+        """Moves the head past the completed shards, generating the
+        bundles buffered by an ordered crawl."""
+
+        while self._head in self._shards:
+            shard = self._shards[self._head]
+            for chunk in shard.chunks:
+                for item in chunk:
+                    yield item
+            shard.chunks = []
+            if not shard.done:
+                return
+            del self._shards[self._head]
+            self._head += 1
+
+    def _retry(self, index, error):
+        shard = self._shards[index]
+        shard.failures += 1
+        if shard.failures > self.retries:
+            raise CrawlerException('Shard %d failed %d times:\n%s' %
+                                   (index, shard.failures, error))
+        self._failed.append(index)
+
+    def _replace_worker(self, worker):
+        """Replace a worker that died, retrying its shard."""
+
+        self._workers.remove(worker)
+        worker.conn.close()
+        worker.process.join()
+        if worker.shard != None:
+            self._retry(worker.shard, 'Worker exited with code %s.' %
+                        worker.process.exitcode)
+        self._start_worker()
+
+    def _start_worker(self):
+        conn, child_conn = multiprocessing.Pipe()
+        process = multiprocessing.Process(
+            target=_work, args=(child_conn, self.spec, self._limiter,
+                                self.deadline))
+        process.daemon = True
+        process.start()
+        # Only the worker holds its end, so that its exit ends the pipe.
+        child_conn.close()
+        self._workers.append(_Worker(process, conn))
+
+###
+###  Rate limiting.
+###
+
+class _RateLimiter(object):
+    """Spaces requests evenly across processes, through shared memory."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self._next = multiprocessing.Value('d', 0.0)
+
+    def wait(self):
+        with self._next.get_lock():
+            now = time.time()
+            start = max(self._next.value, now)
+            self._next.value = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+###
+###  Exceptions.
+###
+
+class CrawlerException(Exception):
+    """Thrown when a shard can't be retrieved."""
+
+    msg = None
+
+    def __init__(self, msg):
+        self.msg = msg
+
+    def get_message(self):
+        """Returns the error message, with the last failure."""
+        return self.msg
+
+###
+###  Utility functions.
+###
+
+def _work(conn, spec, limiter, deadline):
+    """Runs in a worker process, retrieving the shards it is handed."""
+
+    _reset_transport(spec.transport_factory)
+    while True:
+        task = conn.recv()
+        if task == None:
+            return
+        offset, count = task
+        try:
+            received = 0
+            exhausted = False
+            while received < count:
+                limit = min(spec.page_size, count - received)
+                if limiter != None:
+                    limiter.wait()
+                items = spec.get_page(offset + received, limit, deadline)
+                received += len(items)
+                if spec.mapper != None:
+                    items = [spec.mapper(item) for item in items]
+                if len(items) > 0:
+                    conn.send(('items', items))
+                if len(items) < limit:
+                    exhausted = True
+                    break
+            conn.send(('done', exhausted))
+        except Exception:
+            conn.send(('error', traceback.format_exc()))
+
+def _check_transport(transport):
+    """Throws an APIConfigurationException if a worker process can't
+    rebuild 'transport' by itself."""
+
+    from connection import ConnectionPool
+    from transport import MemoryTransport
+    if not isinstance(transport, (ConnectionPool, MemoryTransport)):
+        raise op3nvoice.APIConfigurationException(
+            'A transport_factory is required to crawl with a %s.'
+            % type(transport).__name__)
+
+def _reset_transport(transport_factory):
+    """Give a worker process connections of its own."""
+
+    if transport_factory != None:
+        op3nvoice.set_transport(transport_factory())
+        return
+    from connection import ConnectionPool
+    transport = op3nvoice.get_transport()
+    if isinstance(transport, ConnectionPool):
+        # Closing the inherited copies of the parent's sockets leaves
+        # the parent's connections open.
+        op3nvoice.set_transport(ConnectionPool(transport.host,
+                                               transport.secure,
+                                               transport.max_idle,
+                                               transport.context,
+                                               transport.timeout))
@@ -0,0 +1,81 @@
+##
+##  This file contains the deadlines bounding API calls.  A Deadline is
+##  created from a timeout once and passed down through pagination,
+##  retries and bulk helpers, so that every request they make only gets
+##  the time remaining.
+##
+
+import time
+
+###
+###  Deadlines.
+###
+
+class Deadline(object):
+    """A point in time by which an operation must be complete."""
+
+    expires = None
+
+    def __init__(self, timeout):
+        """Initializer.
+
+        'timeout' the number of seconds from now.  May not be None."""
+
+        assert timeout != None
+        self.expires = time.time() + timeout
+
+    @classmethod
+    def get(cls, timeout):
+        """Returns a Deadline from 'timeout', which may be None (no
+        deadline, None is returned), a number of seconds, or a Deadline
+        (returned as is)."""
+
+        if timeout == None or isinstance(timeout, Deadline):
+            return timeout
+        return cls(timeout)
+
+    def get_remaining(self):
+        """Returns the number of seconds left, 0 if expired."""
+
+        return max(self.expires - time.time(), 0)
+
+    def is_expired(self):
+        """Returns True if the deadline has passed."""
+
+        return time.time() >= self.expires
+
+    def check(self):
+        """Returns the number of seconds left.
+
+        If the deadline has passed, throws a DeadlineExceededException."""
+
+        remaining = self.expires - time.time()
+        if remaining <= 0:
+            raise DeadlineExceededException('The deadline has passed.')
+        return remaining
+
+def get_remaining(deadline):
+    """Returns the seconds left before 'deadline' (a Deadline or None),
+    or None if there is no deadline.
+
+    If the deadline has passed, throws a DeadlineExceededException."""
+
+    if deadline == None:
+        return None
+    return deadline.check()
+
+###
+###  Exceptions.
+###
+
+class DeadlineExceededException(Exception):
+    """Thrown when an API call doesn't complete before its deadline."""
+
+    msg = None
+
+    def __init__(self, msg):
+        self.msg = msg
+
+    def get_message(self):
+        """Returns the error message."""
+        return self.msg
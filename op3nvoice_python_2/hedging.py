@@ -0,0 +1,261 @@
+##
+##  This file contains a transport hedging idempotent reads.  When a GET
+##  takes longer than a given percentile of its endpoint's recent
+##  latencies, a duplicate is sent on another connection and whichever
+##  answers first is used.  This trims the latency tail at the cost of
+##  a small, budgeted amount of extra load.
+##
+
+import sys
+import time
+import Queue
+import threading
+import collections
+from transport import Transport
+from transport import get_endpoint
+from deadline import DeadlineExceededException
+
+DEFAULT_PERCENTILE = 95
+DEFAULT_BUDGET = 0.05
+DEFAULT_MIN_SAMPLES = 20
+DEFAULT_WINDOW = 500
+DEFAULT_WORKERS = 16
+
+# The most hedges that can be saved up while traffic is quiet.
+_MAX_TOKENS = 10.0
+
+###
+###  The transport.
+###
+
+class HedgedTransport(Transport):
+    """Wraps another transport, hedging its GET requests.
+
+    Typical use:
+
+        op3nvoice.set_transport(HedgedTransport(ConnectionPool()))
+
+    Other methods aren't idempotent and are passed through unchanged."""
+
+    def __init__(self, transport, percentile=DEFAULT_PERCENTILE,
+                 budget=DEFAULT_BUDGET, min_samples=DEFAULT_MIN_SAMPLES,
+                 window=DEFAULT_WINDOW, workers=DEFAULT_WORKERS):
+        """Initializer.
+
+        'transport' the transport executing the requests.  It must be
+        able to run two requests at once (a connection pool).  May not
+        be None.
+        'percentile' the percentile (0 to 100) of the endpoint's recent
+        latencies after which a duplicate request is sent.
+        'budget' the maximum number of duplicate requests per request,
+        e.g. 0.05 caps the extra load at 5%.
+        'min_samples' the number of latencies an endpoint needs before
+        its requests are hedged.
+        'window' the number of recent latencies kept per endpoint.
+        'workers' the maximum number of threads running hedged requests
+        and their duplicates.  When all of them are busy, a request is
+        sent without a hedge."""
+
+        assert transport != None
+        assert 0 < percentile < 100
+        assert 0 <= budget <= 1
+        assert workers > 0
+
+        self._transport = transport
+        self._percentile = percentile
+        self._budget = budget
+        self._min_samples = min_samples
+        self._window = window
+        self._lock = threading.Lock()
+        self._latencies = {}
+        self._tokens = _MAX_TOKENS
+        self._workers = _WorkerPool(workers)
+        self.requests = 0
+        self.hedged = 0
+        self.hedges_won = 0
+
+    def request(self, method, path, body='', headers=None, timeout=None):
+        if method != 'GET':
+            return self._transport.request(method, path, body, headers,
+                                           timeout)
+
+        endpoint = get_endpoint(method, path)
+        delay = self._get_hedge_delay(endpoint)
+        start = time.time()
+
+        deadline = None
+        if timeout != None:
+            deadline = start + timeout
+        if delay != None and timeout != None:
+            delay = min(delay, timeout)
+
+        # Both attempts report to 'results'; the first success wins and
+        # the other attempt's response is discarded when it arrives.
+        # The primary attempt records its latency whichever wins, so
+        # that the percentiles aren't biased towards fast responses.
+        results = Queue.Queue()
+        if delay == None or not self._submit(results, 0, method, path, body,
+                                             headers, deadline, endpoint):
+            result = self._transport.request(method, path, body, headers,
+                                             timeout)
+            self._record(endpoint, time.time() - start)
+            return result
+
+        attempts = 1
+        try:
+            outcome = results.get(True, delay)
+        except Queue.Empty:
+            outcome = None
+            if self._take_token():
+                if self._submit(results, 1, method, path, body, headers,
+                                deadline, None):
+                    attempts = 2
+                else:
+                    self._return_token()
+
+        failures = []
+        while True:
+            if outcome == None:
+                outcome = self._get_outcome(results, deadline)
+            attempt, value, exc_info = outcome
+            if exc_info == None:
+                break
+            failures.append(exc_info)
+            if len(failures) == attempts:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            outcome = None
+
+        if attempt == 1:
+            with self._lock:
+                self.hedges_won += 1
+        return value
+
+    def prewarm(self, n):
+        return self._transport.prewarm(n)
+
+    def close(self):
+        self._workers.close()
+        self._transport.close()
+
+    def get_hedge_delay(self, method, path):
+        """Returns the delay after which a request would be hedged, or
+        None if it wouldn't be."""
+
+        return self._get_hedge_delay(get_endpoint(method, path))
+
+    def _get_hedge_delay(self, endpoint):
+        with self._lock:
+            self.requests += 1
+            self._tokens = min(self._tokens + self._budget, _MAX_TOKENS)
+            latencies = self._latencies.get(endpoint)
+            if latencies == None or len(latencies) < self._min_samples:
+                return None
+            ordered = sorted(latencies)
+        return ordered[int(len(ordered) * self._percentile / 100.0)]
+
+    def _take_token(self):
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            self.hedged += 1
+            return True
+
+    def _return_token(self):
+        with self._lock:
+            self._tokens += 1
+            self.hedged -= 1
+
+    def _record(self, endpoint, latency):
+        with self._lock:
+            latencies = self._latencies.get(endpoint)
+            if latencies == None:
+                latencies = collections.deque(maxlen=self._window)
+                self._latencies[endpoint] = latencies
+            latencies.append(latency)
+
+    def _get_outcome(self, results, deadline):
+        if deadline == None:
+            return results.get()
+        try:
+            return results.get(True, max(deadline - time.time(), 0))
+        except Queue.Empty:
+            raise DeadlineExceededException(
+                'The request did not complete before its deadline.')
+
+    def _submit(self, results, attempt, method, path, body, headers,
+                deadline, endpoint):
+        """Run an attempt on a worker.  Its latency is recorded for
+        'endpoint' unless None.  Returns False if every worker is
+        busy."""
+
+        start = time.time()
+        timeout = None
+        if deadline != None:
+            timeout = max(deadline - start, 0)
+
+        def run():
+            try:
+                value = self._transport.request(method, path, body, headers,
+                                                timeout)
+            except:
+                results.put((attempt, None, sys.exc_info()))
+                return
+            if endpoint != None:
+                self._record(endpoint, time.time() - start)
+            results.put((attempt, value, None))
+
+        return self._workers.submit(run)
+
+class _WorkerPool(object):
+    """Runs functions on up to 'max_workers' threads, started as they
+    are needed and kept for the functions that follow."""
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._queue = Queue.Queue()
+        self._threads = 0
+        self._idle = 0
+        self._closed = False
+
+    def submit(self, func):
+        """Returns False, without running 'func', if every worker is
+        busy or the pool is closed."""
+
+        with self._lock:
+            if self._closed:
+                return False
+            if self._idle > 0:
+                self._idle -= 1
+            elif self._threads < self.max_workers:
+                self._threads += 1
+                t = threading.Thread(target=self._work)
+                t.daemon = True
+                t.start()
+            else:
+                return False
+        self._queue.put(func)
+        return True
+
+    def get_thread_count(self):
+        with self._lock:
+            return self._threads
+
+    def close(self):
+        """Stop the workers once they are done."""
+
+        with self._lock:
+            self._closed = True
+            threads = self._threads
+        for i in range(threads):
+            self._queue.put(None)
+
+    def _work(self):
+        while True:
+            func = self._queue.get()
+            if func == None:
+                return
+            func()
+            with self._lock:
+                self._idle += 1
@@ -0,0 +1,251 @@
+##
+##  This file contains an HTTP/2 alternative to the HTTP/1.1 connection
+##  pool.  Concurrent requests are multiplexed as streams over a few
+##  connections instead of needing one socket each.  Framing, flow
+##  control and header compression are provided by the optional hyper
+##  package.  When the server doesn't negotiate HTTP/2, or hyper isn't
+##  installed, requests fall back to an HTTP/1.1 ConnectionPool.
+##
+
+import ssl
+import socket
+import threading
+import op3nvoice
+from transport import Transport
+from connection import ConnectionPool
+from deadline import DeadlineExceededException
+from __init__ import __host__
+
+try:
+    import hyper
+    import h2.exceptions
+except ImportError:
+    hyper = None
+
+DEFAULT_CONNECTIONS = 2
+DEFAULT_MAX_STREAMS = 100
+
+# The HTTP/2 connection preface, followed by an empty SETTINGS frame.
+_PREFACE = ('PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n'
+            '\x00\x00\x00\x04\x00\x00\x00\x00\x00')
+_SETTINGS_FRAME = '\x04'
+
+###
+###  The pool.
+###
+
+class HTTP2ConnectionPool(Transport):
+    """A thread safe pool multiplexing requests over a few HTTP/2
+    connections to one host."""
+
+    def __init__(self, host=__host__, secure=True,
+                 connections=DEFAULT_CONNECTIONS,
+                 max_streams=DEFAULT_MAX_STREAMS, context=None, timeout=None):
+        """Initializer.
+
+        'host' the host (and optional ':port') to connect to.
+        'secure' whether to use TLS.  HTTP/2 is negotiated with ALPN,
+        falling back to HTTP/1.1.  Without TLS, the connection preface
+        is sent to find out whether the server speaks HTTP/2 (prior
+        knowledge).
+        'connections' the maximum number of HTTP/2 connections.
+        'max_streams' the maximum number of concurrent requests on one
+        connection.  Further requests wait for a stream to finish.
+        'context' the ssl.SSLContext used for TLS.  If None, a default
+        context verifying the server certificate is created.
+        'timeout' the socket timeout, in seconds.
+
+        Without the hyper package, only HTTP/1.1 is offered with ALPN;
+        if a server without TLS speaks HTTP/2 only, requests throw an
+        APIConfigurationException."""
+
+        assert host != None
+        assert connections > 0
+        assert max_streams > 0
+
+        self.host = host
+        self.secure = secure
+        self.max_streams = max_streams
+        self.timeout = timeout
+
+        if secure and context == None:
+            context = ssl.create_default_context()
+        if secure and hyper != None:
+            context.set_alpn_protocols(['h2', 'http/1.1'])
+        elif secure:
+            context.set_alpn_protocols(['http/1.1'])
+        self.context = context
+
+        self._condition = threading.Condition()
+        self._slots = [_Slot() for i in range(connections)]
+        self._protocol = None
+        self._fallback = None
+
+    def request(self, method, path, body='', headers=None, timeout=None):
+        """Execute a request on a multiplexed stream.
+
+        hyper only supports a socket timeout per connection, so on HTTP/2
+        'timeout' is only checked before the request is sent; the
+        pool's 'timeout' bounds each socket operation.
+
+        Returns (status, body)."""
+
+        if self._get_protocol() != 'h2':
+            return self._fallback.request(method, path, body, headers,
+                                          timeout)
+        if timeout != None and timeout <= 0:
+            raise DeadlineExceededException('The deadline has passed.')
+
+        slot = self._acquire()
+        try:
+            connection = self._get_connection(slot)
+            try:
+                stream_id = connection.request(method, path, body or None,
+                                               headers or {})
+                response = connection.get_response(stream_id)
+                return response.status, response.read()
+            except (socket.error, h2.exceptions.H2Error):
+                self._reset(slot, connection)
+                raise
+        finally:
+            self._release(slot)
+
+    def prewarm(self, n):
+        """Open and handshake up to 'n' connections in parallel.
+
+        Returns the number of connections opened."""
+
+        if self._get_protocol() != 'h2':
+            return self._fallback.prewarm(n)
+
+        opened = []
+
+        def connect(slot):
+            try:
+                self._get_connection(slot).connect()
+            except (socket.error, h2.exceptions.H2Error):
+                return
+            opened.append(slot)
+
+        threads = [threading.Thread(target=connect, args=(slot,))
+                   for slot in self._slots[:n]]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return len(opened)
+
+    def get_protocol(self):
+        """Returns 'h2' or 'http/1.1', negotiating it if needed."""
+
+        return self._get_protocol()
+
+    def close(self):
+        """Close every connection."""
+
+        with self._condition:
+            for slot in self._slots:
+                if slot.connection != None:
+                    slot.connection.close()
+                    slot.connection = None
+        if self._fallback != None:
+            self._fallback.close()
+
+    def _get_protocol(self):
+        if self._protocol == None:
+            with self._condition:
+                if self._protocol == None:
+                    protocol = self._negotiate()
+                    if protocol == 'h2' and hyper == None:
+                        raise op3nvoice.APIConfigurationException(
+                            'HTTP/2 requires the hyper package.')
+                    self._protocol = protocol
+                    if self._protocol != 'h2':
+                        self._fallback = ConnectionPool(self.host,
+                                                        self.secure,
+                                                        context=self.context,
+                                                        timeout=self.timeout)
+        return self._protocol
+
+    def _negotiate(self):
+        """Returns the protocol the server selects with ALPN or, without
+        TLS, 'h2' if the server answers the connection preface with a
+        SETTINGS frame.  An HTTP/1.1 server answers with an error
+        response instead."""
+
+        host, port = _split_host(self.host)
+        if port == None:
+            port = 443 if self.secure else 80
+        sock = socket.create_connection((host, port), self.timeout)
+        try:
+            if self.secure:
+                sock = self.context.wrap_socket(sock, server_hostname=host)
+                return sock.selected_alpn_protocol() or 'http/1.1'
+
+            sock.sendall(_PREFACE)
+            # The frame type is the 4th byte of the frame header.
+            data = ''
+            while len(data) < 4:
+                chunk = sock.recv(4 - len(data))
+                if not chunk:
+                    break
+                data += chunk
+            if len(data) == 4 and data[3] == _SETTINGS_FRAME:
+                return 'h2'
+            return 'http/1.1'
+        finally:
+            sock.close()
+
+    def _acquire(self):
+        """Returns the least busy slot with a free stream, waiting for
+        one if needed."""
+
+        with self._condition:
+            while True:
+                slot = min(self._slots, key=lambda s: s.active)
+                if slot.active < self.max_streams:
+                    slot.active += 1
+                    return slot
+                self._condition.wait()
+
+    def _release(self, slot):
+        with self._condition:
+            slot.active -= 1
+            self._condition.notify()
+
+    def _get_connection(self, slot):
+        with self._condition:
+            if slot.connection == None:
+                host, port = _split_host(self.host)
+                slot.connection = hyper.HTTP20Connection(
+                    host, port, secure=self.secure,
+                    ssl_context=self.context, timeout=self.timeout)
+            return slot.connection
+
+    def _reset(self, slot, connection):
+        """Drop a failed connection; the next request opens a new one."""
+
+        with self._condition:
+            if slot.connection is connection:
+                slot.connection = None
+        connection.close()
+
+class _Slot(object):
+    """One HTTP/2 connection and its number of active streams."""
+
+    def __init__(self):
+        self.connection = None
+        self.active = 0
+
+###
+###  Utility functions.
+###
+
+def _split_host(host):
+    """Returns (host, port) from 'host' or 'host:port'.  The port is
+    None if not given."""
+
+    if ':' in host:
+        host, port = host.rsplit(':', 1)
+        return host, int(port)
+    return host, None
@@ -0,0 +1,273 @@
+##
+##  This file contains an idempotency layer for create_bundle() and
+##  create_track().  Each creation is recorded in a local persistent
+##  index keyed on the media URL (plus, optionally, other parameters),
+##  so that a retried or re-run ingest returns the existing bundle or
+##  track without a network call instead of creating a duplicate.
+##
+##      creator = IdempotentCreator('ingest.index')
+##      creator.bootstrap()   # optional: index what the account has
+##      bundle = creator.create_bundle(name='Show', media_url=url)
+##      creator.close()
+##
+
+import json
+import sqlite3
+import hashlib
+import urlparse
+import threading
+import op3nvoice
+from concurrency import Future
+from deadline import Deadline, get_remaining
+
+BUNDLE = 'bundle'
+TRACK = 'track'
+
+_DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+###
+###  The creator.
+###
+
+class IdempotentCreator(object):
+    """Creates bundles and tracks at most once per key.  Thread safe.
+
+    The key of a bundle is its normalized media URL plus the values of
+    'key_params'; the key of a track is its tracks list href, its
+    normalized media URL and the values of 'key_params'.  Concurrent
+    creations with the same key in this process make one API call, and
+    every caller gets its result."""
+
+    def __init__(self, path, key_params=(), sync=True):
+        """Initializer.  Opens or creates the index.
+
+        'path' the index file, a sqlite3 database.  May not be None.
+        'key_params' the names of further create_bundle() or
+        create_track() arguments that tell creations apart (e.g.
+        ['name']).  Their values are compared as JSON.
+        'sync' whether each creation is flushed to disk (fsync) once
+        recorded.  If False, a crash of the machine may lose the most
+        recent records.
+
+        Each creation is recorded in its own transaction, so a record
+        costs the same however large the index is, and an interrupted
+        write leaves the index as it was."""
+
+        assert path != None
+
+        self.key_params = tuple(key_params)
+        self.sync = sync
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        if sync:
+            self._db.execute('PRAGMA synchronous = FULL')
+        else:
+            self._db.execute('PRAGMA synchronous = OFF')
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS records '
+                             '(key TEXT PRIMARY KEY, result TEXT NOT NULL)')
+        # key -> the Future of the creation in progress
+        self._in_flight = {}
+        self.created = 0
+        self.skipped = 0
+        self.coalesced = 0
+
+    def create_bundle(self, name=None, media_url=None, audio_channel=None,
+                      metadata=None, notify_url=None, timeout=None):
+        """Create a bundle unless one was already created for the same
+        key.  The arguments are those of create_bundle(); 'media_url'
+        may not be None.
+
+        Returns the result of create_bundle(), the recorded result of
+        the earlier creation, or for bundles found by bootstrap() a
+        reference holding their 'self' and 'o3v:tracks' links.
+
+        If the creation fails, throws its exception.  Nothing is
+        recorded, and the next call for the key tries again."""
+
+        assert media_url != None
+
+        args = {'name': name, 'media_url': media_url,
+                'audio_channel': audio_channel, 'metadata': metadata,
+                'notify_url': notify_url}
+        return self._create(self.get_key(BUNDLE, None, args),
+                            op3nvoice.create_bundle, args, timeout)
+
+    def create_track(self, href=None, media_url=None, label=None,
+                     audio_channel=None, source=None, timeout=None):
+        """Create a track unless one was already created for the same
+        key.  The arguments are those of create_track().
+
+        Returns the result of create_track(), or the recorded result of
+        the earlier creation.
+
+        If the creation fails, throws its exception."""
+
+        assert href != None
+        assert media_url != None
+
+        args = {'href': href, 'media_url': media_url, 'label': label,
+                'audio_channel': audio_channel, 'source': source}
+        return self._create(self.get_key(TRACK, href, args),
+                            op3nvoice.create_track, args, timeout)
+
+    def get_key(self, kind, href, args):
+        """Returns the index key of a creation.
+
+        'kind' BUNDLE or TRACK.
+        'href' the tracks list href of a TRACK, None for a BUNDLE.
+        'args' the creation arguments."""
+
+        parts = [kind, href and href.rstrip('/'),
+                 normalize_url(args.get('media_url'))]
+        for name in self.key_params:
+            parts.append(args.get(name))
+        return hashlib.sha1(json.dumps(parts, sort_keys=True)).hexdigest()
+
+    def get(self, key):
+        """Returns the recorded result for 'key', or None."""
+
+        with self._lock:
+            return self._get(key)
+
+    def forget(self, key):
+        """Drop the record of 'key', e.g. after deleting the bundle."""
+
+        with self._lock:
+            with self._db:
+                self._db.execute('DELETE FROM records WHERE key = ?',
+                                 (key,))
+
+    def bootstrap(self, query=None, limit=None, timeout=None):
+        """Record the bundles and tracks the account already has, from a
+        scan of the bundle list with the tracks embedded.  A bundle is
+        recorded under the media URL of its first track; 'key_params'
+        values are read from the bundle or track document.
+
+        'query' if not None, only scan the bundles returned by search()
+        for it.
+        'limit' the number of bundles per page.  May be None.
+        'timeout' the number of seconds the scan may take, or a
+        Deadline.  May be None.
+
+        Returns the number of keys recorded.
+
+        If a page retrieval fails, throws an APIException or an
+        APIDataException."""
+
+        if query != None:
+            pages = op3nvoice.iter_search_pages(None, query, None, None,
+                                                limit, True, True, None,
+                                                timeout)
+        else:
+            pages = op3nvoice.iter_bundle_list_pages(None, limit, True, True,
+                                                     None, timeout)
+        count = 0
+        for page in pages:
+            for bundle in op3nvoice.get_page_items(page):
+                count += self._bootstrap_bundle(bundle)
+        return count
+
+    def close(self):
+        """Close the index."""
+
+        with self._lock:
+            self._db.close()
+
+    def _create(self, key, function, args, timeout):
+        deadline = Deadline.get(timeout)
+        with self._lock:
+            recorded = self._get(key)
+            if recorded != None:
+                self.skipped += 1
+                return recorded
+            future = self._in_flight.get(key)
+            if future != None:
+                self.coalesced += 1
+            else:
+                self._in_flight[key] = owned = Future()
+
+        if future != None:
+            return future.result(get_remaining(deadline))
+
+        try:
+            result = function(timeout=deadline, **args)
+        except Exception:
+            with self._lock:
+                del self._in_flight[key]
+            owned.set_exception()
+            raise
+        with self._lock:
+            with self._db:
+                self._db.execute('INSERT OR REPLACE INTO records '
+                                 'VALUES (?, ?)', (key, json.dumps(result)))
+            del self._in_flight[key]
+            self.created += 1
+        owned.set_result(result)
+        return result
+
+    def _bootstrap_bundle(self, bundle):
+        href = op3nvoice.get_self_href(bundle)
+        links = bundle.get('_links', {})
+        if links.has_key('o3v:tracks'):
+            tracks_href = links['o3v:tracks']['href']
+        else:
+            tracks_href = href.rstrip('/') + '/tracks'
+
+        records = []
+        tracks = op3nvoice.get_bundle_tracks(bundle) or []
+        tracks = sorted(tracks, key=lambda t: t.get('track') or 0)
+        first = True
+        for i, track in enumerate(tracks):
+            if track.get('media_url') == None:
+                continue
+            args = dict(track)
+            if first:
+                # The bundle was created with the first media URL.
+                first = False
+                bundle_args = dict(bundle)
+                bundle_args['media_url'] = track['media_url']
+                records.append((self.get_key(BUNDLE, None, bundle_args),
+                                {'_links': {'self': {'href': href},
+                                            'o3v:tracks':
+                                                {'href': tracks_href}}}))
+            records.append((self.get_key(TRACK, tracks_href, args),
+                            {'_links': {'self': {'href': tracks_href}},
+                             'track': track.get('track', i)}))
+
+        count = 0
+        with self._lock:
+            with self._db:
+                for key, result in records:
+                    cursor = self._db.execute(
+                        'INSERT OR IGNORE INTO records VALUES (?, ?)',
+                        (key, json.dumps(result)))
+                    count += cursor.rowcount
+        return count
+
+    def _get(self, key):
+        row = self._db.execute('SELECT result FROM records WHERE key = ?',
+                               (key,)).fetchone()
+        if row == None:
+            return None
+        return json.loads(row[0])
+
+###
+###  Utility functions.
+###
+
+def normalize_url(url):
+    """Returns 'url' in a canonical form for comparison: surrounding
+    white space, the fragment and a default port removed, and the scheme
+    and host in lower case."""
+
+    if url == None:
+        return None
+    parts = urlparse.urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+    port = _DEFAULT_PORTS.get(scheme)
+    if port != None and netloc.endswith(':%d' % port):
+        netloc = netloc[:-len(':%d' % port)]
+    return urlparse.urlunsplit((scheme, netloc, parts.path or '/',
+                                parts.query, ''))
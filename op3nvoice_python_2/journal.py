@@ -0,0 +1,394 @@
+##
+##  This file contains a local write-ahead journal for create_bundle(),
+##  create_track() and update_metadata().  Calls are appended to a file
+##  and return at once; background workers then deliver them to the API,
+##  retrying transient failures.  Calls not acknowledged by the API when
+##  the process stops are delivered again the next time the journal is
+##  opened.
+##
+##      journal = WriteJournal('ingest.journal')
+##      future = journal.create_bundle(name='Show', media_url=url)
+##      ...
+##      journal.close()
+##
+
+import os
+import json
+import time
+import threading
+import collections
+import op3nvoice
+from concurrency import Future
+
+CREATE_BUNDLE = 'create_bundle'
+CREATE_TRACK = 'create_track'
+UPDATE_METADATA = 'update_metadata'
+
+DEFAULT_CONCURRENCY = 4
+DEFAULT_BACKOFF = 1.0
+DEFAULT_MAX_BACKOFF = 60.0
+
+# API statuses worth retrying; other 4xx statuses fail the entry.
+RETRY_STATUSES = (408, 429)
+
+# Calls that can be journaled, with the argument ordering them: calls
+# with the same value run one after the other, in journal order.
+_CALLS = {
+    CREATE_BUNDLE: None,
+    CREATE_TRACK: 'href',
+    UPDATE_METADATA: 'href',
+}
+
+###
+###  The journal.
+###
+
+class WriteJournal(object):
+    """An append-only journal of API writes, delivered asynchronously.
+    Thread safe.
+
+    Delivery is at least once: a call whose response was lost is
+    repeated, so a repeated create_bundle() or create_track() may create
+    a duplicate.  Calls to the same href (tracks list or metadata) are
+    delivered in the order they were journaled; others run
+    concurrently."""
+
+    def __init__(self, path, concurrency=DEFAULT_CONCURRENCY, retries=None,
+                 backoff=DEFAULT_BACKOFF, max_backoff=DEFAULT_MAX_BACKOFF,
+                 sync=True, call_timeout=None, on_error=None):
+        """Initializer.  Opens or creates the journal, and starts
+        delivering the calls it holds that weren't acknowledged.
+
+        'path' the journal file.  May not be None.
+        'concurrency' the number of calls delivered at the same time.
+        'retries' the number of times a call failing transiently (a
+        network error, a timeout, a 5xx, 408 or 429 status) is retried.
+        If None, it is retried until it succeeds or the journal is
+        closed.  A call out of retries stays in the journal and is
+        delivered again when the journal is next opened.
+        'backoff' the number of seconds before the first retry.  Each
+        retry doubles it, up to 'max_backoff'.
+        'sync' whether each call is flushed to disk (fsync) before it
+        returns.  If False, a crash of the machine may lose the most
+        recent calls.
+        'call_timeout' the number of seconds each delivery attempt may
+        take.  May be None.
+        'on_error' may be None, or a function called with the call name,
+        its arguments and the exception when a call fails for good, or
+        runs out of retries.  Useful for calls replayed from a previous
+        run, which have no future."""
+
+        assert path != None
+        assert concurrency > 0
+        assert retries == None or retries >= 0
+        assert backoff >= 0
+
+        self.path = path
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.sync = sync
+        self.call_timeout = call_timeout
+        self.on_error = on_error
+
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+        self._closed = False
+        # id -> _Entry, for every entry not acknowledged
+        self._entries = {}
+        # Entries ready to be delivered, in journal order.
+        self._ready = collections.deque()
+        # ordering key -> the entries waiting for the one being delivered
+        self._lanes = {}
+        self.delivered = 0
+        self.failed = 0
+        self.retried = 0
+
+        entries = _read(path)
+        self._next_id = max([0] + [e.id for e in entries]) + 1
+        # Rewrite the journal with only the entries left to deliver, so
+        # that it doesn't grow forever.
+        self._rewrite(entries)
+        with self._lock:
+            for entry in entries:
+                self._enqueue(entry)
+
+        self._threads = []
+        for i in range(concurrency):
+            t = threading.Thread(target=self._deliver)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def create_bundle(self, name=None, media_url=None, audio_channel=None,
+                      metadata=None, notify_url=None):
+        """Journal a create_bundle() call.  The arguments are those of
+        create_bundle().  Returns a Future resolving with its result."""
+
+        return self.submit(CREATE_BUNDLE, name=name, media_url=media_url,
+                           audio_channel=audio_channel, metadata=metadata,
+                           notify_url=notify_url)
+
+    def create_track(self, href=None, media_url=None, label=None,
+                     audio_channel=None, source=None):
+        """Journal a create_track() call.  The arguments are those of
+        create_track().  Returns a Future resolving with its result."""
+
+        assert href != None
+        assert media_url != None
+
+        return self.submit(CREATE_TRACK, href=href, media_url=media_url,
+                           label=label, audio_channel=audio_channel,
+                           source=source)
+
+    def update_metadata(self, href=None, metadata=None, version=None):
+        """Journal an update_metadata() call.  The arguments are those of
+        update_metadata().  Returns a Future resolving with its
+        result."""
+
+        assert href != None
+        assert metadata != None
+        assert version == None or isinstance(version, int)
+
+        return self.submit(UPDATE_METADATA, href=href, metadata=metadata,
+                           version=version)
+
+    def submit(self, call, **args):
+        """Journal a call.
+
+        'call' CREATE_BUNDLE, CREATE_TRACK or UPDATE_METADATA.
+        'args' the keyword arguments of the call.  They must be
+        convertible to JSON.
+
+        Returns a Future resolving with the result of the call once the
+        API has acknowledged it, or with its exception.
+
+        If the journal is closed, throws an APIConfigurationException.
+        If the journal can't be written, throws an IOError."""
+
+        assert call in _CALLS
+
+        with self._lock:
+            if self._closed:
+                raise op3nvoice.APIConfigurationException(
+                    'The write journal is closed.')
+            entry = _Entry(self._next_id, call, args)
+            entry.future = Future()
+            line = json.dumps({'id': entry.id, 'call': call, 'args': args})
+            self._write(line)
+            self._next_id += 1
+            self._enqueue(entry)
+        return entry.future
+
+    def get_pending_count(self):
+        """Returns the number of calls not yet acknowledged."""
+
+        with self._lock:
+            return len(self._entries)
+
+    def wait(self, timeout=None):
+        """Wait until every call journaled has been delivered or has
+        failed.
+
+        'timeout' the maximum number of seconds to wait.  If None, wait
+        until done.
+
+        Returns True if nothing is left to deliver."""
+
+        end = None
+        if timeout != None:
+            end = time.time() + timeout
+        with self._condition:
+            while len(self._entries) > 0:
+                if end == None:
+                    self._condition.wait()
+                else:
+                    remaining = end - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._condition.wait(remaining)
+            return True
+
+    def close(self, wait=True):
+        """Stop delivering calls and close the journal.
+
+        'wait' whether to wait for the calls in progress.  Calls not
+        delivered stay in the journal."""
+
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        if wait:
+            for t in self._threads:
+                t.join()
+        with self._lock:
+            self._f.close()
+
+    def _enqueue(self, entry):
+        self._entries[entry.id] = entry
+        key = entry.get_key()
+        if key != None:
+            lane = self._lanes.get(key)
+            if lane != None:
+                lane.append(entry)
+                return
+            self._lanes[key] = collections.deque()
+        self._ready.append(entry)
+        self._condition.notify_all()
+
+    def _write(self, line):
+        self._f.write(line + '\n')
+        self._f.flush()
+        if self.sync:
+            os.fsync(self._f.fileno())
+
+    def _rewrite(self, entries):
+        temp_path = self.path + '.tmp'
+        f = open(temp_path, 'wb')
+        try:
+            for entry in entries:
+                f.write(json.dumps({'id': entry.id, 'call': entry.call,
+                                    'args': entry.args}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(temp_path, self.path)
+        self._f = open(self.path, 'ab')
+
+    def _deliver(self):
+        """Runs in the background, delivering entries."""
+
+        while True:
+            with self._condition:
+                while len(self._ready) == 0 and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    return
+                entry = self._ready.popleft()
+
+            outcome = self._call(entry)
+
+            with self._condition:
+                if outcome == _DELIVERED or outcome == _FAILED:
+                    record = {'id': entry.id}
+                    if outcome == _DELIVERED:
+                        record['ack'] = True
+                        self.delivered += 1
+                    else:
+                        record['failed'] = True
+                        self.failed += 1
+                    if not self._f.closed:
+                        self._write(json.dumps(record))
+                # Entries out of retries stay in the file for the next
+                # run.
+                del self._entries[entry.id]
+                key = entry.get_key()
+                if key != None:
+                    lane = self._lanes[key]
+                    if len(lane) > 0:
+                        self._ready.append(lane.popleft())
+                    else:
+                        del self._lanes[key]
+                self._condition.notify_all()
+
+    def _call(self, entry):
+        """Delivers an entry.  Returns _DELIVERED, _FAILED or _RETRY
+        (out of retries)."""
+
+        function = getattr(op3nvoice, entry.call)
+        args = dict((str(k), v) for k, v in entry.args.iteritems())
+        backoff = self.backoff
+        attempt = 0
+        while True:
+            try:
+                result = function(timeout=self.call_timeout, **args)
+            except Exception, e:
+                transient = _is_transient(e)
+                if transient and not self._closed and (
+                    self.retries == None or attempt < self.retries):
+                    with self._condition:
+                        self.retried += 1
+                        # Other notifications wake us early; only close
+                        # cuts the backoff short.
+                        end = time.time() + backoff
+                        while not self._closed and time.time() < end:
+                            self._condition.wait(end - time.time())
+                    backoff = min(backoff * 2, self.max_backoff)
+                    attempt += 1
+                    continue
+                if entry.future != None:
+                    entry.future.set_exception()
+                if self.on_error != None:
+                    self.on_error(entry.call, entry.args, e)
+                if transient:
+                    return _RETRY
+                return _FAILED
+            else:
+                if entry.future != None:
+                    entry.future.set_result(result)
+                return _DELIVERED
+
+_DELIVERED = 'delivered'
+_FAILED = 'failed'
+_RETRY = 'retry'
+
+class _Entry(object):
+    __slots__ = ['id', 'call', 'args', 'future']
+
+    def __init__(self, id, call, args):
+        self.id = id
+        self.call = call
+        self.args = args
+        # None for entries replayed from a previous run.
+        self.future = None
+
+    def get_key(self):
+        name = _CALLS[self.call]
+        if name == None:
+            return None
+        return self.args.get(name)
+
+###
+###  Utility functions.
+###
+
+def _read(path):
+    """Returns the entries of the journal at 'path' that weren't
+    acknowledged or failed, in journal order."""
+
+    entries = collections.OrderedDict()
+    if not os.path.exists(path):
+        return []
+
+    f = open(path, 'rb')
+    try:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A torn last line from an interrupted run.
+                continue
+            if record.has_key('call'):
+                if record['call'] in _CALLS:
+                    entries[record['id']] = _Entry(record['id'],
+                                                   record['call'],
+                                                   record['args'])
+            else:
+                entries.pop(record['id'], None)
+    finally:
+        f.close()
+    return entries.values()
+
+def _is_transient(e):
+    """Returns whether a call failing with 'e' may succeed if repeated."""
+
+    if isinstance(e, op3nvoice.APIException):
+        status = e.get_http_response()
+        return status >= 500 or status in RETRY_STATUSES
+    if isinstance(e, (op3nvoice.APIDataException,
+                      op3nvoice.APIConfigurationException,
+                      AssertionError, TypeError, ValueError)):
+        return False
+    # Network errors, timeouts, open circuit breakers.
+    return True
@@ -0,0 +1,665 @@
+##
+##  This file contains a load generator for the client library, and a
+##  local stand-in for the API to point it at.  A recorded or synthetic
+##  mix of operations is replayed at a target rate or concurrency, and
+##  throughput, latency percentiles, error rate and client CPU per
+##  request are reported for every interval.
+##
+##      python -m op3nvoice_python_2.loadgen --qps 200 --duration 60
+##
+##  or, from python:
+##
+##      server = StandInServer(bundles=500)
+##      server.start()
+##      op3nvoice.set_transport(ConnectionPool(server.get_host(),
+##                                             secure=False))
+##      hrefs = server.get_bundle_hrefs()
+##      generator = LoadGenerator(synthetic_operations(hrefs), qps=200)
+##      report = generator.run()
+##
+
+import os
+import sys
+import json
+import time
+import Queue
+import random
+import urllib
+import urlparse
+import threading
+import collections
+import multiprocessing
+import BaseHTTPServer
+import SocketServer
+import op3nvoice
+
+# The relative weights of the operations in a synthetic mix.
+DEFAULT_MIX = {'get_bundle_list': 25, 'get_bundle': 35, 'search': 15,
+               'get_metadata': 10, 'update_metadata': 10,
+               'create_track': 5}
+
+DEFAULT_CONCURRENCY = 8
+DEFAULT_DURATION = 60.0
+DEFAULT_INTERVAL = 5.0
+
+# The operations that may appear in a trace.
+OPERATIONS = ('get_bundle_list', 'get_bundle', 'search', 'get_metadata',
+              'update_metadata', 'get_track_list', 'create_track',
+              'create_bundle', 'update_bundle', 'delete_bundle')
+
+# This named tuple holds the measurements of one reporting interval,
+# and of the whole run.  Latencies are in seconds, and include the time
+# an operation waited for a free worker after it was due.
+LoadInterval = collections.namedtuple('LoadInterval',
+                                      ['start', 'duration', 'requests',
+                                       'errors', 'throughput', 'error_rate',
+                                       'p50', 'p90', 'p99', 'max',
+                                       'cpu_per_request'])
+
+# This named tuple is returned by LoadGenerator.run().
+LoadReport = collections.namedtuple('LoadReport',
+                                    ['intervals', 'total', 'errors'])
+
+_SEARCH_WORDS = ('news', 'weather', 'sports', 'interview', 'music',
+                 'meeting', 'lecture', 'podcast')
+
+###
+###  Operations.
+###
+
+def synthetic_operations(bundle_hrefs, mix=None, seed=None):
+    """Generates an endless random mix of operations on existing bundles,
+    as (operation name, keyword arguments) tuples.
+
+    'bundle_hrefs' the hrefs of the bundles operated on.  May not be
+    empty.
+    'mix' a dictionary mapping operation names to relative weights.  If
+    None, DEFAULT_MIX is used.
+    'seed' the random seed, for repeatable mixes.  May be None."""
+
+    assert len(bundle_hrefs) > 0
+
+    if mix == None:
+        mix = DEFAULT_MIX
+    rng = random.Random(seed)
+    names = []
+    cumulative = []
+    total = 0
+    for name, weight in sorted(mix.iteritems()):
+        assert name in OPERATIONS
+        total += weight
+        names.append(name)
+        cumulative.append(total)
+
+    while True:
+        pick = rng.uniform(0, total)
+        name = names[-1]
+        for i, bound in enumerate(cumulative):
+            if pick < bound:
+                name = names[i]
+                break
+        href = rng.choice(bundle_hrefs)
+
+        if name == 'get_bundle_list':
+            args = {'limit': 10, 'embed_items': True}
+        elif name == 'search':
+            args = {'query': rng.choice(_SEARCH_WORDS), 'limit': 10,
+                    'embed_items': True}
+        elif name == 'get_bundle':
+            args = {'href': href, 'embed_tracks': True}
+        elif name in ('get_metadata', 'delete_bundle'):
+            args = {'href': href}
+            if name == 'get_metadata':
+                args['href'] = href + '/metadata'
+        elif name == 'update_metadata':
+            args = {'href': href + '/metadata',
+                    'metadata': {'step': rng.randint(0, 1000)}}
+        elif name == 'get_track_list':
+            args = {'href': href + '/tracks'}
+        elif name == 'create_track':
+            args = {'href': href + '/tracks',
+                    'media_url': 'http://example.com/media.mp3'}
+        elif name == 'create_bundle':
+            args = {'name': 'load test',
+                    'media_url': 'http://example.com/media.mp3'}
+        else:
+            args = {'href': href, 'name': 'load test'}
+        yield name, args
+
+def load_trace(path):
+    """Returns the operations recorded in 'path', a file of JSON lines
+    like {"op": "get_bundle", "args": {"href": "/v1/bundles/1"}}."""
+
+    operations = []
+    with open(path, 'rb') as f:
+        for line in f:
+            line = line.strip()
+            if line == '':
+                continue
+            record = json.loads(line)
+            assert record['op'] in OPERATIONS
+            args = dict((str(k), v)
+                        for k, v in record.get('args', {}).iteritems())
+            operations.append((record['op'], args))
+    return operations
+
+###
+###  The load generator.
+###
+
+class LoadGenerator(object):
+    """Replays operations through the op3nvoice functions, so that the
+    whole client stack (transport, pooling, decoding) is measured."""
+
+    def __init__(self, operations, qps=None,
+                 concurrency=DEFAULT_CONCURRENCY, duration=DEFAULT_DURATION,
+                 interval=DEFAULT_INTERVAL, progress=None):
+        """Initializer.
+
+        'operations' an iterable of (operation name, keyword arguments)
+        tuples, e.g. from synthetic_operations() or load_trace().  A
+        list is replayed in a loop until 'duration' is up.
+        'qps' the target number of operations per second.  Operations
+        are started on schedule whether or not earlier ones have
+        finished (open loop).  If None, each worker starts its next
+        operation as soon as the previous one finishes (closed loop).
+        'concurrency' the number of worker threads.
+        'duration' the number of seconds to run for.
+        'interval' the number of seconds per reported interval.
+        'progress' may be None, or a function called with each
+        LoadInterval as it completes."""
+
+        assert qps == None or qps > 0
+        assert concurrency > 0
+        assert duration > 0
+        assert interval > 0
+
+        self.operations = operations
+        self.qps = qps
+        self.concurrency = concurrency
+        self.duration = duration
+        self.interval = interval
+        self.progress = progress
+        self._lock = threading.Lock()
+        self._latencies = []
+        self._errors = 0
+        self._all_latencies = []
+        self._all_errors = collections.Counter()
+
+    def run(self):
+        """Run the load and return a LoadReport: the LoadInterval of
+        each interval, the LoadInterval of the whole run, and a Counter
+        of error messages."""
+
+        operations = self.operations
+        if isinstance(operations, list):
+            operations = _cycle(operations)
+
+        work = Queue.Queue(self.concurrency)
+        workers = [threading.Thread(target=self._work, args=(work,))
+                   for i in range(self.concurrency)]
+        for t in workers:
+            t.daemon = True
+            t.start()
+
+        intervals = []
+        start = time.time()
+        end = start + self.duration
+        cpu = start_cpu = _get_cpu()
+        interval_start = start
+        next_report = start + self.interval
+        due = start
+
+        for operation in operations:
+            now = time.time()
+            if now >= next_report:
+                intervals.append(self._report(interval_start, now, cpu))
+                cpu = _get_cpu()
+                interval_start = now
+                next_report += self.interval
+            if now >= end:
+                break
+            if self.qps != None:
+                due += 1.0 / self.qps
+                if due > now:
+                    time.sleep(due - now)
+                work.put((operation, due))
+            else:
+                work.put((operation, None))
+
+        for t in workers:
+            work.put(None)
+        for t in workers:
+            t.join()
+
+        now = time.time()
+        if now > interval_start:
+            intervals.append(self._report(interval_start, now, cpu))
+        total = _get_interval(start, now - start, self._all_latencies,
+                              sum(i.errors for i in intervals),
+                              _get_cpu() - start_cpu)
+        return LoadReport(intervals=intervals, total=total,
+                          errors=self._all_errors)
+
+    def _work(self, work):
+        while True:
+            item = work.get()
+            if item == None:
+                return
+            (name, args), due = item
+            start = time.time()
+            if due == None:
+                due = start
+            error = None
+            try:
+                getattr(op3nvoice, name)(**args)
+            except Exception, e:
+                error = '%s: %s' % (name, _get_error_message(e))
+            latency = time.time() - due
+            with self._lock:
+                self._latencies.append(latency)
+                if error != None:
+                    self._errors += 1
+                    self._all_errors[error] += 1
+
+    def _report(self, start, end, cpu):
+        with self._lock:
+            latencies = self._latencies
+            errors = self._errors
+            self._latencies = []
+            self._errors = 0
+        self._all_latencies.extend(latencies)
+        interval = _get_interval(start, end - start, latencies, errors,
+                                 _get_cpu() - cpu)
+        if self.progress != None:
+            self.progress(interval)
+        return interval
+
+###
+###  The stand-in server.
+###
+
+class StandInServer(object):
+    """A local, in-memory imitation of the API, good enough to drive the
+    client library under load: bundles, tracks, metadata, paging and a
+    substring search.  It isn't a faithful copy of the API."""
+
+    def __init__(self, host='127.0.0.1', port=0, bundles=100, latency=0,
+                 error_rate=0, seed=None):
+        """Initializer.
+
+        'host', 'port' the address to listen on.  Port 0 picks a free
+        port.
+        'bundles' the number of bundles to start with.
+        'latency' the number of seconds added to every response.
+        'error_rate' the fraction of requests answered with a 503.
+        'seed' the random seed for the initial bundles and the errors."""
+
+        self._address = (host, port)
+        self.latency = latency
+        self.error_rate = error_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._bundles = collections.OrderedDict()
+        self._next_id = 1
+        self._server = None
+        self._thread = None
+        for i in range(bundles):
+            self._create_bundle({'name': '%s %d' % (
+                                     self._rng.choice(_SEARCH_WORDS), i),
+                                 'media_url': 'http://example.com/%d.mp3' % i,
+                                 'metadata': json.dumps({'n': i})})
+
+    def start(self):
+        """Start serving in a background thread."""
+
+        assert self._server == None
+
+        self._server = _Server(self._address, _Handler)
+        self._server.stand_in = self
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._server != None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+
+    def get_host(self):
+        """Returns 'host:port', as expected by ConnectionPool."""
+
+        host, port = self._server.server_address[:2]
+        return '%s:%d' % (host, port)
+
+    def get_bundle_hrefs(self):
+        with self._lock:
+            return [_get_bundle_href(i) for i in self._bundles]
+
+    def handle(self, method, path, query, form):
+        """Returns (status, data)."""
+
+        if self.latency > 0:
+            time.sleep(self.latency)
+        if self.error_rate > 0 and self._rng.random() < self.error_rate:
+            return 503, _get_error(503, 'Service unavailable.')
+
+        parts = path.strip('/').split('/')
+        if len(parts) < 2 or parts[0] != op3nvoice.__api_version__:
+            return 404, _get_error(404, 'Not found.')
+        parts = parts[1:]
+
+        with self._lock:
+            if parts == [op3nvoice.BUNDLES_PATH]:
+                if method == 'GET':
+                    return 200, self._get_page(path, query,
+                                               self._bundles.values())
+                if method == 'POST':
+                    return 201, self._get_bundle(self._create_bundle(form),
+                                                 '')
+            elif parts == [op3nvoice.SEARCH_PATH] and method == 'GET':
+                words = query.get('query', '').lower()
+                bundles = [b for b in self._bundles.itervalues()
+                           if words in b['name'].lower()]
+                return 200, self._get_page(path, query, bundles)
+            elif parts[0] == op3nvoice.BUNDLES_PATH and len(parts) >= 2:
+                return self._handle_bundle(method, parts[1:], query, form)
+        return 405, _get_error(405, 'Method not allowed.')
+
+    def _handle_bundle(self, method, parts, query, form):
+        try:
+            bundle = self._bundles[int(parts[0])]
+        except (ValueError, KeyError):
+            return 404, _get_error(404, 'Bundle not found.')
+
+        if len(parts) == 1:
+            if method == 'GET':
+                return 200, self._get_bundle(bundle, query.get('embed', ''))
+            if method == 'PUT':
+                if 'name' in form:
+                    bundle['name'] = form['name']
+                return 200, self._get_bundle(bundle, '')
+            if method == 'DELETE':
+                del self._bundles[bundle['id']]
+                return 204, None
+        elif parts[1] == 'metadata':
+            metadata = bundle['metadata']
+            if method == 'GET':
+                return 200, self._get_metadata(bundle)
+            if method == 'PUT':
+                version = form.get('version')
+                if version != None and int(version) != metadata['version']:
+                    return 409, _get_error(409, 'Version mismatch.')
+                metadata['data'] = json.loads(form.get('data', 'null'))
+                metadata['version'] += 1
+                return 200, self._get_metadata(bundle)
+            if method == 'DELETE':
+                metadata['data'] = None
+                return 204, None
+        elif parts[1] == 'tracks':
+            if method == 'GET':
+                return 200, {'tracks': bundle['tracks']}
+            if method == 'POST':
+                bundle['tracks'].append(_get_track(len(bundle['tracks']),
+                                                   form))
+                return 201, {'_links': {'self': {'href': bundle['href'] +
+                                                         '/tracks'}}}
+        return 405, _get_error(405, 'Method not allowed.')
+
+    def _create_bundle(self, form):
+        bundle_id = self._next_id
+        self._next_id += 1
+        data = None
+        if form.get('metadata') != None:
+            data = json.loads(form['metadata'])
+        bundle = {'id': bundle_id, 'href': _get_bundle_href(bundle_id),
+                  'name': form.get('name', ''), 'tracks': [],
+                  'metadata': {'version': 1, 'data': data}}
+        if form.get('media_url') != None:
+            bundle['tracks'].append(_get_track(0, form))
+        self._bundles[bundle_id] = bundle
+        return bundle
+
+    def _get_bundle(self, bundle, embed):
+        href = bundle['href']
+        result = {'name': bundle['name'],
+                  '_links': {'self': {'href': href},
+                             'o3v:tracks': {'href': href + '/tracks'},
+                             'o3v:metadata': {'href': href + '/metadata'}}}
+        embedded = {}
+        if 'tracks' in embed:
+            embedded['o3v:tracks'] = {'tracks': bundle['tracks']}
+        if 'metadata' in embed:
+            embedded['o3v:metadata'] = self._get_metadata(bundle)
+        if len(embedded) > 0:
+            result['_embedded'] = embedded
+        return result
+
+    def _get_metadata(self, bundle):
+        metadata = bundle['metadata']
+        return {'version': metadata['version'], 'data': metadata['data'],
+                'created': '2014-05-01T00:00:00Z',
+                'updated': '2014-05-01T00:00:00Z',
+                '_links': {'self': {'href': bundle['href'] + '/metadata'}}}
+
+    def _get_page(self, path, query, bundles):
+        limit = int(query.get('limit', 10))
+        offset = int(query.get('offset', 0))
+        embed = query.get('embed', '')
+        page = bundles[offset:offset + limit]
+
+        links = {'self': {'href': path}}
+        if offset + limit < len(bundles):
+            next_query = dict(query)
+            next_query['offset'] = offset + limit
+            links['next'] = {'href': path + '?' + urllib.urlencode(next_query)}
+        result = {'total': len(bundles), '_links': links}
+        if 'items' in embed:
+            result['_embedded'] = {'items': [self._get_bundle(b, embed)
+                                             for b in page]}
+        else:
+            links['items'] = [{'href': b['href']} for b in page]
+        return result
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    stand_in = None
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Send each response in one write, so that Nagle's algorithm doesn't
+    # hold back the body.
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def _handle(self):
+        length = int(self.headers.getheader('Content-Length') or 0)
+        body = self.rfile.read(length)
+        url = urlparse.urlparse(self.path)
+        query = _parse_form(url.query)
+        form = _parse_form(body)
+
+        status, data = self.server.stand_in.handle(self.command, url.path,
+                                                   query, form)
+        body = ''
+        if data != None:
+            body = json.dumps(data)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/hal+json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _handle
+
+    def log_message(self, format, *args):
+        pass
+
+def serve_in_process(**kwargs):
+    """Start a StandInServer in a child process, so that its CPU isn't
+    counted as the client's.
+
+    'kwargs' passed to StandInServer.
+
+    Returns (process, host, bundle hrefs).  Call process.terminate() to
+    stop it."""
+
+    parent, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=_serve, args=(child, kwargs))
+    process.daemon = True
+    process.start()
+    host, hrefs = parent.recv()
+    return process, host, hrefs
+
+def _serve(connection, kwargs):
+    server = StandInServer(**kwargs)
+    server.start()
+    connection.send((server.get_host(), server.get_bundle_hrefs()))
+    server._thread.join()
+
+###
+###  Command line.
+###
+
+def main(argv=None):
+    """Run a load test from the command line.  Writes one JSON line per
+    interval, then the totals.  Returns the exit status."""
+
+    import argparse
+    from connection import ConnectionPool
+
+    parser = argparse.ArgumentParser(
+        prog='op3nvoice-loadgen',
+        description='Replay API operations against a local stand-in '
+        'server (or a real host) and report latency and throughput.')
+    parser.add_argument('--qps', type=float,
+                        help='the target operations per second (open loop); '
+                        'if omitted, run closed loop')
+    parser.add_argument('-c', '--concurrency', type=int,
+                        default=DEFAULT_CONCURRENCY)
+    parser.add_argument('--duration', type=float, default=DEFAULT_DURATION)
+    parser.add_argument('--interval', type=float, default=DEFAULT_INTERVAL)
+    parser.add_argument('--trace', help='a JSON lines file of operations '
+                        'to replay instead of a synthetic mix')
+    parser.add_argument('--mix', help='the synthetic mix, e.g. '
+                        'get_bundle=40,search=10')
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--host', help='target this host:port instead of '
+                        'a stand-in server')
+    parser.add_argument('--secure', action='store_true',
+                        help='use HTTPS with --host')
+    parser.add_argument('--key', default='loadgen',
+                        help='the API key sent with --host')
+    parser.add_argument('--bundles', type=int, default=100,
+                        help='the number of stand-in bundles')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='the stand-in response delay, in seconds')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='the fraction of stand-in 503 responses')
+    args = parser.parse_args(argv)
+
+    process = None
+    hrefs = []
+    if args.host != None:
+        host = args.host
+    else:
+        process, host, hrefs = serve_in_process(bundles=args.bundles,
+                                                latency=args.latency,
+                                                error_rate=args.error_rate,
+                                                seed=args.seed)
+    op3nvoice.set_key(args.key)
+    op3nvoice.set_transport(ConnectionPool(host, secure=args.secure,
+                                           max_idle=args.concurrency))
+
+    if args.trace != None:
+        operations = load_trace(args.trace)
+    else:
+        if len(hrefs) == 0:
+            page = op3nvoice.get_bundle_list(None, 100)
+            hrefs = [op3nvoice.get_self_href(i)
+                     for i in op3nvoice.get_page_items(page)]
+        mix = None
+        if args.mix != None:
+            mix = dict((name, float(weight)) for name, weight in
+                       (item.split('=') for item in args.mix.split(',')))
+        operations = synthetic_operations(hrefs, mix, args.seed)
+
+    def write(name, interval):
+        data = interval._asdict()
+        data['report'] = name
+        sys.stdout.write(json.dumps(data) + '\n')
+        sys.stdout.flush()
+
+    try:
+        generator = LoadGenerator(operations, args.qps, args.concurrency,
+                                  args.duration, args.interval,
+                                  lambda i: write('interval', i))
+        report = generator.run()
+        write('total', report.total)
+        for error, count in report.errors.most_common(10):
+            sys.stderr.write('%d x %s\n' % (count, error))
+    finally:
+        if process != None:
+            process.terminate()
+    return 0
+
+###
+###  Utility functions.
+###
+
+def _cycle(operations):
+    while True:
+        for operation in operations:
+            yield operation
+
+def _get_cpu():
+    t = os.times()
+    return t[0] + t[1]
+
+def _get_interval(start, duration, latencies, errors, cpu):
+    latencies = sorted(latencies)
+    n = len(latencies)
+
+    def percentile(p):
+        if n == 0:
+            return None
+        return latencies[min(int(n * p / 100.0), n - 1)]
+
+    return LoadInterval(start=start, duration=duration, requests=n,
+                        errors=errors,
+                        throughput=n / duration if duration > 0 else 0,
+                        error_rate=float(errors) / n if n > 0 else 0,
+                        p50=percentile(50), p90=percentile(90),
+                        p99=percentile(99), max=percentile(100),
+                        cpu_per_request=cpu / n if n > 0 else None)
+
+def _get_error_message(e):
+    try:
+        if hasattr(e, 'get_message'):
+            return e.get_message()
+        if hasattr(e, 'get_msg'):
+            return e.get_msg()
+    except Exception:
+        pass
+    return '%s: %s' % (e.__class__.__name__, e)
+
+def _get_bundle_href(bundle_id):
+    return '/%s/%s/%d' % (op3nvoice.__api_version__, op3nvoice.BUNDLES_PATH,
+                          bundle_id)
+
+def _get_track(index, form):
+    return {'track': index, 'status': 'done', 'size': 1000000,
+            'duration': 60.0, 'mime_type': 'audio/mpeg',
+            'label': form.get('label'), 'source': form.get('source'),
+            'media_url': form.get('media_url')}
+
+def _get_error(status, message):
+    return {'status': status, 'code': status, 'message': message}
+
+def _parse_form(s):
+    return dict((k, v[-1]) for k, v in urlparse.parse_qs(s).iteritems())
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,182 @@
+##
+##  This file contains a map/reduce facility covering a whole bundle
+##  collection.  Pages are retrieved over the network in the calling
+##  process, while the CPU-heavy mapper runs in a pool of worker
+##  processes so that it isn't serialized by the GIL.
+##
+
+import Queue
+import threading
+import traceback
+import multiprocessing
+import op3nvoice
+
+DEFAULT_BATCH_SIZE = 50
+
+# How often a wait for mapped batches checks for batches that failed
+# without reaching the callback (e.g. an unpicklable mapper), in seconds.
+_POLL_INTERVAL = 0.1
+
+###
+###  The map/reduce function.
+###
+
+def map_reduce(mapper, reducer, initial=None, query=None, query_field=None,
+               filter=None, limit=None, embed_tracks=None,
+               embed_metadata=None, processes=None,
+               batch_size=DEFAULT_BATCH_SIZE, max_pending=None,
+               timeout=None):
+    """Apply 'mapper' to every bundle and fold the results with 'reducer'.
+
+    'mapper' a function taking one bundle (the embedded bundle data) and
+    returning a value.  It runs in a worker process, so it must be
+    defined at module level in order to be pickled.  May not be None.
+    'reducer' a function taking the accumulated value and one mapped
+    value and returning the new accumulated value.  It runs in the
+    calling process.  May not be None.
+    'initial' the initial accumulated value.
+    'query', 'query_field', 'filter' if 'query' is not None, map over
+    the result of search() instead of the whole bundle list.  See
+    search() for details.
+    'limit' the number of bundles per page.  May be None.
+    'embed_tracks' whether or not to embed the track data in the bundles.
+    'embed_metadata' whether or not to embed the metadata in the bundles.
+    'processes' the number of worker processes.  If None, the number of
+    CPUs is used.
+    'batch_size' the maximum number of bundles sent to a worker at once.
+    'max_pending' the maximum number of batches queued or being mapped
+    at any time.  When reached, page retrieval waits for the workers.
+    If None, twice the number of worker processes is used.
+    'timeout' the number of seconds the page retrieval may take, or a
+    Deadline.  May be None.
+
+    Partial results are reduced as soon as their batch is mapped, in
+    completion order, so 'reducer' should not depend on bundle order.
+
+    Returns the final accumulated value.
+
+    If a page retrieval fails, throws an APIException or an
+    APIDataException.  If the timeout expires, throws a
+    DeadlineExceededException.  If 'mapper' throws, or can't be
+    pickled, throws a MapperException."""
+
+    # Argument error checking.
+    assert mapper != None
+    assert reducer != None
+    assert batch_size > 0
+    assert max_pending == None or max_pending > 0
+
+    if processes == None:
+        processes = multiprocessing.cpu_count()
+    if max_pending == None:
+        max_pending = 2 * processes
+
+    if query != None:
+        pages = op3nvoice.iter_search_pages(None, query, query_field, filter,
+                                            limit, True, embed_tracks,
+                                            embed_metadata, timeout)
+    else:
+        pages = op3nvoice.iter_bundle_list_pages(None, limit, True,
+                                                 embed_tracks,
+                                                 embed_metadata, timeout)
+
+    # Completed batches are handed back to this thread through 'done';
+    # 'slots' bounds the number of batches in flight.
+    # The pool only calls the callback on success, so batches that fail
+    # in the pool itself are found by polling their AsyncResults.
+    done = Queue.Queue()
+    slots = threading.BoundedSemaphore(max_pending)
+    state = {'result': initial, 'in_flight': 0}
+    submitted = []
+
+    def check_failed():
+        for result in submitted:
+            if result.ready() and not result.successful():
+                try:
+                    result.get()
+                except Exception:
+                    raise MapperException(traceback.format_exc())
+        submitted[:] = [r for r in submitted if not r.ready()]
+
+    def reduce_ready(block):
+        while state['in_flight'] > 0:
+            try:
+                if block:
+                    values, error = done.get(True, _POLL_INTERVAL)
+                else:
+                    values, error = done.get(False)
+            except Queue.Empty:
+                check_failed()
+                if not block:
+                    return
+                continue
+            state['in_flight'] -= 1
+            slots.release()
+            if error != None:
+                raise MapperException(error)
+            for value in values:
+                state['result'] = reducer(state['result'], value)
+            block = False
+
+    pool = multiprocessing.Pool(processes)
+
+    try:
+        for batch in _batches(pages, batch_size):
+            # Reduce whatever is finished, then wait for a free slot.
+            reduce_ready(False)
+            while not slots.acquire(False):
+                reduce_ready(True)
+            state['in_flight'] += 1
+            submitted.append(pool.apply_async(_map_batch, (mapper, batch),
+                                              callback=done.put))
+
+        while state['in_flight'] > 0:
+            reduce_ready(True)
+    finally:
+        pool.terminate()
+        pool.join()
+
+    return state['result']
+
+###
+###  Exceptions.
+###
+
+class MapperException(Exception):
+    """Thrown when the mapper fails in a worker process, or can't be
+    sent to one (e.g. a lambda, which can't be pickled)."""
+
+    msg = None
+
+    def __init__(self, msg):
+        self.msg = msg
+
+    def get_message(self):
+        """Returns the formatted traceback of the worker failure."""
+        return self.msg
+
+###
+###  Utility functions.
+###
+
+def _batches(pages, batch_size):
+    """Generates lists of at most 'batch_size' items from 'pages'."""
+
+    batch = []
+    for page in pages:
+        for item in op3nvoice.get_page_items(page):
+            batch.append(item)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+    if len(batch) > 0:
+        yield batch
+
+def _map_batch(mapper, batch):
+    """Runs in a worker process.  Returns (values, None) on success, or
+    (None, formatted traceback) if 'mapper' throws."""
+
+    try:
+        return ([mapper(item) for item in batch], None)
+    except Exception:
+        return (None, traceback.format_exc())
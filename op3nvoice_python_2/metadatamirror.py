@@ -0,0 +1,387 @@
+##
+##  This file contains a local mirror of bundle metadata with secondary
+##  indexes, so that bundles can be filtered on their metadata without
+##  a search round trip or one get_metadata() call per bundle.
+##
+##      mirror = MetadataMirror()
+##      mirror.add_index('show', 'show')
+##      mirror.add_index('episode', 'episode', SORTED)
+##      mirror.add_index('language', 'languages', multi=True)
+##      mirror.load()
+##      hrefs = mirror.find('show', 'Nightly')
+##      hrefs = mirror.find_range('episode', 10, 20)
+##
+
+import json
+import bisect
+import threading
+import op3nvoice
+
+HASH = 'hash'
+SORTED = 'sorted'
+
+_MISSING = object()
+
+###
+###  The mirror.
+###
+
+class MetadataMirror(object):
+    """The metadata of a set of bundles, keyed by bundle href, with
+    user-declared indexes on JSON paths into the metadata.  Thread
+    safe.
+
+    The mirror is kept up to date through load(), refresh() and
+    update(), or by calling put() and remove() with metadata obtained
+    elsewhere (e.g. from notifications).  Every change updates the
+    indexes incrementally."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._indexes = {}
+        # bundle href -> _Entry
+        self._entries = {}
+
+    def add_index(self, name, path, kind=HASH, multi=False):
+        """Declare an index.  Existing metadata is indexed immediately.
+
+        'name' the index name used by find() and find_range().
+        'path' the JSON path of the indexed value: a string of keys
+        separated by dots ('show', 'credits.host') or a list of keys.
+        'kind' HASH for equality lookups, SORTED for equality and range
+        lookups.
+        'multi' if True and the value is a list, the bundle is indexed
+        under each element instead of under the list."""
+
+        assert name != None
+        assert path != None
+        assert kind in (HASH, SORTED)
+
+        if isinstance(path, basestring):
+            path = path.split('.')
+        if kind == HASH:
+            index = _HashIndex(path, multi)
+        else:
+            index = _SortedIndex(path, multi)
+
+        with self._lock:
+            assert name not in self._indexes
+            self._indexes[name] = index
+            for href, entry in self._entries.iteritems():
+                entry.keys[name] = index.add(href, entry.data)
+
+    def put(self, bundle_href, data, version=None):
+        """Set the metadata of a bundle, replacing the previous one.
+
+        'bundle_href' the relative href to the bundle.  May not be None.
+        'data' the metadata (the 'data' of a get_metadata() result).
+        'version' the metadata version, if known.  If it is older than
+        the mirrored version, the call is ignored.
+
+        Returns True if the mirror changed."""
+
+        assert bundle_href != None
+
+        with self._lock:
+            old = self._entries.get(bundle_href)
+            if old != None:
+                if (version != None and old.version != None and
+                    version < old.version):
+                    return False
+                self._unindex(bundle_href, old)
+            entry = _Entry(data, version)
+            for name, index in self._indexes.iteritems():
+                entry.keys[name] = index.add(bundle_href, data)
+            self._entries[bundle_href] = entry
+        return True
+
+    def remove(self, bundle_href):
+        """Drop a bundle from the mirror, e.g. after deleting it."""
+
+        with self._lock:
+            entry = self._entries.pop(bundle_href, None)
+            if entry != None:
+                self._unindex(bundle_href, entry)
+
+    def get(self, bundle_href):
+        """Returns the mirrored metadata of a bundle, or None."""
+
+        with self._lock:
+            entry = self._entries.get(bundle_href)
+        if entry == None:
+            return None
+        return entry.data
+
+    def get_hrefs(self):
+        """Returns the hrefs of every mirrored bundle."""
+
+        with self._lock:
+            return self._entries.keys()
+
+    def find(self, name, value):
+        """Returns the hrefs of the bundles whose indexed value equals
+        'value'.
+
+        'name' the index name.  May not be None."""
+
+        with self._lock:
+            return self._get_index(name).find(value)
+
+    def find_range(self, name, low=None, high=None, include_low=True,
+                   include_high=False):
+        """Returns the hrefs of the bundles whose indexed value is
+        between 'low' and 'high', in ascending value order.
+
+        'name' the name of a SORTED index.  May not be None.
+        'low', 'high' the bounds.  None means unbounded."""
+
+        with self._lock:
+            index = self._get_index(name)
+            assert isinstance(index, _SortedIndex)
+            return index.find_range(low, high, include_low, include_high)
+
+    def load(self, query=None, limit=None, timeout=None):
+        """Mirror the metadata of every bundle, or of the bundles
+        matching a search, reading it embedded in the bundle pages.
+
+        'query' if not None, only mirror the bundles returned by
+        search() for it.
+        'limit' the number of bundles per page.  May be None.
+        'timeout' the number of seconds the load may take, or a
+        Deadline.  May be None.
+
+        Returns the number of bundles mirrored.
+
+        If a page retrieval fails, throws an APIException or an
+        APIDataException."""
+
+        if query != None:
+            pages = op3nvoice.iter_search_pages(None, query, None, None,
+                                                limit, True, None, True,
+                                                timeout)
+        else:
+            pages = op3nvoice.iter_bundle_list_pages(None, limit, True, None,
+                                                     True, timeout)
+        count = 0
+        for page in pages:
+            for bundle in op3nvoice.get_page_items(page):
+                href = op3nvoice.get_self_href(bundle)
+                metadata = _get_bundle_metadata(bundle)
+                if href != None and metadata != None:
+                    self._put_metadata(href, metadata)
+                    count += 1
+        return count
+
+    def refresh(self, href, timeout=None):
+        """Mirror the current metadata of one bundle.
+
+        'href' the relative href to the bundle or to its metadata.
+        'timeout' see get_metadata().
+
+        Returns the metadata.
+
+        If the retrieval fails, throws an APIException or an
+        APIDataException."""
+
+        metadata = op3nvoice.get_metadata(_get_metadata_href(href), timeout)
+        self._put_metadata(_get_bundle_href(href), metadata)
+        return _get_data(metadata)
+
+    def update(self, href, data, version=None, timeout=None):
+        """Call update_metadata() and mirror the new metadata.
+
+        'href' the relative href to the bundle or to its metadata.
+        The other arguments are those of update_metadata().
+
+        Returns the result of update_metadata()."""
+
+        result = op3nvoice.update_metadata(_get_metadata_href(href), data,
+                                           version, timeout)
+        new_version = None
+        if isinstance(result, dict):
+            new_version = result.get('version')
+        self.put(_get_bundle_href(href), data, new_version)
+        return result
+
+    def _put_metadata(self, bundle_href, metadata):
+        self.put(bundle_href, _get_data(metadata), metadata.get('version'))
+
+    def _get_index(self, name):
+        index = self._indexes.get(name)
+        assert index != None, 'Unknown index: %s' % name
+        return index
+
+    def _unindex(self, href, entry):
+        for name, keys in entry.keys.iteritems():
+            self._indexes[name].remove(href, keys)
+
+class _Entry(object):
+    __slots__ = ['data', 'version', 'keys']
+
+    def __init__(self, data, version):
+        self.data = data
+        self.version = version
+        # index name -> the keys the bundle is indexed under
+        self.keys = {}
+
+###
+###  Indexes.
+###
+
+class _Index(object):
+
+    def __init__(self, path, multi):
+        self.path = path
+        self.multi = multi
+
+    def get_keys(self, data):
+        """Returns the keys 'data' is indexed under."""
+
+        value = data
+        for key in self.path:
+            if isinstance(value, dict):
+                value = value.get(key, _MISSING)
+            elif isinstance(value, list) and key.isdigit():
+                i = int(key)
+                value = value[i] if i < len(value) else _MISSING
+            else:
+                value = _MISSING
+            if value is _MISSING:
+                return []
+
+        if self.multi and isinstance(value, list):
+            values = value
+        else:
+            values = [value]
+        keys = []
+        for v in values:
+            v = _get_key(v)
+            if v is not _MISSING and v not in keys:
+                keys.append(v)
+        return keys
+
+    def add(self, href, data):
+        keys = self.get_keys(data)
+        for key in keys:
+            self.insert(key, href)
+        return keys
+
+class _HashIndex(_Index):
+
+    def __init__(self, path, multi):
+        _Index.__init__(self, path, multi)
+        self._hrefs = {}
+
+    def insert(self, key, href):
+        hrefs = self._hrefs.get(key)
+        if hrefs == None:
+            hrefs = self._hrefs[key] = set()
+        hrefs.add(href)
+
+    def remove(self, href, keys):
+        for key in keys:
+            hrefs = self._hrefs.get(key)
+            if hrefs != None:
+                hrefs.discard(href)
+                if len(hrefs) == 0:
+                    del self._hrefs[key]
+
+    def find(self, value):
+        return list(self._hrefs.get(_get_key(value), ()))
+
+class _SortedIndex(_Index):
+
+    def __init__(self, path, multi):
+        _Index.__init__(self, path, multi)
+        # Parallel lists ordered by (key, href).
+        self._keys = []
+        self._hrefs = []
+
+    def insert(self, key, href):
+        lo = bisect.bisect_left(self._keys, key)
+        hi = bisect.bisect_right(self._keys, key, lo)
+        i = bisect.bisect_left(self._hrefs, href, lo, hi)
+        self._keys.insert(i, key)
+        self._hrefs.insert(i, href)
+
+    def remove(self, href, keys):
+        for key in keys:
+            lo = bisect.bisect_left(self._keys, key)
+            hi = bisect.bisect_right(self._keys, key, lo)
+            i = bisect.bisect_left(self._hrefs, href, lo, hi)
+            if i < hi and self._hrefs[i] == href:
+                del self._keys[i]
+                del self._hrefs[i]
+
+    def find(self, value):
+        key = _get_key(value)
+        lo = bisect.bisect_left(self._keys, key)
+        hi = bisect.bisect_right(self._keys, key, lo)
+        return self._hrefs[lo:hi]
+
+    def find_range(self, low, high, include_low, include_high):
+        lo = 0
+        hi = len(self._keys)
+        if low != None:
+            if include_low:
+                lo = bisect.bisect_left(self._keys, low)
+            else:
+                lo = bisect.bisect_right(self._keys, low)
+        if high != None:
+            if include_high:
+                hi = bisect.bisect_right(self._keys, high, lo)
+            else:
+                hi = bisect.bisect_left(self._keys, high, lo)
+        return self._hrefs[lo:max(lo, hi)]
+
+###
+###  Utility functions.
+###
+
+def _get_key(value):
+    """Returns 'value' in a hashable, comparable form, or _MISSING if
+    it can't be indexed."""
+
+    if isinstance(value, list):
+        keys = [_get_key(v) for v in value]
+        if _MISSING in keys:
+            return _MISSING
+        return tuple(keys)
+    if isinstance(value, dict):
+        return _MISSING
+    return value
+
+def _get_data(metadata):
+    """Returns the 'data' of a get_metadata() result, decoding it if the
+    API returned it as a JSON string."""
+
+    data = metadata.get('data')
+    if isinstance(data, basestring):
+        try:
+            data = json.loads(data)
+        except ValueError:
+            pass
+    return data
+
+def _get_bundle_metadata(bundle):
+    """Returns the metadata embedded in a bundle, or None."""
+
+    embedded = bundle.get('_embedded')
+    if isinstance(embedded, dict):
+        for key in ('o3v:metadata', 'metadata'):
+            if isinstance(embedded.get(key), dict):
+                return embedded[key]
+    if isinstance(bundle.get('metadata'), dict):
+        return bundle['metadata']
+    return None
+
+def _get_metadata_href(href):
+    if href.rstrip('/').endswith('/metadata'):
+        return href
+    return href.rstrip('/') + '/metadata'
+
+def _get_bundle_href(href):
+    href = href.rstrip('/')
+    if href.endswith('/metadata'):
+        return href[:-len('/metadata')]
+    return href
@@ -5,29 +5,36 @@
 ##
 
 import sys
+import time
 import urllib
-import httplib
+import threading
 import collections
 import json
 import urlparse
 from __init__ import __version__
 from __init__ import __api_version__
 from __init__ import __api_lib_name__
-from __init__ import __host__
-from __init__ import __debug_level__
+from deadline import Deadline
+from deadline import DeadlineExceededException
+from deadline import get_remaining
 
 BUNDLES_PATH = 'bundles'
 SEARCH_PATH = 'search'
 PYTHON_VERSION = '.'.join(map(str, sys.version_info[:3]))
 
 _key = None
+_transport = None
+_transport_lock = threading.Lock()
+_search_cache = None
+_profiler = None
 
 ###
 ###  The API functions.
 ###
 
 def get_bundle_list(href=None, limit=None, embed_items=None,
-                    embed_tracks=None, embed_metadata=None):
+                    embed_tracks=None, embed_metadata=None, timeout=None,
+                    fields=None):
     """Get a list of available bundles.
 
     'href' the relative href to the bundle list to retriev. If None, the
@@ -39,6 +46,14 @@ def get_bundle_list(href=None, limit=None, embed_items=None,
     the result.
     'embed_metadata' whether or not to expand the bundle metadata into
     the result.
+    'timeout' the number of seconds the call may take, or a Deadline
+    shared with other calls.  May be None.  If it expires, throws a
+    DeadlineExceededException.
+    'fields' may be None, or a list of dotted paths (e.g. ['id', 'name',
+    'tracks.status']) to keep in each embedded bundle; everything else,
+    including '_links', is dropped from the result (see get_bundle()).
+    Lists along a path are traversed.
+    The page's 'next' and 'items' links are always kept.
 
     NB: providing values for 'limit', 'embed_*' will override either the
     API default or the values in the provided href.
@@ -54,26 +69,20 @@ def get_bundle_list(href=None, limit=None, embed_items=None,
     assert limit == None or limit > 0
 
     if href == None:
-        j = _get_first_bundle_list(limit, embed_items, embed_tracks,
-                                   embed_metadata)
+        raw_result = _get_first_bundle_list(limit, embed_items,
+                                            embed_tracks, embed_metadata,
+                                            timeout)
     else:
-        j = _get_additional_bundle_list(href, limit, embed_items,
-                                        embed_tracks, embed_metadata)
+        raw_result = _get_additional_bundle_list(href, limit, embed_items,
+                                                 embed_tracks,
+                                                 embed_metadata, timeout)
 
     # Convert the JSON to a python data struct.
-
-    result = None
-
-    try:
-        result = json.loads(j)
-    except ValueError, e:
-        msg = 'Unable to convert JSON string to python data structure.'
-        raise APIDataException(e, j, msg)
-
-    return result
+    return _decode(raw_result.json, fields, True, raw_result.call)
 
 def _get_first_bundle_list(limit=None, embed_items=None,
-                           embed_tracks=None, embed_metadata=None):
+                           embed_tracks=None, embed_metadata=None,
+                           timeout=None):
     """Get a list of available bundles.
 
     'limit' may be None, which implies API default.  If not None, must be > 1.
@@ -84,7 +93,7 @@ def _get_first_bundle_list(limit=None, embed_items=None,
     Note that including tracks and metadata without including items is
     meaningless.  
     
-    Returns the raw JSON returned by the API.
+    Returns the Result of the GET.
 
     If the response status is not 2xx, throws an APIException."""
 
@@ -104,24 +113,23 @@ def _get_first_bundle_list(limit=None, embed_items=None,
     if len(fields) > 0:
         data = fields
     
-    raw_result = get(path, data)
+    raw_result = get(path, data, timeout)
 
     if raw_result.status < 200 or raw_result.status > 202:
         raise APIException(raw_result.status, raw_result.json)
-    else:
-        result = raw_result.json
 
-    return result
+    return raw_result
 
 def _get_additional_bundle_list(href=None, limit=None, embed_items=None,
-                                embed_tracks=None, embed_metadata=None):
+                                embed_tracks=None, embed_metadata=None,
+                                timeout=None):
     """Get next, previous, first, last list (page) of available bundles.
 
     'href' the href to retrieve the bundles.
 
     All other arguments override arguments in the href.
 
-    Returns the raw JSON returned by the API.
+    Returns the Result of the GET.
 
     If the response status is not 2xx, throws an APIException."""
 
@@ -144,17 +152,15 @@ def _get_additional_bundle_list(href=None, limit=None, embed_items=None,
     if final_embed != None:
         data['embed'] = final_embed
 
-    raw_result = get(path, data)
+    raw_result = get(path, data, timeout)
 
     if raw_result.status < 200 or raw_result.status > 202:
         raise APIException(raw_result.status, raw_result.json)
-    else:
-        result = raw_result.json
 
-    return result
+    return raw_result
 
 def create_bundle(name=None, media_url=None, audio_channel=None,
-                  metadata=None, notify_url=None):
+                  metadata=None, notify_url=None, timeout=None):
                   
     """Create a new bundle. 
 
@@ -164,6 +170,9 @@ def create_bundle(name=None, media_url=None, audio_channel=None,
 
     All other parameters are also optional. For information about these
     see https://api-beta.op3nvoice.com/docs#!/audio/v1audio_post_1.
+    'timeout' the number of seconds the call may take, or a Deadline
+    shared with other calls.  May be None.  If it expires, throws a
+    DeadlineExceededException.
 
     Returns a data structure equivalent to the JSON returned by the API.
     This data structure can be used to instantiate a BundleReference.
@@ -192,27 +201,21 @@ def create_bundle(name=None, media_url=None, audio_channel=None,
     if len(fields) > 0:
         data = fields
 
-    raw_result = post(path, data)
+    raw_result = post(path, data, timeout)
 
     if raw_result.status < 200 or raw_result.status > 202:
         raise APIException(raw_result.status, raw_result.json)
 
     # Convert the JSON to a python data struct.
-
-    result = None
-
-    try:
-        result = json.loads(raw_result.json)
-    except ValueError, e:
-        msg = 'Unable to convert JSON string to python data structure.'
-        raise APIDataException(e, raw_result.json, msg)
-
-    return result
+    return _decode(raw_result.json, call=raw_result.call)
     
-def delete_bundle(href=None):
+def delete_bundle(href=None, timeout=None):
     """Delete a bundle.
 
     'href' the relative href to the bundle. May not be None.
+    'timeout' the number of seconds the call may take, or a Deadline
+    shared with other calls.  May be None.  If it expires, throws a
+    DeadlineExceededException.
 
     Returns nothing.
 
@@ -221,12 +224,13 @@ def delete_bundle(href=None):
     # Argument error checking.
     assert href != None
 
-    raw_result = delete(href)
+    raw_result = delete(href, None, timeout)
 
     if raw_result.status != 204:
         raise APIException(raw_result.status, raw_result.json)
 
-def get_bundle(href=None, embed_tracks=False, embed_metadata=False):
+def get_bundle(href=None, embed_tracks=False, embed_metadata=False,
+               timeout=None, fields=None):
     """Get a bundle.
 
     'href' the relative href to the bundle. May not be None.
@@ -234,6 +238,15 @@ def get_bundle(href=None, embed_tracks=False, embed_metadata=False):
     information in the response.
     'embed_metadata' determines whether or not to include metadata
     information in the response.
+    'timeout' the number of seconds the call may take, or a Deadline
+    shared with other calls.  May be None.  If it expires, throws a
+    DeadlineExceededException.
+    'fields' may be None, or a list of dotted paths (e.g. ['id', 'name',
+    'tracks.status']) to keep in the bundle; everything else,
+    including '_links', is dropped from the result.  Lists along a path
+    are traversed.  The response is decoded in full first, so this
+    shrinks the memory the result holds, not the decoding time or its
+    peak memory.
 
     Returns a data structure equivalent to the JSON returned by the API.
     This data structure can be used to instantiate a Bundle.
@@ -246,34 +259,26 @@ def get_bundle(href=None, embed_tracks=False, embed_metadata=False):
     assert href != None
 
     data = None
-    fields = {}
+    params = {}
     embed = process_embed(embed_items=False,
                           embed_tracks=embed_tracks,
                           embed_metadata=embed_metadata)
     if embed != None:
-        fields['embed'] = embed
+        params['embed'] = embed
 
-    if len(fields) > 0:
-        data = fields
+    if len(params) > 0:
+        data = params
 
-    raw_result = get(href, data)
+    raw_result = get(href, data, timeout)
 
     if raw_result.status < 200 or raw_result.status > 202:
         raise APIException(raw_result.status, raw_result.json)
 
     # Convert the JSON to a python data struct.
+    return _decode(raw_result.json, fields, call=raw_result.call)
 
-    result = None
-
-    try:
-        result = json.loads(raw_result.json)
-    except ValueError, e:
-        msg = 'Unable to convert JSON string to python data structure.'
-        raise APIDataException(e, raw_result.json, msg)
-
-    return result
-
-def update_bundle(href=None, name=None, notify_url=None, version=None):
+def update_bundle(href=None, name=None, notify_url=None, version=None,
+                  timeout=None):
     """Update a bundle.  Note that only the 'name' and 'notify_url' can
     be update.
 
@@ -283,6 +288,9 @@ def update_bundle(href=None, name=None, notify_url=None, version=None):
     'version' the object version.  May be None; if not None, must be
     an integer, and the version must match the version of the bundle.  If
     not, a 409 conflict error will cause an APIException to be thrown.
+    'timeout' the number of seconds the call may take, or a Deadline
+    shared with other calls.  May be None.  If it expires, throws a
+    DeadlineExceededException.
 
     Returns a data structure equivalent to the JSON returned by the API.
     This data structure can be used to instantiate a Reference.
@@ -310,27 +318,21 @@ def update_bundle(href=None, name=None, notify_url=None, version=None):
     if len(fields) > 0:
         data = fields
 
-    raw_result = put(href, data)
+    raw_result = put(href, data, timeout)
 
     if raw_result.status < 200 or raw_result.status > 202:
         raise APIException(raw_result.status, raw_result.json)
 
     # Convert the JSON to a python data struct.
+    return _decode(raw_result.json, call=raw_result.call)
 
-    result = None
-
-    try:
-        result = json.loads(raw_result.json)
-    except ValueError, e:
-        msg = 'Unable to convert JSON string to python data structure.'
-        raise APIDataException(e, raw_result.json, msg)
-
-    return result
-
-def get_metadata(href=None):
+def get_metadata(href=None, timeout=None):
     """Get metadata.
 
     'href' the relative href to the bundle. May not be None.
+    'timeout' the number of seconds the call may take, or a Deadline
+    shared with other calls.  May be None.  If it expires, throws a
+    DeadlineExceededException.
 
     Returns a data structure equivalent to the JSON returned by the API.
     This data structure can be used to instantiate a Metadata.
@@ -342,24 +344,15 @@ def get_metadata(href=None):
     # Argument error checking.
     assert href != None
 
-    raw_result = get(href)
+    raw_result = get(href, None, timeout)
 
     if raw_result.status < 200 or raw_result.status > 202:
         raise APIException(raw_result.status, raw_result.json)
 
     # Convert the JSON to a python data struct.
+    return _decode(raw_result.json, call=raw_result.call)
 
-    result = None
-
-    try:
-        result = json.loads(raw_result.json)
-    except ValueError, e:
-        msg = 'Unable to convert JSON string to python data structure.'
-        raise APIDataException(e, raw_result.json, msg)
-
-    return result
-
-def update_metadata(href=None, metadata=None, version=None):
+def update_metadata(href=None, metadata=None, version=None, timeout=None):
     """Update the metadata in a bundle.
     be update.
 
@@ -370,6 +363,9 @@ def update_metadata(href=None, metadata=None, version=None):
     'version' the object version.  May be None; if not None, must be
     an integer, and the version must match the version of the bundle.  If
     not, a 409 conflict error will cause an APIException to be thrown.
+    'timeout' the number of seconds the call may take, or a Deadline
+    shared with other calls.  May be None.  If it expires, throws a
+    DeadlineExceededException.
     
     Returns a data structure equivalent to the JSON returned by the API.
     This data structure can be used to instantiate a Reference.
@@ -393,27 +389,21 @@ def update_metadata(href=None, metadata=None, version=None):
 
     data = fields 
 
-    raw_result = put(href, data)
+    raw_result = put(href, data, timeout)
 
     if raw_result.status < 200 or raw_result.status > 202:
         raise APIException(raw_result.status, raw_result.json)
 
     # Convert the JSON to a python data struct.
-
-    result = None
-
-    try:
-        result = json.loads(raw_result.json)
-    except ValueError, e:
-        msg = 'Unable to convert JSON string to python data structure.'
-        raise APIDataException(e, raw_result.json, msg)
-
-    return result
+    return _decode(raw_result.json, call=raw_result.call)
     
-def delete_metadata(href=None):
+def delete_metadata(href=None, timeout=None):
     """Delete metadata.
 
     'href' the relative href to the bundle. May not be None.
+    'timeout' the number of seconds the call may take, or a Deadline
+    shared with other calls.  May be None.  If it expires, throws a
+    DeadlineExceededException.
 
     Returns nothing.
 
@@ -422,13 +412,13 @@ def delete_metadata(href=None):
     # Argument error checking.
     assert href != None
 
-    raw_result = delete(href)
+    raw_result = delete(href, None, timeout)
 
     if raw_result.status != 204:
         raise APIException(raw_result.status, raw_result.json)
 
 def create_track(href=None, media_url=None, label=None,
-                 audio_channel=None, source=None):
+                 audio_channel=None, source=None, timeout=None):
     """Add a new track to a bundle.  Note that the total number of
     allowable tracks is limited. See the API documentation for details.
 
@@ -439,6 +429,9 @@ def create_track(href=None, media_url=None, label=None,
     None. For details see the API documentation.
     'source' the source of the recording. May be None. For details see
     the API documentation.
+    'timeout' the number of seconds the call may take, or a Deadline
+    shared with other calls.  May be None.  If it expires, throws a
+    DeadlineExceededException.
 
     Returns a data structure equivalent to the JSON returned by the API.
     This data structure can be used to instantiate a Reference.
@@ -466,25 +459,17 @@ def create_track(href=None, media_url=None, label=None,
     if len(fields) > 0:
         data = fields
 
-    raw_result = post(href, data)
+    raw_result = post(href, data, timeout)
 
     if raw_result.status < 200 or raw_result.status > 202:
         raise APIException(raw_result.status, raw_result.json)
 
     # Convert the JSON to a python data struct.
-
-    result = None
-
-    try:
-        result = json.loads(raw_result.json)
-    except ValueError, e:
-        msg = 'Unable to convert JSON string to python data structure.'
-        raise APIDataException(e, raw_result.json, msg)
-
-    return result
+    return _decode(raw_result.json, call=raw_result.call)
         
 def update_track(href=None, track=None, media_url=None, label=None,
-                 audio_channel=None, source=None, version=None):
+                 audio_channel=None, source=None, version=None,
+                 timeout=None):
     """Add a new track to a bundle.  Note that the total number of
     allowable tracks is limited. See the API documentation for details.
 
@@ -499,6 +484,9 @@ def update_track(href=None, track=None, media_url=None, label=None,
     'version' the object version.  May be None; if not None, must be
     an integer, and the version must match the version of the bundle.  If
     not, a 409 conflict error will cause an APIException to be thrown.
+    'timeout' the number of seconds the call may take, or a Deadline
+    shared with other calls.  May be None.  If it expires, throws a
+    DeadlineExceededException.
 
     Returns a data structure equivalent to the JSON returned by the API.
     This data structure can be used to instantiate a Reference.
@@ -531,27 +519,21 @@ def update_track(href=None, track=None, media_url=None, label=None,
     if len(fields) > 0:
         data = fields
 
-    raw_result = put(href, data)
+    raw_result = put(href, data, timeout)
 
     if raw_result.status < 200 or raw_result.status > 202:
         raise APIException(raw_result.status, raw_result.json)
 
     # Convert the JSON to a python data struct.
+    return _decode(raw_result.json, call=raw_result.call)
 
-    result = None
-
-    try:
-        result = json.loads(raw_result.json)
-    except ValueError, e:
-        msg = 'Unable to convert JSON string to python data structure.'
-        raise APIDataException(e, raw_result.json, msg)
-
-    return result
-
-def get_track_list(href=None):
+def get_track_list(href=None, timeout=None):
     """Get track list.
 
     'href' the relative href to the bundle. May not be None.
+    'timeout' the number of seconds the call may take, or a Deadline
+    shared with other calls.  May be None.  If it expires, throws a
+    DeadlineExceededException.
 
     Returns a data structure equivalent to the JSON returned by the API.
     This data structure can be used to instantiate a TrackList.
@@ -563,29 +545,23 @@ def get_track_list(href=None):
     # Argument error checking.
     assert href != None
 
-    raw_result = get(href)
+    raw_result = get(href, None, timeout)
 
     if raw_result.status < 200 or raw_result.status > 202:
         raise APIException(raw_result.status, raw_result.json)
 
     # Convert the JSON to a python data struct.
+    return _decode(raw_result.json, call=raw_result.call)
 
-    result = None
-
-    try:
-        result = json.loads(raw_result.json)
-    except ValueError, e:
-        msg = 'Unable to convert JSON string to python data structure.'
-        raise APIDataException(e, raw_result.json, msg)
-
-    return result
-
-def delete_track(href=None, track=None):
+def delete_track(href=None, track=None, timeout=None):
     """Delete a track, or all the tracks.
 
     'href' the relative href to the bundle. May not be None.
     'track' the index of the track to delete. If none is given,
     all tracks are deleted.
+    'timeout' the number of seconds the call may take, or a Deadline
+    shared with other calls.  May be None.  If it expires, throws a
+    DeadlineExceededException.
     
     Returns nothing.
 
@@ -604,14 +580,14 @@ def delete_track(href=None, track=None):
     if len(fields) > 0:
         data = fields
 
-    raw_result = delete(href, data)
+    raw_result = delete(href, data, timeout)
 
     if raw_result.status != 204:
         raise APIException(raw_result.status, raw_result.json)
 
 def search(href=None, query=None, query_field=None, filter=None,
            limit=None, embed_items=None, embed_tracks=None,
-           embed_metadata=None):
+           embed_metadata=None, timeout=None, fields=None):
            
     """Search a media collection.
 
@@ -627,10 +603,21 @@ def search(href=None, query=None, query_field=None, filter=None,
     the result.
     'embed_metadata' whether or not to expand the bundle metadata into
     the result.
+    'timeout' the number of seconds the call may take, or a Deadline
+    shared with other calls.  May be None.  If it expires, throws a
+    DeadlineExceededException.
+    'fields' may be None, or a list of dotted paths (e.g. ['id', 'name',
+    'tracks.status']) to keep in each embedded bundle; everything else,
+    including '_links', is dropped from the result (see get_bundle()).
+    Lists along a path are traversed.
+    The page's 'next' and 'items' links are always kept.
 
     NB: providing values for 'limit', 'embed_*' will override either the
     API default or the values in the provided href.
 
+    If enable_search_cache() was called, the page may come from the
+    cache.
+
     Returns a data structure equivalent to the JSON returned by the API.
     This data structure can be used to instantiate a SearchCollection.
 
@@ -643,29 +630,21 @@ def search(href=None, query=None, query_field=None, filter=None,
     assert limit == None or limit > 0
     
     if href == None:
-        j = _search_p1(query, query_field, filter, limit, embed_items,
-                       embed_tracks, embed_metadata)
+        j, call = _search_p1(query, query_field, filter, limit, embed_items,
+                             embed_tracks, embed_metadata, timeout)
                                    
     else:
-        j = _search_pn(href, query, query_field, filter, limit,
-                       embed_items, embed_tracks, embed_metadata)
+        j, call = _search_pn(href, query, query_field, filter, limit,
+                             embed_items, embed_tracks, embed_metadata,
+                             timeout)
                                         
 
     # Convert the JSON to a python data struct.
-
-    result = None
-
-    try:
-        result = json.loads(j)
-    except ValueError, e:
-        msg = 'Unable to convert JSON string to python data structure.'
-        raise APIDataException(e, j, msg)
-
-    return result
+    return _decode(j, fields, True, call)
 
 def _search_p1(query=None, query_field=None, filter=None, limit=None,
                embed_items=None, embed_tracks=None,
-               embed_metadata=None):
+               embed_metadata=None, timeout=None):
     # Prepare the data we're going to include in our query.
     path = '/' + __api_version__ + '/' + SEARCH_PATH
     
@@ -687,18 +666,11 @@ def _search_p1(query=None, query_field=None, filter=None, limit=None,
     if len(fields) > 0:
         data = fields
     
-    raw_result = get(path, data)
-
-    if raw_result.status < 200 or raw_result.status > 202:
-        raise APIException(raw_result.status, raw_result.json)
-    else:
-        result = raw_result.json
-
-    return result
+    return _search_get(path, data, timeout)
 
 def _search_pn(href=None, query=None, query_field=None, filter=None,
                limit=None, embed_items=None, embed_tracks=None,
-               embed_metadata=None):
+               embed_metadata=None, timeout=None):
     url_components = urlparse.urlparse(href)
     path = url_components.path
     data = urlparse.parse_qs(url_components.query)
@@ -719,14 +691,37 @@ def _search_pn(href=None, query=None, query_field=None, filter=None,
     if final_embed != None:
         data['embed'] = final_embed
 
-    raw_result = get(path, data)
+    return _search_get(path, data, timeout)
+
+def _search_get(path, data, timeout):
+    """Returns (json, call).  'call' is the profiled call of the GET, or
+    None if the page came from the cache."""
+
+    cache = _search_cache
+    if cache == None:
+        raw_result = _search_fetch(path, data, timeout)
+        return raw_result.json, raw_result.call
+
+    fetched = []
+    def fetch(t):
+        raw_result = _search_fetch(path, data, t)
+        fetched.append(raw_result)
+        return raw_result.json
+
+    j = cache.get(cache.get_key(path, data), fetch, timeout)
+    # A background revalidation may fetch while a stale page is served.
+    for raw_result in fetched:
+        if raw_result.json is j:
+            return j, raw_result.call
+    return j, None
+
+def _search_fetch(path, data, timeout):
+    raw_result = get(path, data, timeout)
 
     if raw_result.status < 200 or raw_result.status > 202:
         raise APIException(raw_result.status, raw_result.json)
-    else:
-        result = raw_result.json
 
-    return result
+    return raw_result
 
 ###
 ### Functions to set the API key and perform basic HTTP operations.
@@ -735,13 +730,155 @@ def _search_pn(href=None, query=None, query_field=None, filter=None,
 
 # This named tuple is returned by get(), put(), post(), delete()
 # functions and consumed by the REST cover functions.
-Result = collections.namedtuple('Result', ['status', 'json'])
+class Result(collections.namedtuple('Result', ['status', 'json'])):
+
+    # The profiled call of the request, or None.  Passed to _decode() so
+    # that the decode is attributed to it.  Not part of the tuple, so
+    # that (status, json) unpacking keeps working.
+    call = None
 
 def set_key(key):
     """The API key.  May not be None."""
     global _key
     assert key != None
     _key = key
+    # Another key may see another account.
+    if _search_cache != None:
+        _search_cache.invalidate()
+
+def set_transport(transport):
+    """Replace the transport executing get(), post(), put() and delete().
+
+    'transport' a Transport: a ConnectionPool (the default), an
+    HTTP2ConnectionPool, a MemoryTransport, a CassetteTransport...  May
+    not be None.  The previous transport is closed."""
+    global _transport
+    assert transport != None
+    with _transport_lock:
+        old = _transport
+        _transport = transport
+    if old != None and old is not transport:
+        old.close()
+
+def get_transport():
+    """Returns the transport executing get(), post(), put() and
+    delete()."""
+    return _get_transport()
+
+def use_http2(connections=None, max_streams=None, host=None, secure=True):
+    """Multiplex the API calls over HTTP/2 connections, falling back to
+    HTTP/1.1 when the server doesn't negotiate HTTP/2.
+
+    'connections' the maximum number of connections.  If None, the
+    HTTP2ConnectionPool default is used.
+    'max_streams' the maximum number of concurrent requests per
+    connection.  If None, the HTTP2ConnectionPool default is used.
+    'host' the host (and optional ':port') to connect to.  If None, the
+    API host is used.
+    'secure' whether to use TLS.
+
+    HTTP/2 requires the hyper package; see HTTP2ConnectionPool."""
+    import http2
+    kwargs = {'secure': secure}
+    if host != None:
+        kwargs['host'] = host
+    if connections != None:
+        kwargs['connections'] = connections
+    if max_streams != None:
+        kwargs['max_streams'] = max_streams
+    set_transport(http2.HTTP2ConnectionPool(**kwargs))
+
+def enable_search_cache(ttl=None, max_entries=None, max_bytes=None,
+                        stale_ttl=0):
+    """Cache the pages returned by search(), so that repeated queries
+    don't reach the API.
+
+    'ttl' the number of seconds a page is served from the cache.  If
+    None, the SearchCache default is used.
+    'max_entries' the maximum number of pages cached.  If None, the
+    SearchCache default is used.
+    'max_bytes' the approximate maximum memory used by the cached
+    pages.  If None, the SearchCache default is used.
+    'stale_ttl' the number of seconds after 'ttl' during which a stale
+    page is returned while a fresh one is retrieved in the background.
+
+    Returns the SearchCache, e.g. to call get_stats() or invalidate()."""
+    global _search_cache
+    import searchcache
+    kwargs = {'stale_ttl': stale_ttl}
+    if ttl != None:
+        kwargs['ttl'] = ttl
+    if max_entries != None:
+        kwargs['max_entries'] = max_entries
+    if max_bytes != None:
+        kwargs['max_bytes'] = max_bytes
+    _search_cache = searchcache.SearchCache(**kwargs)
+    return _search_cache
+
+def disable_search_cache():
+    """Stop caching search() pages and drop the cached ones."""
+    global _search_cache
+    _search_cache = None
+
+def enable_profiling(max_calls=None):
+    """Record the phases (DNS, connect, TLS, send, wait, transfer,
+    decode) of every API call, aggregated by endpoint.
+
+    'max_calls' the number of most recent calls kept for Chrome traces.
+    If None, the Profiler default is used.
+
+    Returns the Profiler, e.g. to call get_stats(),
+    write_chrome_trace() or write_folded()."""
+    global _profiler
+    import profiler
+    if max_calls == None:
+        _profiler = profiler.Profiler()
+    else:
+        _profiler = profiler.Profiler(max_calls)
+    return _profiler
+
+def disable_profiling():
+    """Stop recording the phases of API calls."""
+    global _profiler
+    _profiler = None
+
+def prewarm(n):
+    """Open and handshake 'n' connections to the API host in parallel,
+    so that the first API calls don't pay for connection set up.
+
+    Returns the number of connections opened."""
+    return _get_transport().prewarm(n)
+
+def _get_transport():
+    global _transport
+    if _transport == None:
+        # Imported here so that loading this module doesn't pay for ssl.
+        from connection import ConnectionPool
+        with _transport_lock:
+            if _transport == None:
+                _transport = ConnectionPool()
+    return _transport
+
+def _request(method, path, body, timeout):
+    """Returns a Result from the transport, profiling the request if
+    enable_profiling() was called."""
+
+    remaining = get_remaining(Deadline.get(timeout))
+    headers = _get_headers()
+    profiler = _profiler
+    if profiler == None:
+        s, j = _get_transport().request(method, path, body, headers,
+                                        remaining)
+        return Result(status=s, json=j)
+    call = profiler.begin(method, path)
+    try:
+        s, j = _get_transport().request(method, path, body, headers,
+                                        remaining)
+    finally:
+        profiler.end(call)
+    result = Result(status=s, json=j)
+    result.call = call
+    return result
 
 def _get_headers():
     # So that we can track what library and what version of the
@@ -758,7 +895,7 @@ def _get_headers():
             'User-Agent': user_agent,
             'Content-Type': 'application/x-www-form-urlencoded'}
 
-def get(path, data=None):
+def get(path, data=None, timeout=None):
     """Executes a GET.
 
     'path' may not be None. Should include the full path to the resource.
@@ -770,34 +907,22 @@ def get(path, data=None):
     status: the HTTP status code
     json: the returned JSON-HAL
 
-    If the key was not set, throws an APIConfigurationException."""
+    'timeout' the number of seconds the request may take, covering
+    connect, TLS, send and read, or a Deadline.  May be None.
+
+    If the key was not set, throws an APIConfigurationException.
+    If the timeout expires, throws a DeadlineExceededException."""
 
     # Argument error checking.
     assert path != None
         
-    # Open our connection.
-    connection = httplib.HTTPSConnection(__host__)
-    if __debug_level__ > 0:
-        connection.set_debuglevel(__debug_level__)
-
-    # Execute the request.
+    # Execute the request within the time remaining.
     fullpath = path
     if data != None:
         fullpath += '?' + urllib.urlencode(data, True)
-    connection.request('GET', fullpath, '', _get_headers())
-    response = connection.getresponse()
-
-    # Extreact the result.
-    s = response.status
-    j = response.read()
-
-    # Close our connection.
-    connection.close()
-
-    # return (status, json)
-    return Result(status=s, json=j)
+    return _request('GET', fullpath, '', timeout)
 
-def post(path, data):
+def post(path, data, timeout=None):
     """Executes a POST.
 
     'path' may not be None, should not inlude a version number, and
@@ -809,35 +934,23 @@ def post(path, data):
     status: the HTTP status code
     json: the returned JSON-HAL
     
-    If the key was not set, throws an APIConfigurationException."""
+    'timeout' the number of seconds the request may take, covering
+    connect, TLS, send and read, or a Deadline.  May be None.
+
+    If the key was not set, throws an APIConfigurationException.
+    If the timeout expires, throws a DeadlineExceededException."""
 
     # Argument error checking.
     assert path != None
     assert data == None or isinstance(data, dict)
         
-    # Open our connection.
-    connection = httplib.HTTPSConnection(__host__)
-    if __debug_level__ > 0:
-        connection.set_debuglevel(__debug_level__)
-
-    # Execute the request.
+    # Execute the request within the time remaining.
     encoded_data = ''
     if data != None:
         encoded_data = urllib.urlencode(data, True)
-    connection.request('POST', path, encoded_data, _get_headers())
-    response = connection.getresponse()
-
-    # Extract the result.
-    s = response.status
-    j = response.read()
-
-    # Close our connection.
-    connection.close()
-
-    # return (status, json)
-    return Result(status=s, json=j)
+    return _request('POST', path, encoded_data, timeout)
 
-def delete(path, data=None):
+def delete(path, data=None, timeout=None):
     """Executes a DELETE.
 
     'path' may not be None. Should include the full path to the resoure.
@@ -848,35 +961,23 @@ def delete(path, data=None):
     status: the HTTP status code
     json: the returned JSON-HAL
 
-    If the key was not set, throws an APIConfigurationException."""    
+    'timeout' the number of seconds the request may take, covering
+    connect, TLS, send and read, or a Deadline.  May be None.
+
+    If the key was not set, throws an APIConfigurationException.
+    If the timeout expires, throws a DeadlineExceededException."""    
 
     # Argument error checking.
     assert path != None
     assert data == None or isinstance(data, dict)
 
-    # Open our connection.
-    connection = httplib.HTTPSConnection(__host__)
-    if __debug_level__ > 0:
-        connection.set_debuglevel(__debug_level__)
-
-    # Execute the request.
+    # Execute the request within the time remaining.
     encoded_data = ''
     if data != None:
         encoded_data = urllib.urlencode(data, True)
-    connection.request('DELETE', path, encoded_data, _get_headers())
-    response = connection.getresponse()
-
-    # Extract the result.
-    s = response.status
-    j = response.read()
-
-    # Close our connection.
-    connection.close()
-
-    # return (status, json)
-    return Result(status=s, json=j)
+    return _request('DELETE', path, encoded_data, timeout)
         
-def put(path, data):
+def put(path, data, timeout=None):
     """Executes a PUT.
 
     'path' may not be None. Should include the full path to the resoure.
@@ -887,32 +988,21 @@ def put(path, data):
     status: the HTTP status code
     json: the returned JSON-HAL
 
-    If the key was not set, throws an APIConfigurationException."""
+    'timeout' the number of seconds the request may take, covering
+    connect, TLS, send and read, or a Deadline.  May be None.
+
+    If the key was not set, throws an APIConfigurationException.
+    If the timeout expires, throws a DeadlineExceededException."""
 
     # Argument error checking.
     assert path != None
     assert data == None or isinstance(data, dict)
         
-    # Open our connection.
-    connection = httplib.HTTPSConnection(__host__)
-    if __debug_level__ > 0:
-        connection.set_debuglevel(__debug_level__)
-
-    # Execute the request.
+    # Execute the request within the time remaining.
     encoded_data = ''
     if data != None:
         encoded_data = urllib.urlencode(data, True)
-    connection.request('PUT', path, encoded_data, _get_headers())
-    response = connection.getresponse()
-
-    # Extract the result.
-    s = response.status
-    j = response.read()
-
-    # Close our connection.
-    connection.close()
-
-    return Result(status=s, json=j)
+    return _request('PUT', path, encoded_data, timeout)
 
 ###
 ###  Exceptions.
@@ -1079,7 +1169,191 @@ def process_embed_override(href_embed=None,
         else:
             final_metadata = None
 
-    return process_embed(embed_items=final_items, 
+    return process_embed(embed_items=final_items,
                          embed_tracks=final_tracks,
                          embed_metadata=final_metadata)
 
+def _decode(j, fields=None, page=False, call=None):
+    """Returns the python data structure of the JSON string 'j',
+    projected onto 'fields' (see get_bundle()) unless None.  If 'page'
+    is true, the projection applies to the page's embedded items.  If
+    'call' is not None, the decode is profiled as part of it.
+
+    If the conversion fails, throws an APIDataException."""
+
+    if call != None:
+        start = time.time()
+
+    try:
+        result = json.loads(j)
+    except ValueError, e:
+        msg = 'Unable to convert JSON string to python data structure.'
+        raise APIDataException(e, j, msg)
+
+    if call != None:
+        call.add_phase('decode', start, time.time())
+
+    if fields == None:
+        return result
+
+    projection = _get_projection(fields)
+    if not page:
+        return _project(result, projection)
+
+    # Keep what pagination needs, project the items.
+    projected = {}
+    for key, value in result.iteritems():
+        if key == '_links' and isinstance(value, dict):
+            links = {}
+            for rel in _PAGE_LINKS:
+                if rel in value:
+                    links[rel] = value[rel]
+            projected[key] = links
+        elif key == '_embedded' and isinstance(value, dict):
+            if 'items' in value:
+                projected[key] = {'items': _project(value['items'],
+                                                    projection)}
+        elif not isinstance(value, (dict, list)):
+            projected[key] = value
+    return projected
+
+# The page links kept by a projection.
+_PAGE_LINKS = ('next', 'items')
+
+# The number of compiled projections cached.
+_MAX_PROJECTIONS = 32
+
+# frozenset of fields -> compiled projection, least recently used first.
+_projections = collections.OrderedDict()
+_projections_lock = threading.Lock()
+
+def _get_projection(fields):
+    """Returns 'fields' compiled into a tree of dictionaries, where
+    True marks a kept subtree.  The most recently used trees are cached,
+    and their keys are the ones used in the projected documents, so
+    every document shares the same key objects."""
+
+    if isinstance(fields, basestring):
+        fields = fields.split(',')
+    fields = frozenset(field.strip() for field in fields)
+    with _projections_lock:
+        projection = _projections.pop(fields, None)
+        if projection != None:
+            _projections[fields] = projection
+            return projection
+
+    projection = {}
+    for field in fields:
+        keys = [intern(str(key)) for key in field.strip().split('.')]
+        node = projection
+        for key in keys[:-1]:
+            child = node.get(key)
+            if child == True:
+                break
+            if child == None:
+                child = node[key] = {}
+            node = child
+        else:
+            node[keys[-1]] = True
+
+    with _projections_lock:
+        _projections[fields] = projection
+        if len(_projections) > _MAX_PROJECTIONS:
+            _projections.popitem(False)
+    return projection
+
+def _project(value, projection):
+    if projection == True:
+        return value
+    if isinstance(value, dict):
+        result = {}
+        for key, child in projection.iteritems():
+            if key in value:
+                result[key] = _project(value[key], child)
+        return result
+    if isinstance(value, list):
+        return [_project(item, projection) for item in value]
+    return value
+
+def get_next_href(page):
+    """Returns the href of the page following 'page' (a bundle list or
+    search result), or None if 'page' is the last one."""
+
+    links = page.get('_links', {})
+    if links.has_key('next'):
+        return links['next']['href']
+    return None
+
+def get_page_items(page):
+    """Returns the items in 'page' (a bundle list or search result).
+
+    If the items were embedded, the embedded documents are returned.
+    Otherwise the item links (dictionaries holding an 'href') are
+    returned."""
+
+    embedded = page.get('_embedded', {})
+    if embedded.has_key('items'):
+        return embedded['items']
+    return page.get('_links', {}).get('items', [])
+
+def get_bundle_tracks(bundle):
+    """Returns the list of tracks embedded in 'bundle' (a bundle, or an
+    item of a bundle list or search result, retrieved with the tracks
+    embedded), or None if the tracks weren't embedded."""
+
+    embedded = bundle.get('_embedded', {})
+    for key in ('o3v:tracks', 'tracks'):
+        if embedded.has_key(key):
+            tracks = embedded[key]
+            # Either the track list itself, or a track list document.
+            if isinstance(tracks, dict):
+                tracks = tracks.get('tracks', [])
+            return tracks
+    if bundle.has_key('tracks'):
+        return bundle['tracks']
+    return None
+
+def get_self_href(document):
+    """Returns the href of 'document' (a bundle, a reference or an item
+    of a bundle list or search result)."""
+
+    if document.has_key('href'):
+        return document['href']
+    return document['_links']['self']['href']
+
+def iter_bundle_list_pages(href=None, limit=None, embed_items=None,
+                           embed_tracks=None, embed_metadata=None,
+                           timeout=None, fields=None):
+    """Generates every page of the bundle list, starting at 'href'.
+
+    The arguments are those of get_bundle_list().  Pages are retrieved
+    one at a time as the generator is consumed.  'timeout' covers the
+    whole iteration."""
+
+    deadline = Deadline.get(timeout)
+    while True:
+        page = get_bundle_list(href, limit, embed_items, embed_tracks,
+                               embed_metadata, deadline, fields)
+        yield page
+        href = get_next_href(page)
+        if href == None:
+            break
+
+def iter_search_pages(href=None, query=None, query_field=None, filter=None,
+                      limit=None, embed_items=None, embed_tracks=None,
+                      embed_metadata=None, timeout=None, fields=None):
+    """Generates every page of a search result, starting at 'href'.
+
+    The arguments are those of search().  Pages are retrieved one at
+    a time as the generator is consumed.  'timeout' covers the whole
+    iteration."""
+
+    deadline = Deadline.get(timeout)
+    while True:
+        page = search(href, query, query_field, filter, limit, embed_items,
+                      embed_tracks, embed_metadata, deadline, fields)
+        yield page
+        href = get_next_href(page)
+        if href == None:
+            break
+
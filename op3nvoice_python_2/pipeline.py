@@ -0,0 +1,281 @@
+##
+##  This file contains a staged streaming pipeline built on the REST
+##  cover functions.  Each stage runs its own worker threads and stages
+##  are connected with bounded queues, so the slowest stage sets the
+##  pace and no stage buffers more than its queue allows.
+##
+
+import sys
+import time
+import Queue
+import threading
+import collections
+import op3nvoice
+
+DEFAULT_QUEUE_SIZE = 100
+
+# How often (in seconds) blocked workers check for cancellation.
+_POLL_INTERVAL = 0.1
+
+# Marks the end of the stream in a queue.
+_END = object()
+
+# Returned instead of an item once the pipeline is cancelled.
+_CANCELLED = object()
+
+# This named tuple is returned by Pipeline.get_metrics(), one per stage.
+StageMetrics = collections.namedtuple('StageMetrics',
+                                      ['name', 'concurrency', 'processed',
+                                       'errors', 'busy_time', 'throughput',
+                                       'queue_depth', 'queue_size'])
+
+###
+###  Sources.
+###
+
+def bundle_source(limit=None, embed_items=None, embed_tracks=None,
+                  embed_metadata=None, timeout=None):
+    """Generates every bundle in the bundle list, one page at a time.
+
+    The arguments are those of get_bundle_list(); 'timeout' covers the
+    whole iteration.  If 'embed_items' is true the embedded bundles are
+    generated, otherwise the bundle links (dictionaries holding an
+    'href')."""
+
+    for page in op3nvoice.iter_bundle_list_pages(None, limit, embed_items,
+                                                 embed_tracks,
+                                                 embed_metadata, timeout):
+        for item in op3nvoice.get_page_items(page):
+            yield item
+
+###
+###  The pipeline.
+###
+
+class Stage(object):
+    """One step of a Pipeline."""
+
+    name = None
+    func = None
+    concurrency = None
+    queue_size = None
+    expand = None
+
+    def __init__(self, name, func, concurrency=1, queue_size=None,
+                 expand=False):
+        """Initializer.
+
+        'name' identifies the stage in the metrics.  May not be None.
+        'func' called with each item; its return value is passed to the
+        next stage.  May not be None.
+        'concurrency' the number of threads running 'func'.
+        'queue_size' the capacity of the queue feeding this stage.  If
+        None, the pipeline's default is used.
+        'expand' if True, 'func' returns an iterable and each of its
+        values is passed to the next stage separately."""
+
+        # Argument error checking.
+        assert name != None
+        assert func != None
+        assert concurrency > 0
+        assert queue_size == None or queue_size > 0
+
+        self.name = name
+        self.func = func
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.expand = expand
+
+class Pipeline(object):
+    """Runs items from a source through a list of Stages.
+
+    Typical use:
+
+        p = Pipeline(bundle_source(), [Stage('get', fetch, 8),
+                                       Stage('transform', transform),
+                                       Stage('update', update, 4)])
+        for result in p.run():
+            ...
+
+    Any thread may call cancel() to stop the pipeline."""
+
+    def __init__(self, source, stages, queue_size=DEFAULT_QUEUE_SIZE):
+        """Initializer.
+
+        'source' an iterable of the items fed to the first stage.  It
+        is consumed in its own thread.  May not be None.
+        'stages' a non-empty list of Stages.
+        'queue_size' the default capacity of the queues between stages,
+        and of the output queue."""
+
+        # Argument error checking.
+        assert source != None
+        assert stages
+        assert queue_size > 0
+
+        self._source = source
+        self._stages = stages
+        self._queues = [Queue.Queue(s.queue_size or queue_size)
+                        for s in stages]
+        self._queues.append(Queue.Queue(queue_size))
+        self._cancelled = threading.Event()
+        self._lock = threading.Lock()
+        self._error = None
+        self._threads = []
+        self._started = None
+        self._processed = [0] * len(stages)
+        self._errors = [0] * len(stages)
+        self._busy = [0.0] * len(stages)
+        self._running = [0] * len(stages)
+
+    def run(self):
+        """Start the pipeline and generate the output of the last stage.
+
+        If a stage throws, the pipeline is cancelled and the exception
+        is re-thrown here.  If the pipeline is cancelled, generation
+        stops."""
+
+        assert self._started == None
+
+        self._started = time.time()
+        self._spawn(self._feed)
+        for i, stage in enumerate(self._stages):
+            self._running[i] = stage.concurrency
+            for n in range(stage.concurrency):
+                self._spawn(self._work, i)
+
+        item = None
+        try:
+            while True:
+                item = self._get(self._queues[-1])
+                if item is _END:
+                    break
+                yield item
+        finally:
+            # Also reached when the consumer abandons the generator.
+            if item is not _END:
+                self.cancel()
+            for t in self._threads:
+                t.join()
+
+        if self._error != None:
+            raise self._error[0], self._error[1], self._error[2]
+
+    def cancel(self):
+        """Stop the source and every stage as soon as possible."""
+
+        self._cancelled.set()
+
+    def is_cancelled(self):
+        """Returns True if the pipeline was cancelled."""
+
+        return self._cancelled.is_set()
+
+    def get_metrics(self):
+        """Returns a list of StageMetrics, one per stage, in order."""
+
+        elapsed = 0.0
+        if self._started != None:
+            elapsed = time.time() - self._started
+
+        result = []
+        for i, stage in enumerate(self._stages):
+            throughput = 0.0
+            if elapsed > 0:
+                throughput = self._processed[i] / elapsed
+            result.append(StageMetrics(name=stage.name,
+                                       concurrency=stage.concurrency,
+                                       processed=self._processed[i],
+                                       errors=self._errors[i],
+                                       busy_time=self._busy[i],
+                                       throughput=throughput,
+                                       queue_depth=self._queues[i].qsize(),
+                                       queue_size=self._queues[i].maxsize))
+        return result
+
+    def _spawn(self, target, *args):
+        t = threading.Thread(target=target, args=args)
+        t.daemon = True
+        self._threads.append(t)
+        t.start()
+
+    def _fail(self, exc_info):
+        with self._lock:
+            if self._error == None:
+                self._error = exc_info
+        self.cancel()
+
+    def _feed(self):
+        try:
+            for item in self._source:
+                if not self._put(self._queues[0], item):
+                    return
+        except Exception:
+            self._fail(sys.exc_info())
+            return
+        self._put(self._queues[0], _END)
+
+    def _work(self, i):
+        stage = self._stages[i]
+        inq = self._queues[i]
+        outq = self._queues[i + 1]
+
+        while True:
+            item = self._get(inq)
+            if item is _END:
+                # Let the sibling workers see the end too.  The last
+                # worker out passes it downstream.
+                self._put(inq, _END)
+                with self._lock:
+                    self._running[i] -= 1
+                    last = self._running[i] == 0
+                if last:
+                    self._put(outq, _END)
+                return
+            if item is _CANCELLED:
+                return
+
+            start = time.time()
+            try:
+                result = stage.func(item)
+                if stage.expand:
+                    result = list(result)
+            except Exception:
+                with self._lock:
+                    self._errors[i] += 1
+                self._fail(sys.exc_info())
+                return
+            with self._lock:
+                self._processed[i] += 1
+                self._busy[i] += time.time() - start
+
+            if stage.expand:
+                for r in result:
+                    if not self._put(outq, r):
+                        return
+            elif not self._put(outq, result):
+                return
+
+    def _put(self, q, item):
+        """Put 'item' in 'q', waiting for room.  Returns False if the
+        pipeline was cancelled first."""
+
+        while not self.is_cancelled():
+            try:
+                q.put(item, True, _POLL_INTERVAL)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def _get(self, q):
+        """Get an item from 'q'.  Returns _CANCELLED if the pipeline
+        was cancelled first.  The output queue returns _END instead, so
+        that run() simply stops."""
+
+        while not self.is_cancelled():
+            try:
+                return q.get(True, _POLL_INTERVAL)
+            except Queue.Empty:
+                pass
+        return _END if q is self._queues[-1] else _CANCELLED
@@ -0,0 +1,186 @@
+##
+##  This file contains the opt-in profiler breaking API calls down into
+##  phases: DNS lookup, TCP connect, TLS handshake, sending the request,
+##  waiting for the response headers, transferring the body and decoding
+##  the JSON.  Phases are aggregated by endpoint and can be written as a
+##  Chrome trace (chrome://tracing, Perfetto) or as folded stacks for
+##  flamegraph.pl.
+##
+##      profiler = op3nvoice.enable_profiling()
+##      ...
+##      profiler.write_chrome_trace('calls.json')
+##      profiler.write_folded('calls.folded')
+##
+
+import os
+import json
+import time
+import thread
+import threading
+import collections
+from transport import get_endpoint
+
+# The phases, in the order they happen.  'request' is the whole
+# transport call, from before DNS to the end of the body.
+PHASES = ('dns', 'connect', 'tls', 'send', 'wait', 'transfer', 'decode')
+REQUEST = 'request'
+
+DEFAULT_MAX_CALLS = 10000
+
+# This named tuple holds the aggregate of one phase of one endpoint.
+PhaseStats = collections.namedtuple('PhaseStats',
+                                    ['count', 'total', 'mean', 'max'])
+
+_local = threading.local()
+
+###
+###  The profiler.
+###
+
+class Profiler(object):
+    """Records the phases of API calls.  Thread safe.
+
+    Phases are measured in the thread making the call; transports that
+    hand requests to other threads (e.g. HedgedTransport) only report
+    the whole request and the decode."""
+
+    def __init__(self, max_calls=DEFAULT_MAX_CALLS):
+        """Initializer.
+
+        'max_calls' the number of most recent calls kept for
+        write_chrome_trace().  The aggregates cover every call."""
+
+        self._lock = threading.Lock()
+        self._calls = collections.deque(maxlen=max_calls)
+        # endpoint -> phase -> [count, total, max]
+        self._stats = {}
+
+    def begin(self, method, path):
+        """Start profiling a call in the current thread.  Returns the
+        call, to be passed to end()."""
+
+        call = _Call(self, get_endpoint(method, path), time.time())
+        _local.call = call
+        return call
+
+    def end(self, call):
+        """Finish a call started by begin().  Its decode is added
+        afterwards, by whoever holds the call."""
+
+        call.end = time.time()
+        _local.call = None
+        self._add(call.endpoint, REQUEST, call.end - call.start)
+        with self._lock:
+            self._calls.append(call)
+
+    def get_stats(self):
+        """Returns a dictionary mapping each endpoint to a dictionary
+        mapping each phase seen (plus 'request') to its PhaseStats.
+        Times are in seconds."""
+
+        with self._lock:
+            result = {}
+            for endpoint, phases in self._stats.iteritems():
+                result[endpoint] = dict(
+                    (phase, PhaseStats(count=s[0], total=s[1],
+                                       mean=s[1] / s[0], max=s[2]))
+                    for phase, s in phases.iteritems())
+            return result
+
+    def reset(self):
+        """Forget every call recorded."""
+
+        with self._lock:
+            self._calls.clear()
+            self._stats = {}
+
+    def write_chrome_trace(self, path):
+        """Write the recent calls to 'path' in the Chrome trace event
+        format: one complete event per call, with its phases nested."""
+
+        with self._lock:
+            calls = list(self._calls)
+
+        pid = os.getpid()
+        events = []
+        for call in calls:
+            events.append(_get_event(call.endpoint, 'call', call.start,
+                                     call.end, pid, call.thread))
+            for phase, start, end in call.phases:
+                events.append(_get_event(phase, call.endpoint, start, end,
+                                         pid, call.thread))
+
+        with open(path, 'wb') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+    def write_folded(self, path):
+        """Write the aggregates to 'path' as folded stacks
+        ('endpoint;phase microseconds' lines), the input format of
+        flamegraph.pl.  Request time not covered by a phase is counted
+        against the endpoint itself."""
+
+        lines = []
+        for endpoint, phases in sorted(self.get_stats().iteritems()):
+            name = endpoint.replace(' ', '_').replace(';', ':')
+            covered = 0
+            for phase in PHASES:
+                stats = phases.get(phase)
+                if stats == None:
+                    continue
+                if phase != 'decode':
+                    covered += stats.total
+                lines.append('%s;%s %d' % (name, phase,
+                                           int(stats.total * 1e6)))
+            request = phases.get(REQUEST)
+            if request != None and request.total > covered:
+                lines.append('%s %d' % (name,
+                                        int((request.total - covered) * 1e6)))
+
+        with open(path, 'wb') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def _add(self, endpoint, phase, duration):
+        with self._lock:
+            phases = self._stats.get(endpoint)
+            if phases == None:
+                phases = self._stats[endpoint] = {}
+            stats = phases.get(phase)
+            if stats == None:
+                phases[phase] = [1, duration, duration]
+            else:
+                stats[0] += 1
+                stats[1] += duration
+                if duration > stats[2]:
+                    stats[2] = duration
+
+class _Call(object):
+    __slots__ = ['profiler', 'endpoint', 'start', 'end', 'thread', 'phases']
+
+    def __init__(self, profiler, endpoint, start):
+        self.profiler = profiler
+        self.endpoint = endpoint
+        self.start = start
+        self.end = None
+        self.thread = thread.get_ident()
+        self.phases = []
+
+    def add_phase(self, phase, start, end):
+        """Record that 'phase' of this call ran from 'start' to 'end'."""
+
+        self.phases.append((phase, start, end))
+        self.profiler._add(self.endpoint, phase, end - start)
+
+###
+###  Utility functions.
+###
+
+def get_current_call():
+    """Returns the call being profiled in the current thread, or None.
+    Used by the transports to report phases."""
+
+    return getattr(_local, 'call', None)
+
+def _get_event(name, category, start, end, pid, tid):
+    return {'name': name, 'cat': category, 'ph': 'X', 'pid': pid,
+            'tid': tid, 'ts': int(start * 1e6),
+            'dur': int((end - start) * 1e6)}
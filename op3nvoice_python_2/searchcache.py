@@ -0,0 +1,201 @@
+##
+##  This file contains the search result cache.  Search pages are cached
+##  by a canonical form of the request, so that the same query asked
+##  with differently ordered or spaced arguments shares one entry.
+##  Entries expire after a TTL and the least recently used ones are
+##  evicted to keep the cache within its entry and memory bounds.
+##
+
+import time
+import threading
+import collections
+
+DEFAULT_TTL = 60.0
+DEFAULT_MAX_ENTRIES = 1000
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+
+# The rough per-entry overhead (key tuple, entry, dictionary slot)
+# counted against the memory bound on top of the page and key strings.
+_ENTRY_OVERHEAD = 256
+
+# This named tuple is returned by SearchCache.get_stats().
+SearchCacheStats = collections.namedtuple('SearchCacheStats',
+                                          ['entries', 'bytes', 'hits',
+                                           'stale_hits', 'misses',
+                                           'evictions'])
+
+###
+###  The cache.
+###
+
+class SearchCache(object):
+    """A thread safe TTL and LRU cache of search pages (JSON strings).
+
+    Typical use is through op3nvoice.enable_search_cache()."""
+
+    def __init__(self, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES,
+                 max_bytes=DEFAULT_MAX_BYTES, stale_ttl=0):
+        """Initializer.
+
+        'ttl' the number of seconds a page is served from the cache.
+        'max_entries' the maximum number of pages cached.
+        'max_bytes' the approximate maximum memory used by the cached
+        pages.
+        'stale_ttl' the number of seconds after 'ttl' expires during
+        which the stale page is still returned immediately while a
+        fresh one is retrieved in the background.  0 disables
+        stale-while-revalidate."""
+
+        assert ttl > 0
+        assert max_entries > 0
+        assert max_bytes > 0
+        assert stale_ttl >= 0
+
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.stale_ttl = stale_ttl
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._hits = 0
+        self._stale_hits = 0
+        self._misses = 0
+        self._evictions = 0
+        # Incremented by invalidate(), so that pages retrieved before an
+        # invalidation aren't stored after it.
+        self._generation = 0
+
+    def get_key(self, path, data):
+        """Returns the canonical cache key of a search request.
+
+        'path' the request path.
+        'data' the query fields, as passed to get().  May be None.
+
+        Field order doesn't matter, whitespace in the query is
+        collapsed, single valued lists (as produced by parse_qs) are
+        unwrapped and the embed set is sorted."""
+
+        fields = []
+        if data != None:
+            for name, value in data.iteritems():
+                if isinstance(value, (list, tuple)):
+                    if len(value) == 1:
+                        value = value[0]
+                    else:
+                        value = tuple(value)
+                if name == 'query' and isinstance(value, basestring):
+                    value = ' '.join(value.split())
+                elif name == 'embed' and isinstance(value, basestring):
+                    value = ','.join(sorted(value.split(',')))
+                elif isinstance(value, (int, long)):
+                    value = str(value)
+                fields.append((name, value))
+        fields.sort()
+        return (path, tuple(fields))
+
+    def get(self, key, fetch, timeout=None):
+        """Returns the page cached under 'key', retrieving it first if
+        needed.
+
+        'key' a key returned by get_key().
+        'fetch' a function taking a timeout and returning the page.  It
+        is called without the lock held, and with a timeout of None
+        when revalidating in the background.
+        'timeout' passed to 'fetch' when the caller has to wait for it.
+
+        Whatever 'fetch' throws is passed on; failures are not
+        cached.  A page retrieved while invalidate() is called is
+        returned but not cached."""
+
+        now = time.time()
+        with self._lock:
+            generation = self._generation
+            entry = self._entries.get(key)
+            if entry != None:
+                age = now - entry.stored_at
+                if age < self.ttl:
+                    self._entries[key] = self._entries.pop(key)
+                    self._hits += 1
+                    return entry.page
+                if age < self.ttl + self.stale_ttl:
+                    self._entries[key] = self._entries.pop(key)
+                    self._stale_hits += 1
+                    if not entry.revalidating:
+                        entry.revalidating = True
+                        self._revalidate(key, fetch, entry, generation)
+                    return entry.page
+            self._misses += 1
+
+        page = fetch(timeout)
+        self._put(key, page, generation)
+        return page
+
+    def invalidate(self, key=None):
+        """Drop the page cached under 'key', or every page if None."""
+
+        with self._lock:
+            self._generation += 1
+            if key == None:
+                self._entries.clear()
+                self._bytes = 0
+            else:
+                entry = self._entries.pop(key, None)
+                if entry != None:
+                    self._bytes -= entry.size
+
+    def get_stats(self):
+        """Returns a SearchCacheStats."""
+
+        with self._lock:
+            return SearchCacheStats(entries=len(self._entries),
+                                    bytes=self._bytes, hits=self._hits,
+                                    stale_hits=self._stale_hits,
+                                    misses=self._misses,
+                                    evictions=self._evictions)
+
+    def _put(self, key, page, generation):
+        """Cache 'page' unless invalidate() was called since
+        'generation' was read."""
+
+        size = len(page) + len(repr(key)) + _ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            if generation != self._generation:
+                return
+            old = self._entries.pop(key, None)
+            if old != None:
+                self._bytes -= old.size
+            self._entries[key] = _Entry(page, size)
+            self._bytes += size
+            while (len(self._entries) > self.max_entries or
+                   self._bytes > self.max_bytes):
+                evicted_key, evicted = self._entries.popitem(False)
+                self._bytes -= evicted.size
+                self._evictions += 1
+
+    def _revalidate(self, key, fetch, entry, generation):
+        def run():
+            try:
+                self._put(key, fetch(None), generation)
+            except Exception:
+                # Keep serving the stale page; the next stale hit after
+                # this one retries.
+                pass
+            finally:
+                entry.revalidating = False
+
+        t = threading.Thread(target=run)
+        t.daemon = True
+        t.start()
+
+class _Entry(object):
+    __slots__ = ['page', 'size', 'stored_at', 'revalidating']
+
+    def __init__(self, page, size):
+        self.page = page
+        self.size = size
+        self.stored_at = time.time()
+        self.revalidating = False
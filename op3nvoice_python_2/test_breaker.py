@@ -0,0 +1,116 @@
+import time
+from transport import MemoryTransport
+from breaker import CircuitBreaker, BreakerTransport, CircuitOpenException
+from breaker import CLOSED, OPEN, HALF_OPEN
+
+COOL_DOWN = 0.1
+
+def _breaker(**kwargs):
+    args = {'window': 10, 'min_requests': 4, 'error_threshold': 0.5,
+            'cool_down': COOL_DOWN}
+    args.update(kwargs)
+    return CircuitBreaker(**args)
+
+def _fail(breaker, n):
+    for i in range(n):
+        permit = breaker.allow()
+        assert permit
+        breaker.record(True, 0, permit)
+
+def _half_open(breaker):
+    _fail(breaker, 4)
+    assert breaker.get_state() == OPEN
+    time.sleep(COOL_DOWN * 1.5)
+    assert breaker.get_state() == HALF_OPEN
+
+def test_closed_to_open():
+    breaker = _breaker()
+    _fail(breaker, 3)
+    assert breaker.get_state() == CLOSED
+    _fail(breaker, 1)
+    assert breaker.get_state() == OPEN
+    assert not breaker.allow()
+    assert 0 < breaker.get_retry_after() <= COOL_DOWN
+
+def test_stays_closed_below_threshold():
+    breaker = _breaker()
+    for i in range(10):
+        permit = breaker.allow()
+        breaker.record(i % 4 == 1, 0, permit)
+    assert breaker.get_state() == CLOSED
+
+def test_slow_calls_open():
+    breaker = _breaker(slow_call_duration=1, slow_call_threshold=0.5)
+    for i in range(4):
+        breaker.record(False, 2, breaker.allow())
+    assert breaker.get_state() == OPEN
+
+def test_open_to_half_open_to_closed():
+    breaker = _breaker()
+    _half_open(breaker)
+    probe = breaker.allow()
+    assert probe
+    # Only one probe at a time.
+    assert not breaker.allow()
+    breaker.record(False, 0, probe)
+    assert breaker.get_state() == CLOSED
+    assert breaker.allow()
+
+def test_open_to_half_open_to_open():
+    breaker = _breaker()
+    _half_open(breaker)
+    probe = breaker.allow()
+    breaker.record(True, 0, probe)
+    assert breaker.get_state() == OPEN
+    assert not breaker.allow()
+
+def test_late_request_does_not_act_as_probe():
+    breaker = _breaker()
+    late = breaker.allow()
+    _half_open(breaker)
+    probe = breaker.allow()
+    # A request allowed while CLOSED completes now: it neither closes
+    # the breaker nor frees a probe slot.
+    breaker.record(False, 0, late)
+    assert breaker.get_state() == HALF_OPEN
+    assert not breaker.allow()
+    breaker.record(True, 0, probe)
+    assert breaker.get_state() == OPEN
+
+def test_probe_from_earlier_period_is_ignored():
+    breaker = _breaker()
+    _half_open(breaker)
+    old_probe = breaker.allow()
+    breaker.record(True, 0, breaker.allow() or old_probe)
+    assert breaker.get_state() == OPEN
+    time.sleep(COOL_DOWN * 1.5)
+    assert breaker.get_state() == HALF_OPEN
+    probe = breaker.allow()
+    breaker.record(False, 0, old_probe)
+    assert breaker.get_state() == HALF_OPEN
+    breaker.record(False, 0, probe)
+    assert breaker.get_state() == CLOSED
+
+def test_transport():
+    memory = MemoryTransport()
+    memory.add('GET', '/v1/bundles/1', 200, {'name': 'ok'})
+    memory.add('GET', '/v1/bundles/2', 503, {'status': 'x', 'message': 'x',
+                                              'code': 503})
+    transport = BreakerTransport(memory, stale_cache=10, min_requests=3,
+                                 cool_down=60)
+    assert transport.request('GET', '/v1/bundles/1')[0] == 200
+    for i in range(2):
+        assert transport.request('GET', '/v1/bundles/2')[0] == 503
+    assert transport.get_states()['GET /v1/bundles/{id}'] == OPEN
+
+    # A cached response is served while open; others fail fast.
+    sent = len(memory.requests)
+    assert transport.request('GET', '/v1/bundles/1')[0] == 200
+    try:
+        transport.request('GET', '/v1/bundles/2')
+    except CircuitOpenException, e:
+        assert e.get_endpoint() == 'GET /v1/bundles/{id}'
+        assert e.get_retry_after() > 0
+    else:
+        assert False, 'The breaker did not open'
+    assert len(memory.requests) == sent
@@ -0,0 +1,144 @@
+import os
+import gzip
+import json
+import op3nvoice
+from transport import MemoryTransport
+from idempotent import IdempotentCreator
+from bulk import export_account, import_bundles
+
+BUNDLE = {'_links': {'self': {'href': '/v1/bundles/1'},
+                     'o3v:tracks': {'href': '/v1/bundles/1/tracks'}}}
+
+def _use_transport():
+    transport = MemoryTransport()
+    transport.add('POST', '/v1/bundles', 201, BUNDLE)
+    transport.add('POST', '/v1/bundles/1/tracks', 201,
+                  {'_links': {'self': {'href': '/v1/bundles/1/tracks'}}})
+    op3nvoice.set_key('key')
+    op3nvoice.set_transport(transport)
+    return transport
+
+def _write(tmpdir, lines):
+    path = str(tmpdir.join('import.jsonl'))
+    f = open(path, 'wb')
+    f.write('\n'.join(lines) + '\n')
+    f.close()
+    return path
+
+def _posts(transport, path):
+    return len([r for r in transport.requests
+                if r[0] == 'POST' and r[1] == path])
+
+def test_export(tmpdir):
+    transport = MemoryTransport()
+    transport.add('GET', '/v1/bundles',
+                  body={'_embedded': {'items': [{'id': 1}]},
+                        '_links': {'next': {'href': '/v1/bundles/p2'}}})
+    transport.add('GET', '/v1/bundles/p2',
+                  body={'_embedded': {'items': [{'id': 2}]}, '_links': {}})
+    op3nvoice.set_key('key')
+    op3nvoice.set_transport(transport)
+
+    path = str(tmpdir.join('export.jsonl.gz'))
+    progress = export_account(path)
+    assert progress.pages == 2
+    assert progress.items == 2
+    lines = gzip.open(path).read().splitlines()
+    assert [json.loads(line)['id'] for line in lines] == [1, 2]
+    assert not os.path.exists(path + '.checkpoint')
+
+def test_export_resume(tmpdir):
+    transport = MemoryTransport()
+    transport.add('GET', '/v1/bundles',
+                  body={'_embedded': {'items': [{'id': 1}]},
+                        '_links': {'next': {'href': '/v1/bundles/p2'}},
+                        'total': 2})
+    transport.add('GET', '/v1/bundles/p2', 503,
+                  {'status': 'x', 'message': 'x', 'code': 503})
+    op3nvoice.set_key('key')
+    op3nvoice.set_transport(transport)
+
+    path = str(tmpdir.join('export.jsonl'))
+    try:
+        export_account(path, compression=None)
+    except op3nvoice.APIException:
+        pass
+    else:
+        assert False, 'The failed page was not thrown'
+    assert os.path.exists(path + '.checkpoint')
+    # Written after the last checkpoint, and discarded on resume.
+    f = open(path, 'ab')
+    f.write('{"id": 9')
+    f.close()
+
+    transport.add('GET', '/v1/bundles/p2',
+                  body={'_embedded': {'items': [{'id': 2}]}, '_links': {}})
+    seen = []
+    progress = export_account(path, compression=None, progress=seen.append)
+    assert progress.pages == 2
+    assert progress.items == 2
+    assert len(seen) == 1
+    lines = open(path).read().splitlines()
+    assert [json.loads(line)['id'] for line in lines] == [1, 2]
+    # The first page isn't retrieved again.
+    paths = [r[1].split('?')[0] for r in transport.requests]
+    assert paths == ['/v1/bundles', '/v1/bundles/p2', '/v1/bundles/p2']
+    assert not os.path.exists(path + '.checkpoint')
+
+def test_import(tmpdir):
+    transport = _use_transport()
+    record = {'media_url': 'http://m/1',
+              'tracks': [{'media_url': 'http://m/2'}]}
+    path = _write(tmpdir, [json.dumps(record)] * 3)
+    assert import_bundles(path, concurrency=2) == (3, 0, 0)
+    assert _posts(transport, '/v1/bundles') == 3
+    assert _posts(transport, '/v1/bundles/1/tracks') == 3
+
+    # Complete lines are skipped by the next run.
+    assert import_bundles(path) == (0, 3, 0)
+    assert _posts(transport, '/v1/bundles') == 3
+
+def test_bad_line_fails_alone(tmpdir):
+    _use_transport()
+    path = _write(tmpdir, ['{"media_url": "http://m/1"}', '{not json',
+                           '{"media_url": "http://m/2"}'])
+    errors = []
+    result = import_bundles(path, on_error=lambda *args: errors.append(args))
+    assert result == (2, 0, 1)
+    assert len(errors) == 1
+    line_number, record, e = errors[0]
+    assert line_number == 1
+    assert record == '{not json\n'
+    assert isinstance(e, ValueError)
+
+def test_resume_partial_line(tmpdir):
+    transport = _use_transport()
+    record = {'media_url': 'http://m/1',
+              'tracks': [{'media_url': 'http://m/2'},
+                         {'media_url': 'http://m/3'}]}
+    path = _write(tmpdir, [json.dumps(record)])
+    f = open(path + '.journal', 'wb')
+    f.write(json.dumps({'line': 0, 'bundle': '/v1/bundles/1',
+                        'tracks_href': '/v1/bundles/1/tracks'}) + '\n')
+    f.write(json.dumps({'line': 0, 'track': 0}) + '\n')
+    f.close()
+
+    assert import_bundles(path) == (1, 0, 0)
+    assert _posts(transport, '/v1/bundles') == 0
+    assert _posts(transport, '/v1/bundles/1/tracks') == 1
+
+def test_creator_prevents_duplicates(tmpdir):
+    transport = _use_transport()
+    record = {'media_url': 'http://m/1',
+              'tracks': [{'media_url': 'http://m/2'}]}
+    path = _write(tmpdir, [json.dumps(record)])
+    creator = IdempotentCreator(str(tmpdir.join('index')))
+    try:
+        assert import_bundles(path, creator=creator) == (1, 0, 0)
+        # As if the run had stopped before writing its journal.
+        os.remove(path + '.journal')
+        assert import_bundles(path, creator=creator) == (1, 0, 0)
+    finally:
+        creator.close()
+    assert _posts(transport, '/v1/bundles') == 1
+    assert _posts(transport, '/v1/bundles/1/tracks') == 1
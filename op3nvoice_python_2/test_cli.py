@@ -0,0 +1,85 @@
+import json
+import StringIO
+import op3nvoice
+from connection import ConnectionPool
+from loadgen import StandInServer
+from cli import main, KEY_ENVIRONMENT_VARIABLE
+
+def _start():
+    server = StandInServer(bundles=25, seed=1)
+    server.start()
+    op3nvoice.set_transport(ConnectionPool(server.get_host(), secure=False))
+    return server
+
+def _lines(text):
+    return [json.loads(line) for line in text.splitlines()]
+
+def test_key_required(monkeypatch, capsys):
+    monkeypatch.delenv(KEY_ENVIRONMENT_VARIABLE, raising=False)
+    assert main(['list']) == 2
+    assert KEY_ENVIRONMENT_VARIABLE in capsys.readouterr()[1]
+
+def test_list(capsys):
+    server = _start()
+    try:
+        assert main(['--key', 'key', 'list', '--limit', '10',
+                     '--fields', 'name']) == 0
+        out, err = capsys.readouterr()
+        bundles = _lines(out)
+        assert len(bundles) == 25
+        assert all(b.keys() == ['name'] for b in bundles)
+        assert err == ''
+    finally:
+        server.stop()
+
+def test_get_from_stdin(monkeypatch, capsys):
+    server = _start()
+    try:
+        hrefs = server.get_bundle_hrefs()[:3]
+        stdin = '\n'.join([hrefs[0], json.dumps({'href': hrefs[1]}),
+                           '', hrefs[2]]) + '\n'
+        monkeypatch.setattr('sys.stdin', StringIO.StringIO(stdin))
+        assert main(['--key', 'key', '-c', '2', 'get']) == 0
+        out, err = capsys.readouterr()
+        # Results are written in input order.
+        assert [op3nvoice.get_self_href(b) for b in _lines(out)] == hrefs
+    finally:
+        server.stop()
+
+def test_bad_line_fails_alone(monkeypatch, capsys):
+    server = _start()
+    try:
+        hrefs = server.get_bundle_hrefs()[:2]
+        stdin = '\n'.join([hrefs[0], '{"href": ', hrefs[1]]) + '\n'
+        monkeypatch.setattr('sys.stdin', StringIO.StringIO(stdin))
+        assert main(['--key', 'key', 'get']) == 1
+        out, err = capsys.readouterr()
+        assert [op3nvoice.get_self_href(b) for b in _lines(out)] == hrefs
+        errors = _lines(err)
+        assert len(errors) == 1
+        assert errors[0]['input'] == '{"href":'
+    finally:
+        server.stop()
+
+def test_purge_errors(capsys):
+    server = _start()
+    try:
+        href = server.get_bundle_hrefs()[0]
+        assert main(['--key', 'key', 'purge', href, '/v1/bundles/0']) == 1
+        out, err = capsys.readouterr()
+        assert _lines(out) == [{'href': href, 'deleted': True}]
+        errors = _lines(err)
+        assert len(errors) == 1
+        assert errors[0]['input'] == '/v1/bundles/0'
+        assert len(server.get_bundle_hrefs()) == 24
+    finally:
+        server.stop()
+
+def test_purge_all(capsys):
+    server = _start()
+    try:
+        assert main(['--key', 'key', 'purge', '--all', '--limit', '10']) == 0
+        assert server.get_bundle_hrefs() == []
+        assert len(_lines(capsys.readouterr()[0])) == 25
+    finally:
+        server.stop()
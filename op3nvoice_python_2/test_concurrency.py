@@ -0,0 +1,104 @@
+import urlparse
+import threading
+import op3nvoice
+from transport import MemoryTransport
+from concurrency import Future, FutureTimeoutException
+from concurrency import OrderedExecutor, get_bundle_href
+
+def test_future_result():
+    future = Future()
+    seen = []
+    future.add_done_callback(lambda f: seen.append(f.result()))
+    assert not future.done()
+    threading.Timer(0.05, future.set_result, [42]).start()
+    assert future.result(5) == 42
+    assert future.exception() == None
+    assert seen == [42]
+
+    # Resolving again is ignored; late callbacks run at once.
+    future.set_result(43)
+    future.add_done_callback(lambda f: seen.append(f.result()))
+    assert seen == [42, 42]
+
+def test_future_exception():
+    future = Future()
+    try:
+        raise ValueError('bad')
+    except ValueError:
+        future.set_exception()
+    assert isinstance(future.exception(), ValueError)
+    try:
+        future.result()
+    except ValueError, e:
+        assert str(e) == 'bad'
+    else:
+        assert False, 'The exception was not re-thrown'
+
+def test_future_timeout():
+    future = Future()
+    for wait in (future.result, future.exception):
+        try:
+            wait(0.01)
+        except FutureTimeoutException, e:
+            assert e.get_message() != None
+        else:
+            assert False, 'The wait did not time out'
+
+def test_get_bundle_href():
+    assert get_bundle_href('/v1/bundles/5/tracks/2') == '/v1/bundles/5'
+    assert get_bundle_href('/v1/bundles/5/metadata?x=1') == '/v1/bundles/5'
+    assert get_bundle_href('/v1/bundles/5/') == '/v1/bundles/5'
+    assert get_bundle_href('/v1/bundles') == '/v1/bundles'
+
+def test_ordered_per_bundle():
+    transport = MemoryTransport()
+    for b in range(4):
+        transport.add('POST', '/v1/bundles/%d/tracks' % b, body={'ok': 1})
+    op3nvoice.set_key('key')
+    op3nvoice.set_transport(transport)
+
+    executor = OrderedExecutor(workers=4)
+    # Tracks lists, tracks and metadata of a bundle share a lane.
+    assert executor.get_lane('/v1/bundles/1/tracks') == \
+        executor.get_lane('/v1/bundles/1/metadata')
+    futures = []
+    for i in range(50):
+        href = '/v1/bundles/%d/tracks' % (i % 4)
+        futures.append(executor.submit(href, op3nvoice.create_track, href,
+                                       'http://m/%d' % i))
+    executor.shutdown()
+    assert [f.result() for f in futures] == [{'ok': 1}] * 50
+    for b in range(4):
+        urls = [urlparse.parse_qs(body)['media_url'][0]
+                for method, path, body in transport.requests
+                if path == '/v1/bundles/%d/tracks' % b]
+        assert urls == ['http://m/%d' % i for i in range(b, 50, 4)]
+
+def test_lanes_run_in_parallel():
+    executor = OrderedExecutor(workers=2, lanes=2, key=lambda k: k)
+    first = [k for k in range(10) if executor.get_lane(k) == 0][0]
+    second = [k for k in range(10) if executor.get_lane(k) == 1][0]
+    release = threading.Event()
+    blocked = executor.submit(first, release.wait, 5)
+    # The other lane isn't held up by the blocked one.
+    assert executor.submit(second, lambda: 'ran').result(5) == 'ran'
+    queued = executor.submit(first, lambda: 'queued')
+    assert executor.get_queue_depths()[0] == 2
+    release.set()
+    assert blocked.result(5)
+    assert queued.result(5) == 'queued'
+    executor.shutdown()
+
+def test_failure_and_shutdown():
+    executor = OrderedExecutor(workers=1)
+    failed = executor.submit('k', int, 'x')
+    later = executor.submit('k', int, '7')
+    executor.shutdown()
+    assert isinstance(failed.exception(), ValueError)
+    assert later.result() == 7
+    try:
+        executor.submit('k', int, '1')
+    except RuntimeError:
+        pass
+    else:
+        assert False, 'A shut down executor accepted a function'
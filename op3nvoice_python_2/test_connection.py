@@ -0,0 +1,125 @@
+import time
+import socket
+import httplib
+import threading
+import connection
+from connection import ConnectionPool
+
+class _Server(object):
+    """A raw HTTP/1.1 server.  'mode' is 'keep' (keep connections
+    alive), 'close' (close each connection after one response, without
+    saying so) or 'hang' (answer the first request of a connection
+    only)."""
+
+    def __init__(self, mode):
+        self.mode = mode
+        self.requests = []
+        self._sock = socket.socket()
+        self._sock.bind(('127.0.0.1', 0))
+        self._sock.listen(5)
+        self.host = '127.0.0.1:%d' % self._sock.getsockname()[1]
+        t = threading.Thread(target=self._accept)
+        t.daemon = True
+        t.start()
+
+    def _accept(self):
+        while True:
+            conn, address = self._sock.accept()
+            t = threading.Thread(target=self._serve, args=(conn,))
+            t.daemon = True
+            t.start()
+
+    def _serve(self, conn):
+        f = conn.makefile('rb')
+        count = 0
+        while True:
+            line = f.readline()
+            if not line:
+                break
+            length = 0
+            while True:
+                header = f.readline()
+                if header in ('\r\n', ''):
+                    break
+                if header.lower().startswith('content-length:'):
+                    length = int(header.split(':')[1])
+            f.read(length)
+            self.requests.append(line.split()[0])
+            count += 1
+            if self.mode == 'hang' and count > 1:
+                time.sleep(2)
+                break
+            conn.sendall('HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\n{}')
+            if self.mode == 'close':
+                break
+        conn.close()
+
+def _reuse(server, method):
+    pool = ConnectionPool(server.host, secure=False, timeout=0.5)
+    assert pool.request('GET', '/first') == (200, '{}')
+    assert pool.get_idle_count() == 1
+    # Let the server close the idle connection.
+    time.sleep(0.1)
+    return pool.request(method, '/second', '{}' if method != 'GET' else '')
+
+def test_keep_alive():
+    server = _Server('keep')
+    pool = ConnectionPool(server.host, secure=False)
+    for i in range(3):
+        assert pool.request('GET', '/') == (200, '{}')
+    assert pool.get_idle_count() == 1
+
+def test_stale_get_is_retried():
+    server = _Server('close')
+    assert _reuse(server, 'GET') == (200, '{}')
+    assert server.requests == ['GET', 'GET']
+
+def test_stale_put_is_retried():
+    server = _Server('close')
+    assert _reuse(server, 'PUT') == (200, '{}')
+
+def test_stale_post_is_not_retried():
+    server = _Server('close')
+    try:
+        _reuse(server, 'POST')
+    except (httplib.HTTPException, socket.error):
+        pass
+    else:
+        assert False, 'A POST was replayed'
+    assert server.requests == ['GET']
+
+def test_timeout_is_not_retried():
+    server = _Server('hang')
+    try:
+        _reuse(server, 'GET')
+    except socket.timeout:
+        pass
+    else:
+        assert False, 'The timeout was not raised'
+    # The request reached the server once, and wasn't sent again.
+    time.sleep(0.1)
+    assert server.requests == ['GET', 'GET']
+
+def test_prewarm_counts_idle_connections():
+    server = _Server('keep')
+    pool = ConnectionPool(server.host, secure=False, max_idle=2)
+    # Connections beyond max_idle are closed, and not counted.
+    assert pool.prewarm(4) == 2
+    assert pool.get_idle_count() == 2
+    assert pool.request('GET', '/') == (200, '{}')
+    assert pool.get_idle_count() == 2
+
+def test_prewarm_connect_timeout(monkeypatch):
+    timeouts = []
+
+    def hang(address, timeout, source_address):
+        timeouts.append(timeout)
+        raise socket.timeout('timed out')
+    monkeypatch.setattr(connection, '_create_connection', hang)
+
+    # Without a pool timeout, connects are still bounded.
+    assert ConnectionPool('api.example.com', secure=False).prewarm(2) == 0
+    assert timeouts == [connection.DEFAULT_PREWARM_TIMEOUT] * 2
+    pool = ConnectionPool('api.example.com', secure=False, timeout=3)
+    assert pool.prewarm(1) == 0
+    assert timeouts[-1] == 3
@@ -0,0 +1,86 @@
+import os
+import op3nvoice
+from connection import ConnectionPool
+from hedging import HedgedTransport
+from loadgen import StandInServer
+from crawler import crawl
+
+BUNDLES = 2499
+
+# While this file exists, the first worker to remove it crashes.
+_crash_flag = None
+
+def _get_href(bundle):
+    return op3nvoice.get_self_href(bundle)
+
+def _crash_once(bundle):
+    try:
+        os.remove(_crash_flag)
+    except OSError:
+        pass
+    else:
+        os._exit(1)
+    return _get_href(bundle)
+
+def _start(**kwargs):
+    server = StandInServer(bundles=BUNDLES, seed=1, **kwargs)
+    server.start()
+    op3nvoice.set_key('key')
+    op3nvoice.set_transport(ConnectionPool(server.get_host(), secure=False))
+    return server
+
+def _crawl(server, ordered, mapper=_get_href, **kwargs):
+    hrefs = list(crawl(mapper, processes=4, ordered=ordered,
+                       shard_size=250, page_size=50, timeout=60, **kwargs))
+    assert len(hrefs) == BUNDLES
+    assert len(set(hrefs)) == BUNDLES
+    if ordered:
+        assert hrefs == server.get_bundle_hrefs()
+    else:
+        assert sorted(hrefs) == sorted(server.get_bundle_hrefs())
+
+def test_crawl():
+    server = _start()
+    try:
+        _crawl(server, True)
+        _crawl(server, False)
+    finally:
+        server.stop()
+
+def test_worker_crash(tmpdir):
+    global _crash_flag
+    server = _start()
+    try:
+        for ordered in (True, False):
+            _crash_flag = str(tmpdir.join('crash'))
+            open(_crash_flag, 'wb').close()
+            _crawl(server, ordered, _crash_once)
+            assert not os.path.exists(_crash_flag)
+    finally:
+        server.stop()
+
+def test_shard_retry():
+    server = _start(error_rate=0.05)
+    try:
+        _crawl(server, True, retries=20)
+        _crawl(server, False, retries=20)
+    finally:
+        server.stop()
+
+def test_wrapping_transport_requires_factory():
+    server = _start()
+    try:
+        pool = op3nvoice.get_transport()
+        op3nvoice.set_transport(HedgedTransport(pool))
+        try:
+            list(crawl(processes=1))
+        except op3nvoice.APIConfigurationException:
+            pass
+        else:
+            assert False, 'A wrapping transport was crawled without a factory'
+        op3nvoice.set_transport(pool)
+        _crawl(server, False,
+               transport_factory=lambda: HedgedTransport(
+                   ConnectionPool(server.get_host(), secure=False)))
+    finally:
+        server.stop()
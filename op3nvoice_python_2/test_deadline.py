@@ -0,0 +1,62 @@
+import time
+import op3nvoice
+from transport import MemoryTransport
+from deadline import Deadline, DeadlineExceededException, get_remaining
+
+class _TimingTransport(MemoryTransport):
+    """Records the timeout of each request."""
+
+    def __init__(self):
+        MemoryTransport.__init__(self)
+        self.timeouts = []
+
+    def request(self, method, path, body='', headers=None, timeout=None):
+        self.timeouts.append(timeout)
+        return MemoryTransport.request(self, method, path, body, headers,
+                                       timeout)
+
+def test_deadline():
+    assert Deadline.get(None) == None
+    deadline = Deadline.get(10)
+    assert Deadline.get(deadline) is deadline
+    assert 9 < deadline.get_remaining() <= 10
+    assert 9 < get_remaining(deadline) <= 10
+    assert get_remaining(None) == None
+
+    expired = Deadline(-1)
+    assert expired.is_expired()
+    assert expired.get_remaining() == 0
+    try:
+        get_remaining(expired)
+    except DeadlineExceededException:
+        pass
+    else:
+        assert False, 'The expired deadline was not thrown'
+
+def test_deadline_covers_pagination():
+    transport = _TimingTransport()
+    transport.add('GET', '/v1/bundles',
+                  body={'_links': {'next': {'href': '/v1/bundles/p2'}}})
+    transport.add('GET', '/v1/bundles/p2', body={'_links': {}})
+    op3nvoice.set_key('key')
+    op3nvoice.set_transport(transport)
+
+    pages = op3nvoice.iter_bundle_list_pages(timeout=10)
+    pages.next()
+    time.sleep(0.05)
+    pages.next()
+    first, second = transport.timeouts
+    assert first <= 10
+    assert second <= first - 0.05
+
+def test_expired_deadline_sends_nothing():
+    transport = _TimingTransport()
+    op3nvoice.set_key('key')
+    op3nvoice.set_transport(transport)
+    try:
+        op3nvoice.get_bundle('/v1/bundles/1', timeout=Deadline(-1))
+    except DeadlineExceededException:
+        pass
+    else:
+        assert False, 'The expired deadline was not thrown'
+    assert transport.requests == []
@@ -0,0 +1,85 @@
+import time
+import threading
+from transport import Transport
+from hedging import HedgedTransport
+
+class _SlowTransport(Transport):
+    """Answers at once, except the requests numbered in 'slow', which
+    take a second, and those in 'fail', which throw."""
+
+    def __init__(self, slow=(), fail=()):
+        self.slow = slow
+        self.fail = fail
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def request(self, method, path, body='', headers=None, timeout=None):
+        with self._lock:
+            n = self.count
+            self.count += 1
+        if n in self.slow:
+            time.sleep(1)
+        if n in self.fail:
+            raise IOError('request %d failed' % n)
+        return 200, str(n)
+
+def _warm(transport):
+    for i in range(5):
+        transport.request('GET', '/v1/bundles/1')
+
+def test_slow_request_is_hedged():
+    inner = _SlowTransport(slow=[5])
+    transport = HedgedTransport(inner, min_samples=5, budget=1)
+    _warm(transport)
+    assert transport.get_hedge_delay('GET', '/v1/bundles/2') != None
+
+    start = time.time()
+    assert transport.request('GET', '/v1/bundles/2') == (200, '6')
+    assert time.time() - start < 0.5
+    assert transport.hedged == 1
+    assert transport.hedges_won == 1
+
+def test_writes_are_not_hedged():
+    inner = _SlowTransport(slow=[5])
+    transport = HedgedTransport(inner, min_samples=5, budget=1)
+    for i in range(5):
+        transport.request('GET', '/v1/bundles')
+    assert transport.request('POST', '/v1/bundles') == (200, '5')
+    assert transport.hedged == 0
+    assert inner.count == 6
+
+def test_both_attempts_fail():
+    inner = _SlowTransport(slow=[5], fail=[5, 6])
+    transport = HedgedTransport(inner, min_samples=5, budget=1)
+    _warm(transport)
+    try:
+        transport.request('GET', '/v1/bundles/2')
+    except IOError:
+        pass
+    else:
+        assert False, 'The failures were not thrown'
+    assert inner.count == 7
+
+def test_primary_latency_recorded_when_hedge_wins():
+    inner = _SlowTransport(slow=[5])
+    transport = HedgedTransport(inner, min_samples=5, budget=1, window=10)
+    _warm(transport)
+    assert transport.request('GET', '/v1/bundles/2') == (200, '6')
+    assert transport.hedges_won == 1
+    # The slow primary's latency lands once it completes.
+    time.sleep(1.2)
+    latencies = transport._latencies['GET /v1/bundles/{id}']
+    assert len(latencies) == 6
+    assert max(latencies) >= 1
+
+def test_workers_are_reused():
+    inner = _SlowTransport()
+    transport = HedgedTransport(inner, min_samples=5, workers=2)
+    _warm(transport)
+    for i in range(50):
+        assert transport.request('GET', '/v1/bundles/2')[0] == 200
+    # Not a thread per request.
+    assert transport._workers.get_thread_count() <= 2
+    transport.close()
+    # Once closed, requests are sent without a hedge.
+    assert transport.request('GET', '/v1/bundles/2')[0] == 200
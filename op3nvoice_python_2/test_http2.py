@@ -0,0 +1,94 @@
+import socket
+import threading
+import pytest
+import op3nvoice
+import http2
+from loadgen import StandInServer
+
+def _listen(serve):
+    """Returns the 'host:port' of a local server calling 'serve' with
+    each accepted socket."""
+
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(5)
+
+    def accept():
+        while True:
+            conn, address = sock.accept()
+            t = threading.Thread(target=serve, args=(conn,))
+            t.daemon = True
+            t.start()
+
+    t = threading.Thread(target=accept)
+    t.daemon = True
+    t.start()
+    return '127.0.0.1:%d' % sock.getsockname()[1]
+
+def _serve_h2(sock):
+    import h2.config
+    import h2.events
+    import h2.connection
+    config = h2.config.H2Configuration(client_side=False)
+    conn = h2.connection.H2Connection(config)
+    conn.initiate_connection()
+    sock.sendall(conn.data_to_send())
+    while True:
+        data = sock.recv(65535)
+        if not data:
+            break
+        for event in conn.receive_data(data):
+            if isinstance(event, h2.events.RequestReceived):
+                conn.send_headers(event.stream_id,
+                                  [(':status', '200'),
+                                   ('content-length', '2')])
+                conn.send_data(event.stream_id, '{}', end_stream=True)
+        sock.sendall(conn.data_to_send())
+    sock.close()
+
+def _serve_settings(sock):
+    # An empty SETTINGS frame, as an HTTP/2 server starts with.
+    sock.sendall('\x00\x00\x00\x04\x00\x00\x00\x00\x00')
+    sock.recv(65535)
+    sock.close()
+
+def test_fallback_to_http11():
+    server = StandInServer(bundles=25, seed=1)
+    server.start()
+    try:
+        op3nvoice.set_key('key')
+        op3nvoice.use_http2(host=server.get_host(), secure=False)
+        transport = op3nvoice.get_transport()
+        assert isinstance(transport, http2.HTTP2ConnectionPool)
+        assert transport.get_protocol() == 'http/1.1'
+
+        hrefs = [op3nvoice.get_self_href(item)
+                 for page in op3nvoice.iter_bundle_list_pages(limit=10,
+                                                              embed_items=True)
+                 for item in op3nvoice.get_page_items(page)]
+        assert hrefs == server.get_bundle_hrefs()
+        op3nvoice.delete_bundle(hrefs[0])
+        assert len(server.get_bundle_hrefs()) == 24
+    finally:
+        server.stop()
+
+@pytest.mark.skipif(http2.hyper != None, reason='hyper is installed')
+def test_http2_without_hyper():
+    pool = http2.HTTP2ConnectionPool(_listen(_serve_settings), secure=False)
+    try:
+        pool.request('GET', '/v1/bundles')
+    except op3nvoice.APIConfigurationException:
+        pass
+    else:
+        assert False, 'HTTP/2 was used without hyper'
+
+@pytest.mark.skipif(http2.hyper == None, reason='requires hyper')
+def test_http2():
+    pool = http2.HTTP2ConnectionPool(_listen(_serve_h2), secure=False,
+                                     timeout=5)
+    try:
+        assert pool.get_protocol() == 'h2'
+        for i in range(3):
+            assert pool.request('GET', '/v1/bundles') == (200, '{}')
+    finally:
+        pool.close()
@@ -0,0 +1,153 @@
+import time
+import threading
+import op3nvoice
+from transport import MemoryTransport
+import idempotent
+from idempotent import IdempotentCreator, normalize_url
+
+BUNDLE = {'_links': {'self': {'href': '/v1/bundles/1'},
+                     'o3v:tracks': {'href': '/v1/bundles/1/tracks'}}}
+TRACKS = '/v1/bundles/1/tracks'
+
+class _SlowTransport(MemoryTransport):
+    """Holds every request until 'release' is set."""
+
+    def __init__(self):
+        MemoryTransport.__init__(self)
+        self.release = threading.Event()
+
+    def request(self, method, path, body='', headers=None, timeout=None):
+        self.release.wait(5)
+        return MemoryTransport.request(self, method, path, body, headers,
+                                       timeout)
+
+def _use_transport(transport):
+    transport.add('POST', '/v1/bundles', body=BUNDLE)
+    transport.add('POST', TRACKS, body={'track': 1})
+    op3nvoice.set_key('key')
+    op3nvoice.set_transport(transport)
+    return transport
+
+def _posts(transport):
+    return [r for r in transport.requests if r[0] == 'POST']
+
+def test_normalize_url():
+    assert normalize_url(' HTTP://Media.Example.com:80/a.mp3#t=1 ') == \
+        'http://media.example.com/a.mp3'
+    assert normalize_url('https://host:443') == 'https://host/'
+    assert normalize_url('https://host:8443/a?x=1') == \
+        'https://host:8443/a?x=1'
+    assert normalize_url(None) == None
+
+def test_created_once(tmpdir):
+    transport = _use_transport(MemoryTransport())
+    path = str(tmpdir.join('ingest.index'))
+    creator = IdempotentCreator(path)
+    assert creator.create_bundle(name='a', media_url='http://m/1') == BUNDLE
+    assert creator.create_bundle(name='b', media_url='HTTP://M/1#x') == \
+        BUNDLE
+    assert creator.create_track(TRACKS, 'http://m/2') == {'track': 1}
+    assert creator.create_track(TRACKS + '/', 'http://m/2') == {'track': 1}
+    creator.close()
+    assert len(_posts(transport)) == 2
+
+    # The index survives a restart.
+    creator = IdempotentCreator(path)
+    creator.create_bundle(media_url='http://m/1')
+    creator.create_track(TRACKS, 'http://m/2')
+    assert creator.skipped == 2
+    assert len(_posts(transport)) == 2
+
+    # Forgetting a key creates it again.
+    key = creator.get_key(idempotent.BUNDLE, None,
+                          {'media_url': 'http://m/1'})
+    assert creator.get(key) == BUNDLE
+    creator.forget(key)
+    creator.create_bundle(media_url='http://m/1')
+    assert len(_posts(transport)) == 3
+    creator.close()
+
+def test_key_params(tmpdir):
+    transport = _use_transport(MemoryTransport())
+    creator = IdempotentCreator(str(tmpdir.join('ingest.index')),
+                                key_params=['name'])
+    creator.create_bundle(name='a', media_url='http://m/1')
+    creator.create_bundle(name='b', media_url='http://m/1')
+    creator.create_bundle(name='a', media_url='http://m/1')
+    creator.close()
+    assert len(_posts(transport)) == 2
+
+def test_failure_not_recorded(tmpdir):
+    transport = _use_transport(MemoryTransport())
+    transport.add('POST', '/v1/bundles', 503, {'status': 'x',
+                                               'message': 'x', 'code': 503})
+    creator = IdempotentCreator(str(tmpdir.join('ingest.index')))
+    try:
+        creator.create_bundle(media_url='http://m/1')
+    except op3nvoice.APIException:
+        pass
+    else:
+        assert False, 'The failure was not thrown'
+    transport.add('POST', '/v1/bundles', body=BUNDLE)
+    assert creator.create_bundle(media_url='http://m/1') == BUNDLE
+    assert creator.created == 1
+    creator.close()
+
+def test_concurrent_creations_coalesce(tmpdir):
+    transport = _use_transport(_SlowTransport())
+    creator = IdempotentCreator(str(tmpdir.join('ingest.index')))
+    results = []
+
+    def create():
+        results.append(creator.create_bundle(media_url='http://m/1'))
+    threads = [threading.Thread(target=create) for i in range(5)]
+    for t in threads:
+        t.start()
+    while creator.coalesced < 4:
+        time.sleep(0.01)
+    transport.release.set()
+    for t in threads:
+        t.join()
+    creator.close()
+    assert results == [BUNDLE] * 5
+    assert len(_posts(transport)) == 1
+
+def test_bootstrap(tmpdir):
+    transport = _use_transport(MemoryTransport())
+    item = {'_links': {'self': {'href': '/v1/bundles/7'}},
+            '_embedded': {'o3v:tracks': {'tracks': [
+                {'track': 1, 'media_url': 'http://m/7b'},
+                {'track': 0, 'media_url': 'http://m/7a'}]}}}
+    transport.add('GET', '/v1/bundles', body={
+        '_embedded': {'items': [item]},
+        '_links': {'self': {'href': '/v1/bundles'}}})
+    creator = IdempotentCreator(str(tmpdir.join('ingest.index')))
+    assert creator.bootstrap() == 3
+
+    # Recorded under the media URL of its first track.
+    bundle = creator.create_bundle(media_url='http://m/7a')
+    assert op3nvoice.get_self_href(bundle) == '/v1/bundles/7'
+    assert bundle['_links']['o3v:tracks']['href'] == '/v1/bundles/7/tracks'
+    creator.create_track('/v1/bundles/7/tracks', 'http://m/7b')
+    creator.close()
+    assert _posts(transport) == []
+
+def test_bootstrap_skips_tracks_without_media(tmpdir):
+    transport = _use_transport(MemoryTransport())
+    item = {'_links': {'self': {'href': '/v1/bundles/7'}},
+            'tracks': [{'track': 0}, {'track': 1, 'media_url': 'http://m/7'}]}
+    transport.add('GET', '/v1/bundles', body={
+        '_embedded': {'items': [item]},
+        '_links': {'self': {'href': '/v1/bundles'}}})
+    path = str(tmpdir.join('ingest.index'))
+    creator = IdempotentCreator(path, sync=False)
+    assert creator.bootstrap() == 2
+    # Already recorded: bootstrapping again adds nothing.
+    assert creator.bootstrap() == 0
+    creator.close()
+
+    creator = IdempotentCreator(path)
+    bundle = creator.create_bundle(media_url='http://m/7')
+    creator.close()
+    assert op3nvoice.get_self_href(bundle) == '/v1/bundles/7'
+    assert _posts(transport) == []
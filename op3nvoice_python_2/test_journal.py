@@ -0,0 +1,148 @@
+import json
+import urlparse
+import op3nvoice
+from transport import MemoryTransport
+from journal import WriteJournal, CREATE_BUNDLE
+
+BUNDLE = {'_links': {'self': {'href': '/v1/bundles/1'},
+                     'o3v:tracks': {'href': '/v1/bundles/1/tracks'}}}
+TRACKS = '/v1/bundles/1/tracks'
+
+class _FlakyTransport(MemoryTransport):
+    """Answers the first 'failures' requests with 'status'."""
+
+    def __init__(self, failures, status=503):
+        MemoryTransport.__init__(self)
+        self.failures = failures
+        self.status = status
+
+    def request(self, method, path, body='', headers=None, timeout=None):
+        if self.failures > 0:
+            self.failures -= 1
+            self.requests.append((method, path, body))
+            return self.status, json.dumps({'status': 'Error',
+                                            'message': 'Try again.',
+                                            'code': self.status})
+        return MemoryTransport.request(self, method, path, body, headers,
+                                       timeout)
+
+def _use_transport(transport):
+    transport.add('POST', '/v1/bundles', body=BUNDLE)
+    transport.add('POST', TRACKS, body={'track': 1})
+    op3nvoice.set_key('key')
+    op3nvoice.set_transport(transport)
+    return transport
+
+def _journal(tmpdir, **kwargs):
+    args = {'backoff': 0.01, 'sync': False}
+    args.update(kwargs)
+    return WriteJournal(str(tmpdir.join('writes.journal')), **args)
+
+def test_deliver(tmpdir):
+    transport = _use_transport(MemoryTransport())
+    journal = _journal(tmpdir)
+    try:
+        future = journal.create_bundle(name='Show', media_url='http://m/1')
+        assert future.result(5) == BUNDLE
+        assert journal.wait(5)
+        assert journal.get_pending_count() == 0
+        assert journal.delivered == 1
+    finally:
+        journal.close()
+    assert [r[:2] for r in transport.requests] == [('POST', '/v1/bundles')]
+    assert urlparse.parse_qs(transport.requests[0][2])['name'] == ['Show']
+
+def test_replay_and_compaction(tmpdir):
+    path = tmpdir.join('writes.journal')
+    path.write(json.dumps({'id': 1, 'call': CREATE_BUNDLE,
+                           'args': {'name': 'a'}}) + '\n' +
+               json.dumps({'id': 2, 'call': CREATE_BUNDLE,
+                           'args': {'name': 'b'}}) + '\n' +
+               json.dumps({'id': 1, 'ack': True}) + '\n' +
+               '{"id": 3, "ca')
+
+    # Only the unacknowledged entry is left after compaction.
+    transport = _use_transport(MemoryTransport())
+    journal = _journal(tmpdir, concurrency=1)
+    assert journal.wait(5)
+    journal.close()
+    assert len(transport.requests) == 1
+    assert urlparse.parse_qs(transport.requests[0][2])['name'] == ['b']
+
+    transport = _use_transport(MemoryTransport())
+    journal = _journal(tmpdir)
+    assert journal.get_pending_count() == 0
+    journal.close()
+    assert transport.requests == []
+
+def test_transient_failures_retry(tmpdir):
+    transport = _use_transport(_FlakyTransport(2))
+    journal = _journal(tmpdir)
+    try:
+        assert journal.create_bundle(name='a').result(5) == BUNDLE
+        assert journal.retried == 2
+    finally:
+        journal.close()
+    assert len(transport.requests) == 3
+
+def test_out_of_retries_stays(tmpdir):
+    errors = []
+    _use_transport(_FlakyTransport(2))
+    journal = _journal(tmpdir, retries=1,
+                       on_error=lambda *args: errors.append(args))
+    future = journal.create_bundle(name='a')
+    assert isinstance(future.exception(5), op3nvoice.APIException)
+    journal.close()
+    assert [e[:2] for e in errors] == [(CREATE_BUNDLE, {'name': 'a',
+                                                        'media_url': None,
+                                                        'audio_channel': None,
+                                                        'metadata': None,
+                                                        'notify_url': None})]
+
+    # Delivered by the next run.
+    transport = _use_transport(MemoryTransport())
+    journal = _journal(tmpdir)
+    assert journal.wait(5)
+    journal.close()
+    assert journal.delivered == 1
+    assert len(transport.requests) == 1
+
+def test_permanent_failure_is_dropped(tmpdir):
+    _use_transport(_FlakyTransport(1, 400))
+    journal = _journal(tmpdir)
+    future = journal.create_bundle(name='a')
+    e = future.exception(5)
+    assert e.get_http_response() == 400
+    assert journal.wait(5)
+    journal.close()
+    assert journal.failed == 1
+    assert journal.retried == 0
+
+    transport = _use_transport(MemoryTransport())
+    journal = _journal(tmpdir)
+    journal.close()
+    assert transport.requests == []
+
+def test_same_href_in_order(tmpdir):
+    transport = _use_transport(MemoryTransport())
+    journal = _journal(tmpdir, concurrency=4)
+    try:
+        futures = [journal.create_track(TRACKS, 'http://m/%d' % i)
+                   for i in range(20)]
+        for future in futures:
+            assert future.result(5) == {'track': 1}
+    finally:
+        journal.close()
+    urls = [urlparse.parse_qs(r[2])['media_url'][0]
+            for r in transport.requests]
+    assert urls == ['http://m/%d' % i for i in range(20)]
+
+def test_closed(tmpdir):
+    journal = _journal(tmpdir)
+    journal.close()
+    try:
+        journal.create_bundle(name='a')
+    except op3nvoice.APIConfigurationException:
+        pass
+    else:
+        assert False, 'A closed journal accepted a call'
@@ -0,0 +1,78 @@
+import itertools
+import op3nvoice
+from connection import ConnectionPool
+from loadgen import StandInServer, LoadGenerator, synthetic_operations
+
+def _start(**kwargs):
+    server = StandInServer(seed=1, **kwargs)
+    server.start()
+    op3nvoice.set_key('key')
+    op3nvoice.set_transport(ConnectionPool(server.get_host(), secure=False))
+    return server
+
+def test_stand_in_delete_bundle():
+    server = _start(bundles=3)
+    try:
+        href = server.get_bundle_hrefs()[0]
+        assert op3nvoice.delete_bundle(href) == None
+        assert href not in server.get_bundle_hrefs()
+        try:
+            op3nvoice.get_bundle(href)
+        except op3nvoice.APIException, e:
+            assert e.get_http_response() == 404
+        else:
+            assert False, 'The bundle was not deleted'
+    finally:
+        server.stop()
+
+def test_stand_in_paging():
+    server = _start(bundles=25)
+    try:
+        hrefs = [op3nvoice.get_self_href(item)
+                 for page in op3nvoice.iter_bundle_list_pages(limit=10,
+                                                              embed_items=True)
+                 for item in op3nvoice.get_page_items(page)]
+        assert hrefs == server.get_bundle_hrefs()
+    finally:
+        server.stop()
+
+def test_load_generator():
+    server = _start(bundles=50)
+    try:
+        operations = synthetic_operations(server.get_bundle_hrefs(), seed=2)
+        generator = LoadGenerator(operations, concurrency=4, duration=1,
+                                  interval=0.5)
+        report = generator.run()
+        assert report.total.requests > 0
+        assert report.total.errors == 0, report.errors
+        assert len(report.intervals) >= 2
+    finally:
+        server.stop()
+
+def test_load_generator_deletes():
+    server = _start(bundles=20)
+    try:
+        operations = [('delete_bundle', {'href': href})
+                      for href in server.get_bundle_hrefs()]
+        generator = LoadGenerator(iter(operations), concurrency=2,
+                                  duration=5)
+        report = generator.run()
+        assert report.total.requests == 20
+        assert report.total.errors == 0, report.errors
+        assert server.get_bundle_hrefs() == []
+    finally:
+        server.stop()
+
+def test_error_rate():
+    server = _start(bundles=10, error_rate=1)
+    try:
+        operations = itertools.repeat(('get_bundle_list', {}), 5)
+        report = LoadGenerator(operations, concurrency=1, duration=5).run()
+        assert report.total.errors == 5
+        # Counted by the message of the API's error response.
+        assert len(report.errors) == 1
+        error = report.errors.keys()[0]
+        assert error.startswith('get_bundle_list: ')
+        assert 'APIException' not in error
+    finally:
+        server.stop()
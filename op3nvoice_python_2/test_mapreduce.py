@@ -0,0 +1,59 @@
+import threading
+import op3nvoice
+from transport import MemoryTransport
+from mapreduce import map_reduce, MapperException
+
+def _use_bundles(count):
+    transport = MemoryTransport()
+    items = [{'id': i, 'name': 'b%d' % i} for i in range(count)]
+    half = count // 2
+    transport.add('GET', '/v1/bundles',
+                  body={'_embedded': {'items': items[:half]},
+                        '_links': {'next': {'href': '/v1/bundles/p2'}}})
+    transport.add('GET', '/v1/bundles/p2',
+                  body={'_embedded': {'items': items[half:]}, '_links': {}})
+    op3nvoice.set_key('key')
+    op3nvoice.set_transport(transport)
+
+def _get_id(bundle):
+    return bundle['id']
+
+def _fail(bundle):
+    raise ValueError('bad bundle')
+
+def _run(function, *args, **kwargs):
+    """Returns what 'function' returned or raised, failing if it doesn't
+    complete in time."""
+
+    outcome = []
+
+    def run():
+        try:
+            outcome.append(function(*args, **kwargs))
+        except Exception, e:
+            outcome.append(e)
+
+    t = threading.Thread(target=run)
+    t.daemon = True
+    t.start()
+    t.join(30)
+    assert len(outcome) == 1, 'map_reduce() did not complete'
+    return outcome[0]
+
+def test_map_reduce():
+    _use_bundles(120)
+    result = _run(map_reduce, _get_id, lambda total, v: total + v, 0,
+                  processes=2, batch_size=7)
+    assert result == sum(range(120))
+
+def test_mapper_exception():
+    _use_bundles(10)
+    result = _run(map_reduce, _fail, lambda total, v: total, 0, processes=2)
+    assert isinstance(result, MapperException)
+    assert 'bad bundle' in result.get_message()
+
+def test_unpicklable_mapper():
+    _use_bundles(10)
+    result = _run(map_reduce, lambda b: 1, lambda total, v: total + v, 0,
+                  processes=2)
+    assert isinstance(result, MapperException)
@@ -0,0 +1,71 @@
+import op3nvoice
+from transport import MemoryTransport
+from metadatamirror import MetadataMirror, SORTED
+
+def _mirror():
+    mirror = MetadataMirror()
+    mirror.add_index('show', 'show')
+    mirror.add_index('episode', 'episode', SORTED)
+    mirror.add_index('language', 'languages', multi=True)
+    mirror.add_index('host', 'credits.host')
+    return mirror
+
+def test_indexes():
+    mirror = _mirror()
+    mirror.put('/v1/bundles/1', {'show': 'Nightly', 'episode': 12,
+                                 'languages': ['en', 'fr'],
+                                 'credits': {'host': 'Sam'}})
+    mirror.put('/v1/bundles/2', {'show': 'Nightly', 'episode': 3,
+                                 'languages': ['en']})
+    mirror.put('/v1/bundles/3', {'show': 'Weekly', 'episode': 20})
+
+    assert sorted(mirror.find('show', 'Nightly')) == ['/v1/bundles/1',
+                                                      '/v1/bundles/2']
+    assert sorted(mirror.find('language', 'en')) == ['/v1/bundles/1',
+                                                     '/v1/bundles/2']
+    assert mirror.find('language', 'fr') == ['/v1/bundles/1']
+    assert mirror.find('host', 'Sam') == ['/v1/bundles/1']
+    assert mirror.find_range('episode', 3, 20) == ['/v1/bundles/2',
+                                                   '/v1/bundles/1']
+    assert mirror.find_range('episode', 3, 20, False, True) == \
+        ['/v1/bundles/1', '/v1/bundles/3']
+    assert mirror.find_range('episode', low=13) == ['/v1/bundles/3']
+
+def test_updates_reindex():
+    mirror = _mirror()
+    mirror.put('/v1/bundles/1', {'show': 'Nightly'}, version=2)
+    assert not mirror.put('/v1/bundles/1', {'show': 'Old'}, version=1)
+    assert mirror.find('show', 'Old') == []
+    assert mirror.put('/v1/bundles/1', {'show': 'Weekly'}, version=3)
+    assert mirror.find('show', 'Nightly') == []
+    assert mirror.find('show', 'Weekly') == ['/v1/bundles/1']
+    mirror.remove('/v1/bundles/1')
+    assert mirror.find('show', 'Weekly') == []
+    assert mirror.get('/v1/bundles/1') == None
+
+def test_index_added_later():
+    mirror = MetadataMirror()
+    mirror.put('/v1/bundles/1', {'show': 'Nightly'})
+    mirror.add_index('show', 'show')
+    assert mirror.find('show', 'Nightly') == ['/v1/bundles/1']
+
+def test_load_and_update():
+    transport = MemoryTransport()
+    transport.add('GET', '/v1/bundles',
+                  body={'_embedded': {'items': [
+                      {'href': '/v1/bundles/1',
+                       '_embedded': {'o3v:metadata': {
+                           'data': '{"show": "Nightly"}', 'version': 1}}},
+                      {'href': '/v1/bundles/2'}]},
+                        '_links': {}})
+    transport.add('PUT', '/v1/bundles/1/metadata', 200, {'version': 2})
+    op3nvoice.set_key('key')
+    op3nvoice.set_transport(transport)
+
+    mirror = _mirror()
+    assert mirror.load() == 1
+    assert mirror.find('show', 'Nightly') == ['/v1/bundles/1']
+
+    mirror.update('/v1/bundles/1', {'show': 'Weekly'}, 1)
+    assert mirror.get('/v1/bundles/1') == {'show': 'Weekly'}
+    assert mirror.find('show', 'Weekly') == ['/v1/bundles/1']
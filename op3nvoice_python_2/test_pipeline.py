@@ -0,0 +1,54 @@
+import time
+import op3nvoice
+from transport import MemoryTransport
+from pipeline import Pipeline, Stage, bundle_source
+
+def _fail_on_3(n):
+    if n == 3:
+        raise ValueError('bad item')
+    return n
+
+def test_stages():
+    p = Pipeline(xrange(100), [Stage('double', lambda n: n * 2, 4),
+                               Stage('split', lambda n: [n, n + 1], 2,
+                                     expand=True)],
+                 queue_size=5)
+    assert sorted(p.run()) == range(200)
+    metrics = p.get_metrics()
+    assert [m.name for m in metrics] == ['double', 'split']
+    assert [m.processed for m in metrics] == [100, 100]
+    assert [m.errors for m in metrics] == [0, 0]
+
+def test_stage_exception():
+    p = Pipeline(xrange(100), [Stage('check', _fail_on_3, 2)])
+    try:
+        list(p.run())
+    except ValueError, e:
+        assert str(e) == 'bad item'
+    else:
+        assert False, 'The exception was not re-thrown'
+    assert p.is_cancelled()
+    assert p.get_metrics()[0].errors == 1
+
+def test_abandoned_run_stops_workers():
+    def slow(n):
+        time.sleep(0.01)
+        return n
+
+    p = Pipeline(xrange(1000000), [Stage('slow', slow, 2)], queue_size=2)
+    results = p.run()
+    assert results.next() in (0, 1)
+    results.close()
+    assert p.is_cancelled()
+    assert p.get_metrics()[0].processed < 100
+
+def test_bundle_source():
+    transport = MemoryTransport()
+    transport.add('GET', '/v1/bundles',
+                  body={'_embedded': {'items': [{'id': 1}]},
+                        '_links': {'next': {'href': '/v1/bundles/p2'}}})
+    transport.add('GET', '/v1/bundles/p2',
+                  body={'_embedded': {'items': [{'id': 2}]}, '_links': {}})
+    op3nvoice.set_key('key')
+    op3nvoice.set_transport(transport)
+    assert list(bundle_source(embed_items=True)) == [{'id': 1}, {'id': 2}]
@@ -0,0 +1,58 @@
+import json
+import op3nvoice
+from transport import MemoryTransport
+
+def _use_transport():
+    transport = MemoryTransport()
+    transport.add('GET', '/v1/bundles/1', body={'name': 'b1'})
+    transport.add('GET', '/v1/search',
+                  body={'_embedded': {'items': []}, '_links': {}})
+    op3nvoice.set_key('key')
+    op3nvoice.set_transport(transport)
+    return op3nvoice.enable_profiling()
+
+def test_phases():
+    profiler = _use_transport()
+    try:
+        op3nvoice.get_bundle('/v1/bundles/1')
+        stats = profiler.get_stats()['GET /v1/bundles/{id}']
+        assert stats['request'].count == 1
+        assert stats['decode'].count == 1
+    finally:
+        op3nvoice.disable_profiling()
+
+def test_cached_decode_is_not_attributed():
+    profiler = _use_transport()
+    op3nvoice.enable_search_cache()
+    try:
+        op3nvoice.search(query='x')
+        # A call without a decode, followed by a decode without a call.
+        try:
+            op3nvoice.get_bundle('/v1/bundles/2')
+        except op3nvoice.APIException:
+            pass
+        op3nvoice.search(query='x')
+
+        stats = profiler.get_stats()
+        assert stats['GET /v1/search']['decode'].count == 1
+        assert stats['GET /v1/bundles/{id}']['request'].count == 1
+        assert 'decode' not in stats['GET /v1/bundles/{id}']
+    finally:
+        op3nvoice.disable_search_cache()
+        op3nvoice.disable_profiling()
+
+def test_output(tmpdir):
+    profiler = _use_transport()
+    try:
+        op3nvoice.get_bundle('/v1/bundles/1')
+        path = str(tmpdir.join('trace.json'))
+        profiler.write_chrome_trace(path)
+        events = json.load(open(path))['traceEvents']
+        assert [e['name'] for e in events] == ['GET /v1/bundles/{id}',
+                                               'decode']
+        path = str(tmpdir.join('calls.folded'))
+        profiler.write_folded(path)
+        lines = open(path).read().splitlines()
+        assert lines[0].startswith('GET_/v1/bundles/{id};decode ')
+    finally:
+        op3nvoice.disable_profiling()
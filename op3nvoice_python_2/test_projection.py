@@ -0,0 +1,45 @@
+import op3nvoice
+from transport import MemoryTransport
+
+BUNDLE = {'name': 'b1', 'id': 1,
+          '_links': {'self': {'href': '/v1/bundles/1'}},
+          'tracks': [{'status': 'done', 'size': 10},
+                     {'status': 'failed', 'size': 20}]}
+
+def _use_transport():
+    transport = MemoryTransport()
+    transport.add('GET', '/v1/bundles/1', body=BUNDLE)
+    transport.add('GET', '/v1/bundles',
+                  body={'_embedded': {'items': [BUNDLE]},
+                        '_links': {'self': {'href': '/v1/bundles'},
+                                   'next': {'href': '/v1/bundles/p2'}},
+                        'total': 2})
+    op3nvoice.set_key('key')
+    op3nvoice.set_transport(transport)
+
+def test_get_bundle_fields():
+    _use_transport()
+    bundle = op3nvoice.get_bundle('/v1/bundles/1',
+                                  fields=['name', 'tracks.status'])
+    assert bundle == {'name': 'b1',
+                      'tracks': [{'status': 'done'}, {'status': 'failed'}]}
+    # A comma separated string works too.
+    assert op3nvoice.get_bundle('/v1/bundles/1', fields='id') == {'id': 1}
+
+def test_list_fields_keep_paging():
+    _use_transport()
+    page = op3nvoice.get_bundle_list(embed_items=True, fields=['id'])
+    assert op3nvoice.get_page_items(page) == [{'id': 1}]
+    assert op3nvoice.get_next_href(page) == '/v1/bundles/p2'
+    assert page['total'] == 2
+
+def test_no_fields():
+    _use_transport()
+    assert op3nvoice.get_bundle('/v1/bundles/1') == BUNDLE
+
+def test_projection_cache_is_bounded():
+    first = op3nvoice._get_projection(['name', 'tracks.status'])
+    assert op3nvoice._get_projection(' tracks.status,name') is first
+    for i in range(2 * op3nvoice._MAX_PROJECTIONS):
+        op3nvoice._get_projection(['field%d' % i])
+    assert len(op3nvoice._projections) == op3nvoice._MAX_PROJECTIONS
@@ -0,0 +1,106 @@
+import time
+import threading
+import op3nvoice
+from transport import MemoryTransport
+from searchcache import SearchCache
+
+def _counter(pages):
+    """Returns a fetch function returning the next of 'pages' on each
+    call."""
+
+    pages = list(pages)
+    return lambda timeout: pages.pop(0)
+
+def test_key():
+    cache = SearchCache()
+    assert cache.get_key('/v1/search', {'query': ' a   b ', 'limit': 10,
+                                        'embed': 'tracks,items'}) == \
+        cache.get_key('/v1/search', {'embed': ['items,tracks'],
+                                     'limit': ['10'], 'query': 'a b'})
+
+def test_ttl():
+    cache = SearchCache(ttl=0.05)
+    fetch = _counter(['p1', 'p2'])
+    assert cache.get('k', fetch) == 'p1'
+    assert cache.get('k', fetch) == 'p1'
+    time.sleep(0.1)
+    assert cache.get('k', fetch) == 'p2'
+    stats = cache.get_stats()
+    assert (stats.hits, stats.misses) == (1, 2)
+
+def test_stale_while_revalidate():
+    cache = SearchCache(ttl=0.2, stale_ttl=10)
+    fetch = _counter(['p1', 'p2'])
+    cache.get('k', fetch)
+    time.sleep(0.25)
+    # The stale page is served while the fresh one is retrieved.
+    assert cache.get('k', fetch) == 'p1'
+    time.sleep(0.05)
+    assert cache.get('k', fetch) == 'p2'
+    stats = cache.get_stats()
+    assert (stats.hits, stats.stale_hits) == (1, 1)
+
+def test_invalidate_during_revalidation():
+    cache = SearchCache(ttl=0.05, stale_ttl=10)
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow(timeout):
+        started.set()
+        release.wait(5)
+        return 'old account'
+    cache.get('k', lambda t: 'p1')
+    time.sleep(0.1)
+    assert cache.get('k', slow) == 'p1'
+    assert started.wait(5)
+    # E.g. set_key() while the refresh is in flight.
+    cache.invalidate()
+    release.set()
+    time.sleep(0.05)
+    assert cache.get_stats().entries == 0
+    assert cache.get('k', lambda t: 'new account') == 'new account'
+
+def test_invalidate_during_fetch():
+    cache = SearchCache()
+
+    def fetch(timeout):
+        cache.invalidate()
+        return 'old account'
+    assert cache.get('k', fetch) == 'old account'
+    assert cache.get_stats().entries == 0
+
+def test_lru_eviction():
+    cache = SearchCache(max_entries=2)
+    for key in ('a', 'b'):
+        cache.get(key, lambda t: key)
+    cache.get('a', None)
+    cache.get('c', lambda t: 'c')
+    # 'b' was the least recently used.
+    assert cache.get('a', None) == 'a'
+    assert cache.get('b', lambda t: 'B') == 'B'
+    assert cache.get_stats().evictions == 2
+
+def test_max_bytes():
+    cache = SearchCache(max_bytes=1000)
+    cache.get('big', lambda t: 'x' * 2000)
+    assert cache.get_stats().entries == 0
+    for i in range(5):
+        cache.get(i, lambda t: 'x' * 300)
+    assert cache.get_stats().bytes <= 1000
+
+def test_enable_search_cache():
+    transport = MemoryTransport()
+    transport.add('GET', '/v1/search', body={'_links': {}})
+    op3nvoice.set_key('key')
+    op3nvoice.set_transport(transport)
+    op3nvoice.enable_search_cache()
+    try:
+        op3nvoice.search(query='meeting', limit=5)
+        op3nvoice.search(query=' meeting ', limit=5)
+        assert len(transport.requests) == 1
+        # A new key may see another account.
+        op3nvoice.set_key('other')
+        op3nvoice.search(query='meeting', limit=5)
+        assert len(transport.requests) == 2
+    finally:
+        op3nvoice.disable_search_cache()
@@ -0,0 +1,66 @@
+import pytest
+import op3nvoice
+import tracktable
+from transport import MemoryTransport
+from tracktable import TrackTable
+
+TRACKS = [{'track': 0, 'status': 'processed', 'mime_type': 'audio/mpeg',
+           'size': 100, 'duration': 10.0},
+          {'track': 1, 'status': 'processed', 'mime_type': 'audio/wav',
+           'size': 300, 'duration': 30.0},
+          {'track': 2, 'status': 'failed', 'mime_type': 'audio/mpeg',
+           'size': 200}]
+
+@pytest.fixture(params=['numpy', 'python'])
+def table(request, monkeypatch):
+    if request.param == 'numpy':
+        if tracktable.numpy == None:
+            pytest.skip('requires numpy')
+    else:
+        monkeypatch.setattr(tracktable, 'numpy', None)
+    table = TrackTable()
+    table.add_track_list({'tracks': TRACKS}, '/v1/bundles/1')
+    return table
+
+def test_aggregates(table):
+    assert len(table) == 3
+    assert table.count() == 3
+    assert table.count(status='processed') == 2
+    assert table.count(status='processed', mime_type='audio/mpeg') == 1
+    assert table.count(status='unknown') == 0
+    assert table.sum('size') == 600
+    assert table.sum('duration', status='processed') == 40
+    assert table.group_by_count('mime_type') == {'audio/mpeg': 2,
+                                                 'audio/wav': 1}
+    assert table.group_by_sum('status', 'size') == {'processed': 400,
+                                                    'failed': 200}
+    assert table.get_values('bundle') == ['/v1/bundles/1']
+
+def test_percentile(table):
+    assert table.percentile('size', 0) == 100
+    assert table.percentile('size', 50) == 200
+    assert table.percentile('size', 75) == 250
+    assert table.percentile('size', 100) == 300
+    assert table.percentile('size', 50, status='unknown') == None
+
+def test_collect():
+    transport = MemoryTransport()
+    transport.add('GET', '/v1/bundles',
+                  body={'_embedded': {'items': [
+                      {'href': '/v1/bundles/1', 'tracks': TRACKS[:2]},
+                      {'href': '/v1/bundles/2', 'tracks': TRACKS[2:]}]},
+                        '_links': {}})
+    op3nvoice.set_key('key')
+    op3nvoice.set_transport(transport)
+    table = TrackTable.collect()
+    assert len(table) == 3
+    assert table.group_by_count('bundle') == {'/v1/bundles/1': 2,
+                                              '/v1/bundles/2': 1}
+
+def test_column_is_a_copy(table):
+    sizes = table.get_column('size')
+    # The table can still grow, and the copy doesn't change.
+    table.add_track({'track': 3, 'status': 'processed', 'size': 50})
+    assert list(sizes) == [100, 300, 200]
+    assert list(table.get_column('size')) == [100, 300, 200, 50]
+    assert table.sum('size') == 650
@@ -0,0 +1,63 @@
+import json
+from transport import MemoryTransport, CassetteTransport
+from transport import CassetteMissException, get_endpoint
+
+def test_memory_transport():
+    transport = MemoryTransport()
+    transport.add('GET', '/v1/bundles', body={'total': 0})
+    transport.add('GET', '/v1/bundles?limit=1', body='exact')
+    assert transport.request('GET', '/v1/bundles?limit=1') == (200, 'exact')
+    assert transport.request('GET', '/v1/bundles?limit=2') == \
+        (200, '{"total": 0}')
+    assert transport.request('DELETE', '/v1/bundles')[0] == 404
+    assert len(transport.requests) == 3
+
+def test_get_endpoint():
+    uuid = '123e4567-e89b-12d3-a456-426614174000'
+    assert get_endpoint('GET', '/v1/bundles/123/tracks?limit=1') == \
+        'GET /v1/bundles/{id}/tracks'
+    assert get_endpoint('GET', '/v1/bundles/5f2b9c1e0a7d/metadata') == \
+        'GET /v1/bundles/{id}/metadata'
+    assert get_endpoint('DELETE', '/v1/bundles/' + uuid) == \
+        'DELETE /v1/bundles/{id}'
+    # Names holding digits aren't ids.
+    assert get_endpoint('GET', '/v1/formats/mp3') == 'GET /v1/formats/mp3'
+    assert get_endpoint('GET', '/v2beta/bundles') == 'GET /v2beta/bundles'
+
+def test_cassette_round_trip(tmpdir):
+    path = str(tmpdir.join('cassette.jsonl'))
+    body = '\xff\xfe not utf-8 \x00'
+    memory = MemoryTransport()
+    memory.add('GET', '/v1/bundles/1', body=body)
+    memory.add('GET', '/v1/bundles/2', body={'name': u'caf\xe9'})
+
+    recorder = CassetteTransport(path, 'record', memory)
+    assert recorder.request('GET', '/v1/bundles/1') == (200, body)
+    expected = recorder.request('GET', '/v1/bundles/2')
+    recorder.close()
+
+    player = CassetteTransport(path)
+    assert player.request('GET', '/v1/bundles/1') == (200, body)
+    assert player.request('GET', '/v1/bundles/2') == expected
+    try:
+        player.request('GET', '/v1/bundles/3')
+    except CassetteMissException:
+        pass
+    else:
+        assert False, 'A missing interaction was served'
+
+def test_cassette_replays_in_order(tmpdir):
+    path = str(tmpdir.join('cassette.jsonl'))
+    f = open(path, 'wb')
+    for status in (503, 200):
+        # A cassette recorded before bodies were base64 encoded.
+        f.write(json.dumps({'method': 'GET', 'path': '/v1/bundles',
+                            'body': '', 'status': status,
+                            'response': u'{"name": "caf\xe9"}'}) + '\n')
+    f.close()
+
+    player = CassetteTransport(path)
+    assert player.request('GET', '/v1/bundles')[0] == 503
+    for i in range(2):
+        assert player.request('GET', '/v1/bundles') == \
+            (200, '{"name": "caf\xc3\xa9"}')
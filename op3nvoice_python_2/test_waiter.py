@@ -0,0 +1,122 @@
+import time
+import op3nvoice
+import waiter
+from transport import Transport, MemoryTransport
+from waiter import TrackWaiter
+
+DONE = [{'status': 'processed'}]
+PENDING = [{'status': 'processing'}]
+
+def _use(transport, monkeypatch):
+    monkeypatch.setattr(waiter, 'MIN_DELAY', 0.01)
+    op3nvoice.set_key('key')
+    op3nvoice.set_transport(transport)
+
+def _bundle(i, tracks=DONE):
+    return {'_links': {'self': {'href': '/v1/bundles/%d' % i}},
+            'tracks': tracks}
+
+def _wait(hrefs):
+    w = TrackWaiter(timeout=10)
+    futures = [w.add(href) for href in hrefs]
+    # So that every bundle is due on the first round.
+    time.sleep(0.05)
+    w.start()
+    return w, futures
+
+def test_check_bundles(monkeypatch):
+    transport = MemoryTransport()
+    transport.add('GET', '/v1/bundles/1', body=_bundle(1))
+    _use(transport, monkeypatch)
+    w, futures = _wait(['/v1/bundles/1'])
+    assert futures[0].result(5) == DONE
+    assert w.get_pending_count() == 0
+    w.stop()
+
+def test_missing_bundle_fails(monkeypatch):
+    transport = MemoryTransport()
+    transport.add('GET', '/v1/bundles/1', body=_bundle(1))
+    _use(transport, monkeypatch)
+    w, futures = _wait(['/v1/bundles/1', '/v1/bundles/2'])
+    assert futures[0].result(5) == DONE
+    try:
+        futures[1].result(5)
+    except op3nvoice.APIException, e:
+        assert e.get_http_response() == 404
+    else:
+        assert False, 'The missing bundle did not fail'
+    w.stop()
+
+def _add_pages(transport, first, pages, per_page=2):
+    for n in range(pages):
+        items = [_bundle(n * per_page + i) for i in range(per_page)]
+        page = {'_embedded': {'items': items}, '_links': {}}
+        if n + 1 < pages:
+            page['_links']['next'] = {'href': '/v1/pages/%d' % (n + 1)}
+        transport.add('GET', '/v1/pages/%d' % n if n else first, body=page)
+
+def _requests(transport):
+    return [path.split('?')[0] for method, path, body in transport.requests]
+
+def test_page_scan_covers_listing(monkeypatch):
+    transport = MemoryTransport()
+    _add_pages(transport, '/v1/bundles', 12)
+    _use(transport, monkeypatch)
+
+    # Bundle 1000 is in no page: it is only checked on its own once the
+    # whole listing was scanned.
+    hrefs = ['/v1/bundles/%d' % n for n in range(24)] + \
+            ['/v1/bundles/1000']
+    w, futures = _wait(hrefs)
+    for future in futures[:-1]:
+        assert future.result(5) == DONE
+    assert futures[-1].exception(5)
+    w.stop()
+    assert _requests(transport) == \
+        ['/v1/bundles'] + ['/v1/pages/%d' % n for n in range(1, 12)] + \
+        ['/v1/bundles/1000']
+
+def test_page_scan_stops_once_all_seen(monkeypatch):
+    transport = MemoryTransport()
+    _add_pages(transport, '/v1/bundles', 12)
+    _use(transport, monkeypatch)
+
+    # Every due bundle is in the first 8 pages.
+    w, futures = _wait(['/v1/bundles/%d' % n for n in range(16)])
+    for future in futures:
+        assert future.result(5) == DONE
+    w.stop()
+    assert _requests(transport) == \
+        ['/v1/bundles'] + ['/v1/pages/%d' % n for n in range(1, 8)]
+
+def test_page_scan_uses_query(monkeypatch):
+    transport = MemoryTransport()
+    _add_pages(transport, '/v1/search', 6)
+    _use(transport, monkeypatch)
+    w = TrackWaiter(timeout=10, query='show')
+    futures = [w.add('/v1/bundles/%d' % n) for n in range(12)]
+    time.sleep(0.05)
+    w.start()
+    for future in futures:
+        assert future.result(5) == DONE
+    w.stop()
+    assert _requests(transport) == \
+        ['/v1/search'] + ['/v1/pages/%d' % n for n in range(1, 6)]
+    assert 'query=show' in transport.requests[0][1]
+
+def test_unexpected_exception_fails_all(monkeypatch):
+    class BrokenTransport(Transport):
+        def request(self, method, path, body='', headers=None,
+                    timeout=None):
+            raise RuntimeError('broken')
+
+    _use(BrokenTransport(), monkeypatch)
+    w, futures = _wait(['/v1/bundles/1', '/v1/bundles/2'])
+    for future in futures:
+        try:
+            future.result(5)
+        except RuntimeError:
+            pass
+        else:
+            assert False, 'The future was not failed'
+    w.stop()
@@ -0,0 +1,85 @@
+import json
+import urllib2
+import urlparse
+import op3nvoice
+from transport import MemoryTransport
+from webhook import NotificationReceiver
+
+def _notify(url, data):
+    request = urllib2.Request(url, json.dumps(data),
+                              {'Content-Type': 'application/json'})
+    return urllib2.urlopen(request, timeout=5).getcode()
+
+class _NotifyingTransport(MemoryTransport):
+    """Sends the notification before answering the create_bundle()
+    request, as a fast API could."""
+
+    def request(self, method, path, body='', headers=None, timeout=None):
+        if method == 'POST' and path == '/v1/bundles':
+            _notify(urlparse.parse_qs(body)['notify_url'][0],
+                    {'status': 'done'})
+        return MemoryTransport.request(self, method, path, body, headers,
+                                       timeout)
+
+def _start():
+    receiver = NotificationReceiver(host='127.0.0.1')
+    receiver.start()
+    return receiver
+
+def test_wildcard_requires_public_url():
+    try:
+        NotificationReceiver()
+    except op3nvoice.APIConfigurationException:
+        pass
+    else:
+        assert False, 'A wildcard address was accepted as public URL'
+    NotificationReceiver('http://example.com:8080', port=0)
+
+def test_watch():
+    receiver = _start()
+    try:
+        url, future = receiver.watch('/v1/bundles/1')
+        assert url.startswith('http://127.0.0.1:')
+        assert receiver.get_pending_count() == 1
+        assert _notify(url, {'status': 'done'}) == 200
+        notification = future.result(5)
+        assert notification.bundle_href == '/v1/bundles/1'
+        assert notification.data == {'status': 'done'}
+        assert receiver.get_pending_count() == 0
+
+        # The registration was dropped with its first notification.
+        try:
+            _notify(url, {})
+        except urllib2.HTTPError, e:
+            assert e.code == 404
+        else:
+            assert False, 'The registration was not dropped'
+    finally:
+        receiver.stop()
+
+def test_callback():
+    receiver = _start()
+    try:
+        received = []
+        url, future = receiver.watch('/v1/bundles/1', received.append)
+        for i in range(3):
+            _notify(url, {'n': i})
+        assert [n.data['n'] for n in received] == [0, 1, 2]
+    finally:
+        receiver.stop()
+
+def test_notification_before_create_returns():
+    transport = _NotifyingTransport()
+    transport.add('POST', '/v1/bundles', 201,
+                  {'_links': {'self': {'href': '/v1/bundles/1'}}})
+    op3nvoice.set_key('key')
+    op3nvoice.set_transport(transport)
+
+    receiver = _start()
+    try:
+        br, future = receiver.create_bundle(media_url='http://m/1')
+        notification = future.result(5)
+        assert notification.bundle_href == '/v1/bundles/1'
+        assert notification.data == {'status': 'done'}
+    finally:
+        receiver.stop()
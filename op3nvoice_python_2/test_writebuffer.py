@@ -0,0 +1,116 @@
+import json
+import time
+import urlparse
+import op3nvoice
+from transport import MemoryTransport
+from writebuffer import MetadataWriteBuffer
+
+HREF = '/v1/bundles/1/metadata'
+REFERENCE = {'_links': {'self': {'href': HREF}}}
+
+class _ConflictTransport(MemoryTransport):
+    """Answers the first 'conflicts' PUTs with a version conflict."""
+
+    def __init__(self, conflicts):
+        MemoryTransport.__init__(self)
+        self.conflicts = conflicts
+
+    def request(self, method, path, body='', headers=None, timeout=None):
+        if method == 'PUT' and self.conflicts > 0:
+            self.conflicts -= 1
+            self.requests.append((method, path, body))
+            return 409, json.dumps({'status': 'Conflict',
+                                    'message': 'Version mismatch.',
+                                    'code': 409})
+        return MemoryTransport.request(self, method, path, body, headers,
+                                       timeout)
+
+def _use_transport(transport):
+    transport.add('GET', HREF, body={'data': json.dumps({'x': 1}),
+                                     'version': 4})
+    transport.add('PUT', HREF, body=REFERENCE)
+    op3nvoice.set_key('key')
+    op3nvoice.set_transport(transport)
+    return transport
+
+def _puts(transport):
+    puts = []
+    for method, path, body in transport.requests:
+        if method == 'PUT':
+            fields = urlparse.parse_qs(body)
+            puts.append((json.loads(fields['data'][0]),
+                         fields.get('version', [None])[0]))
+    return puts
+
+def test_coalesce():
+    transport = _use_transport(MemoryTransport())
+    buffer = MetadataWriteBuffer(window=60)
+    try:
+        f1 = buffer.update(HREF, {'a': 1})
+        f2 = buffer.update(HREF, {'b': 2}, merge=True)
+        f3 = buffer.update(HREF, {'a': 3}, merge=True)
+        assert buffer.get_pending_count() == 1
+        assert buffer.flush(5)
+        assert f1.result() == f2.result() == f3.result() == REFERENCE
+    finally:
+        buffer.close()
+    # A replacement needs no GET, and the merges apply on top of it.
+    assert [r[0] for r in transport.requests] == ['PUT']
+    assert _puts(transport) == [({'a': 3, 'b': 2}, None)]
+    assert buffer.updates == 3
+    assert buffer.puts == 1
+
+def test_merge_reads_current_version():
+    transport = _use_transport(MemoryTransport())
+    buffer = MetadataWriteBuffer(window=0.05)
+    try:
+        buffer.update(HREF, {'b': 2}, merge=True).result(5)
+    finally:
+        buffer.close()
+    assert [r[0] for r in transport.requests] == ['GET', 'PUT']
+    assert _puts(transport) == [({'x': 1, 'b': 2}, '4')]
+
+def test_merge_retries_conflicts():
+    transport = _use_transport(_ConflictTransport(2))
+    buffer = MetadataWriteBuffer(window=0.05, retries=2)
+    try:
+        assert buffer.update(HREF, {'b': 2}, merge=True).result(5) == \
+            REFERENCE
+        assert buffer.conflicts == 2
+
+        # Giving up after 'retries' conflicts fails the future.
+        transport.conflicts = 3
+        future = buffer.update(HREF, {'c': 3}, merge=True)
+        e = future.exception(5)
+        assert isinstance(e, op3nvoice.APIException)
+        assert e.get_http_response() == 409
+    finally:
+        buffer.close()
+    assert [r[0] for r in transport.requests] == ['GET', 'PUT'] * 6
+
+def test_closed():
+    _use_transport(MemoryTransport())
+    buffer = MetadataWriteBuffer(window=60)
+    future = buffer.update(HREF, {'a': 1})
+    # Closing writes what is pending.
+    buffer.close()
+    assert future.done()
+    try:
+        buffer.update(HREF, {'a': 2})
+    except op3nvoice.APIConfigurationException:
+        pass
+    else:
+        assert False, 'A closed buffer accepted an update'
+
+def test_close_after_flush():
+    transport = _use_transport(MemoryTransport())
+    buffer = MetadataWriteBuffer(window=60)
+    buffer.update(HREF, {'a': 1})
+    assert buffer.flush(5)
+    future = buffer.update(HREF, {'a': 2})
+    # Neither batch's original schedule holds up the close.
+    start = time.time()
+    buffer.close()
+    assert time.time() - start < 5
+    assert future.result() == REFERENCE
+    assert _puts(transport) == [({'a': 1}, None), ({'a': 2}, None)]
@@ -0,0 +1,262 @@
+##
+##  This file contains a compact, column oriented table of tracks for
+##  account-wide analysis.  Numeric fields are kept in typed arrays and
+##  repeated strings (status, mime type, source) are dictionary
+##  encoded, so millions of tracks fit in tens of megabytes.  The
+##  aggregates use NumPy when it is installed.
+##
+
+import array
+import op3nvoice
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# The numeric columns and the dictionary encoded columns.
+NUMERIC_COLUMNS = ('size', 'duration')
+ENCODED_COLUMNS = ('status', 'mime_type', 'source')
+
+###
+###  The table.
+###
+
+class TrackTable(object):
+    """A column oriented table of tracks.
+
+    Typical use:
+
+        table = TrackTable.collect()
+        table.sum('size')
+        table.group_by_sum('mime_type', 'duration')
+        table.percentile('duration', 95, status='processed')"""
+
+    def __init__(self):
+        self._numeric = {}
+        for name in NUMERIC_COLUMNS:
+            self._numeric[name] = array.array('d')
+        self._codes = {}
+        self._values = {}
+        self._lookup = {}
+        for name in ENCODED_COLUMNS + ('bundle',):
+            self._codes[name] = array.array('I')
+            self._values[name] = []
+            self._lookup[name] = {}
+        self._track = array.array('I')
+
+    @classmethod
+    def collect(cls, query=None, limit=None, timeout=None):
+        """Returns a TrackTable holding every track in the account.
+
+        'query' if not None, only collect the tracks of the bundles
+        matching this search.
+        'limit' the number of bundles per page.  May be None.
+        'timeout' the number of seconds the collection may take, or a
+        Deadline.  May be None.
+
+        If a page retrieval fails, throws an APIException or an
+        APIDataException.  If the timeout expires, throws a
+        DeadlineExceededException."""
+
+        table = cls()
+        if query != None:
+            pages = op3nvoice.iter_search_pages(None, query, None, None,
+                                                limit, True, True, None,
+                                                timeout)
+        else:
+            pages = op3nvoice.iter_bundle_list_pages(None, limit, True, True,
+                                                     None, timeout)
+        for page in pages:
+            for item in op3nvoice.get_page_items(page):
+                table.add_bundle(item)
+        return table
+
+    def add_bundle(self, bundle):
+        """Add the tracks of 'bundle' (a bundle, or an item of a bundle
+        list or search result, retrieved with the tracks embedded)."""
+
+        href = op3nvoice.get_self_href(bundle)
+        for track in op3nvoice.get_bundle_tracks(bundle) or []:
+            self.add_track(track, href)
+
+    def add_track_list(self, track_list, bundle_href=None):
+        """Add the tracks of 'track_list', as returned by
+        get_track_list()."""
+
+        for track in track_list.get('tracks', []):
+            self.add_track(track, bundle_href)
+
+    def add_track(self, track, bundle_href=None):
+        """Add one track (a dictionary as found in a track list)."""
+
+        for name in NUMERIC_COLUMNS:
+            self._numeric[name].append(float(track.get(name) or 0))
+        for name in ENCODED_COLUMNS:
+            self._codes[name].append(self._encode(name, track.get(name)))
+        self._codes['bundle'].append(self._encode('bundle', bundle_href))
+        self._track.append(track.get('track') or 0)
+
+    def __len__(self):
+        return len(self._track)
+
+    def get_values(self, name):
+        """Returns the distinct values of a dictionary encoded column
+        ('status', 'mime_type', 'source' or 'bundle')."""
+
+        return list(self._values[name])
+
+    def get_column(self, name):
+        """Returns a copy of a column, as a NumPy array if NumPy is
+        installed, or as a typed array otherwise.  Encoded columns are
+        returned as their codes; see get_values().  The copy doesn't
+        change as tracks are added."""
+
+        column = self._get_view(name)
+        if numpy != None:
+            return column.copy()
+        return array.array(column.typecode, column)
+
+    def _get_view(self, name):
+        """Returns a column without copying it: a NumPy array sharing
+        the table's memory, or the typed array itself.  While a view
+        shares it, the column can't grow, so views must not outlive the
+        aggregate using them."""
+
+        if self._numeric.has_key(name):
+            column = self._numeric[name]
+        elif name == 'track':
+            column = self._track
+        else:
+            column = self._codes[name]
+        if numpy != None:
+            return numpy.frombuffer(column, dtype=_get_dtype(column))
+        return column
+
+    def count(self, **where):
+        """Returns the number of tracks matching 'where'.
+
+        'where' keyword arguments naming an encoded column and the value
+        it must have, e.g. status='processed'."""
+
+        mask = self._get_mask(where)
+        if mask is None:
+            return len(self)
+        if numpy != None:
+            return int(mask.sum())
+        return len(mask)
+
+    def sum(self, name, **where):
+        """Returns the sum of a numeric column over the tracks matching
+        'where' (see count())."""
+
+        column = self._get_view(name)
+        mask = self._get_mask(where)
+        if numpy != None:
+            if mask is not None:
+                column = column[mask]
+            return float(column.sum())
+        if mask is not None:
+            return float(sum(column[i] for i in mask))
+        return float(sum(column))
+
+    def group_by_count(self, key):
+        """Returns a dictionary mapping each value of the encoded column
+        'key' to its number of tracks."""
+
+        return self._group(key, None)
+
+    def group_by_sum(self, key, name):
+        """Returns a dictionary mapping each value of the encoded column
+        'key' to the sum of the numeric column 'name' over its tracks."""
+
+        return self._group(key, name)
+
+    def percentile(self, name, q, **where):
+        """Returns the 'q'th percentile (0 to 100) of a numeric column
+        over the tracks matching 'where' (see count()), or None if no
+        track matches.  Values are linearly interpolated."""
+
+        assert 0 <= q <= 100
+
+        column = self._get_view(name)
+        mask = self._get_mask(where)
+        if numpy != None:
+            if mask is not None:
+                column = column[mask]
+            if len(column) == 0:
+                return None
+            return float(numpy.percentile(column, q))
+
+        if mask is not None:
+            values = sorted(column[i] for i in mask)
+        else:
+            values = sorted(column)
+        if len(values) == 0:
+            return None
+        position = (len(values) - 1) * q / 100.0
+        low = int(position)
+        high = min(low + 1, len(values) - 1)
+        return values[low] + (values[high] - values[low]) * (position - low)
+
+    def _encode(self, name, value):
+        lookup = self._lookup[name]
+        code = lookup.get(value)
+        if code == None:
+            code = len(self._values[name])
+            lookup[value] = code
+            self._values[name].append(value)
+        return code
+
+    def _get_mask(self, where):
+        """Returns None if 'where' is empty.  Otherwise returns a boolean
+        NumPy array if NumPy is installed, or a list of the matching row
+        indices."""
+
+        if len(where) == 0:
+            return None
+
+        mask = None
+        for name, value in where.iteritems():
+            code = self._lookup[name].get(value, -1)
+            codes = self._get_view(name)
+            if numpy != None:
+                match = codes == code
+                mask = match if mask is None else mask & match
+            else:
+                rows = [i for i, c in enumerate(codes) if c == code]
+                mask = rows if mask is None else sorted(set(mask) & set(rows))
+        return mask
+
+    def _group(self, key, name):
+        values = self._values[key]
+        codes = self._get_view(key)
+
+        if numpy != None:
+            weights = None
+            if name != None:
+                weights = self._get_view(name)
+            totals = numpy.bincount(codes, weights=weights,
+                                    minlength=len(values))
+            if name == None:
+                return dict((v, int(totals[i])) for i, v in enumerate(values))
+            return dict((v, float(totals[i])) for i, v in enumerate(values))
+
+        totals = [0] * len(values)
+        if name == None:
+            for c in codes:
+                totals[c] += 1
+        else:
+            column = self._numeric[name]
+            for i, c in enumerate(codes):
+                totals[c] += column[i]
+        return dict(zip(values, totals))
+
+###
+###  Utility functions.
+###
+
+def _get_dtype(column):
+    if column.typecode == 'd':
+        return numpy.float64
+    return numpy.dtype('u%d' % column.itemsize)
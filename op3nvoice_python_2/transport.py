@@ -0,0 +1,221 @@
+##
+##  This file contains the transports executing the requests made by
+##  get(), post(), put() and delete().  Besides the real socket
+##  transports (ConnectionPool and HTTP2ConnectionPool), there is an
+##  in-memory transport serving canned responses and a cassette
+##  transport recording and replaying traffic, so that the library can
+##  be exercised and profiled without the network.
+##
+
+import re
+import json
+import base64
+import threading
+import collections
+
+# Path segments holding ids: numbers, hex strings of 8 or more digits
+# and uuids.
+_ID_SEGMENT = re.compile(r'^(\d+|[0-9a-f]{8,}|[0-9a-f]{8}-[0-9a-f]{4}-'
+                         r'[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})$', re.I)
+
+###
+###  The transport interface.
+###
+
+class Transport(object):
+    """The interface of every transport.  Transports must be thread
+    safe."""
+
+    def request(self, method, path, body='', headers=None, timeout=None):
+        """Execute a request.
+
+        'method' the HTTP method.
+        'path' the path, including the query string.
+        'body' the encoded request body.
+        'headers' a dictionary of request headers.
+        'timeout' the number of seconds the request may take.  May be
+        None.
+
+        Returns (status, body).
+
+        If the timeout expires, throws a DeadlineExceededException."""
+
+        raise NotImplementedError()
+
+    def prewarm(self, n):
+        """Prepare 'n' connections ahead of the first requests.
+
+        Returns the number of connections prepared."""
+
+        return 0
+
+    def close(self):
+        """Release the transport's resources."""
+
+        pass
+
+###
+###  In-memory transport.
+###
+
+class MemoryTransport(Transport):
+    """Serves canned responses without any I/O.
+
+    Responses are registered per method and path.  Paths are matched
+    exactly first (including the query string), then without the query
+    string.  Unmatched requests get a 404 JSON error body."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._responses = {}
+        self.requests = []
+        self.record_requests = True
+
+    def add(self, method, path, status=200, body=''):
+        """Register a response.
+
+        'body' a string, or a python data structure converted to
+        JSON."""
+
+        if not isinstance(body, basestring):
+            body = json.dumps(body)
+        with self._lock:
+            self._responses[(method, path)] = (status, body)
+
+    def request(self, method, path, body='', headers=None, timeout=None):
+        if self.record_requests:
+            with self._lock:
+                self.requests.append((method, path, body))
+
+        response = self._responses.get((method, path))
+        if response == None:
+            response = self._responses.get((method, path.split('?', 1)[0]))
+        if response == None:
+            response = (404, json.dumps({'status': 'Not Found',
+                                         'message': 'No canned response.',
+                                         'code': 404}))
+        return response
+
+###
+###  Record/replay transport.
+###
+
+class CassetteTransport(Transport):
+    """Records traffic going through another transport to a cassette
+    file, or replays a cassette without any I/O.
+
+    A cassette is a JSONL file, one interaction per line, holding the
+    method, path, request body, status and response body.  Response
+    bodies are stored base64 encoded, so that any bytes replay as
+    recorded.  Request headers, which carry the API key, are never
+    recorded."""
+
+    def __init__(self, path, mode='replay', transport=None):
+        """Initializer.
+
+        'path' the cassette file.  May not be None.
+        'mode' 'record' appends every interaction to the cassette;
+        'replay' serves the cassette's interactions.
+        'transport' the transport recorded.  Required in 'record' mode.
+
+        In 'replay' mode, the interactions recorded for the same method,
+        path and body are served in order; the last one is repeated once
+        they are used up.  Requests missing from the cassette throw a
+        CassetteMissException."""
+
+        assert path != None
+        assert mode in ('record', 'replay')
+        assert mode == 'replay' or transport != None
+
+        self.path = path
+        self.mode = mode
+        self._transport = transport
+        self._lock = threading.Lock()
+
+        if mode == 'record':
+            self._f = open(path, 'ab')
+        else:
+            self._interactions = collections.defaultdict(collections.deque)
+            f = open(path, 'rb')
+            try:
+                for line in f:
+                    i = json.loads(line)
+                    key = (i['method'], i['path'], i['body'])
+                    response = i['response']
+                    if i.get('encoding') == 'base64':
+                        response = base64.b64decode(response)
+                    else:
+                        # Cassettes recorded before bodies were encoded.
+                        response = response.encode('utf-8')
+                    self._interactions[key].append((i['status'], response))
+            finally:
+                f.close()
+
+    def request(self, method, path, body='', headers=None, timeout=None):
+        if self.mode == 'replay':
+            return self._replay(method, path, body)
+
+        status, response = self._transport.request(method, path, body,
+                                                   headers, timeout)
+        line = json.dumps({'method': method, 'path': path, 'body': body,
+                           'status': status, 'encoding': 'base64',
+                           'response': base64.b64encode(response)})
+        with self._lock:
+            self._f.write(line + '\n')
+            self._f.flush()
+        return status, response
+
+    def prewarm(self, n):
+        if self.mode == 'record':
+            return self._transport.prewarm(n)
+        return 0
+
+    def close(self):
+        if self.mode == 'record':
+            self._f.close()
+            self._transport.close()
+
+    def _replay(self, method, path, body):
+        with self._lock:
+            queue = self._interactions.get((method, path, body))
+            if not queue:
+                raise CassetteMissException(method, path)
+            if len(queue) > 1:
+                status, response = queue.popleft()
+            else:
+                status, response = queue[0]
+        return status, response
+
+###
+###  Utility functions.
+###
+
+def get_endpoint(method, path):
+    """Returns the endpoint of a request, used to aggregate statistics:
+    the method and the path without its query string, with the
+    segments holding ids (numbers, hex ids, uuids) replaced by '{id}'.
+    For example 'GET /v1/bundles/{id}/tracks'."""
+
+    segments = path.split('?', 1)[0].rstrip('/').split('/')
+    for i, segment in enumerate(segments):
+        if _ID_SEGMENT.match(segment):
+            segments[i] = '{id}'
+    return method + ' ' + '/'.join(segments)
+
+###
+###  Exceptions.
+###
+
+class CassetteMissException(Exception):
+    """Thrown when a replayed request isn't in the cassette."""
+
+    method = None
+    path = None
+
+    def __init__(self, method, path):
+        self.method = method
+        self.path = path
+
+    def get_message(self):
+        """Returns the error message."""
+        return 'No recorded response for ' + self.method + ' ' + self.path
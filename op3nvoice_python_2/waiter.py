@@ -0,0 +1,301 @@
+##
+##  This file contains a waiter for track processing.  Instead of
+##  polling each bundle's track list in a loop, it checks many pending
+##  bundles per request using bundle list (or search) pages with the
+##  tracks embedded, and backs off per bundle based on how long its
+##  media should take to process.
+##
+
+import sys
+import time
+import httplib
+import urlparse
+import threading
+import op3nvoice
+from concurrency import Future
+from concurrency import FutureTimeoutException
+from deadline import Deadline
+from deadline import DeadlineExceededException
+
+# Track status values after which a track won't change any more.
+DONE_TRACK_STATUSES = ('processed', 'complete', 'completed', 'error',
+                       'failed')
+
+# Polling delays, in seconds.
+MIN_DELAY = 2.0
+MAX_DELAY = 300.0
+BACKOFF = 1.5
+
+# Processing time, in seconds, estimated for each second of media, and
+# the media bytes per second assumed when the duration isn't known yet.
+PROCESSING_RATIO = 0.1
+BYTES_PER_SECOND = 16000
+
+# When at least this many bundles are due, scan pages rather than
+# getting each bundle.
+PAGE_SCAN_THRESHOLD = 10
+
+# 4xx statuses worth checking again, rather than failing the bundle.
+RETRY_STATUSES = (408, 429)
+
+###
+###  The waiter.
+###
+
+def wait_for_tracks(bundle_hrefs, timeout=None, query=None, limit=None,
+                    done_statuses=DONE_TRACK_STATUSES):
+    """Wait in the background for the tracks of many bundles to finish
+    processing.
+
+    'bundle_hrefs' the relative hrefs of the bundles.
+    'timeout' the number of seconds after which unfinished bundles
+    give up.  If None, wait forever.
+    'query', 'limit', 'done_statuses' see TrackWaiter.
+
+    Returns a dictionary mapping each bundle href to a Future.  The
+    future resolves with the bundle's list of tracks once every track
+    is done, or throws a FutureTimeoutException when 'timeout' expires
+    first."""
+
+    waiter = TrackWaiter(timeout, query, limit, done_statuses)
+    futures = {}
+    for href in bundle_hrefs:
+        futures[href] = waiter.add(href)
+    waiter.start()
+    return futures
+
+class TrackWaiter(object):
+    """Polls the track status of pending bundles in a background thread.
+
+    Pending bundles are checked together: when many are due, bundle
+    list (or search) pages with the tracks embedded are scanned, which
+    checks a whole page of bundles per request.  Each bundle has its
+    own polling delay, starting from the time its media should take to
+    process (from the tracks' 'duration', or 'size' until the duration
+    is known) and growing on each check that finds it unfinished."""
+
+    def __init__(self, timeout=None, query=None, limit=None,
+                 done_statuses=DONE_TRACK_STATUSES):
+        """Initializer.
+
+        'timeout' the number of seconds, counted from start(), after
+        which unfinished bundles give up.  If None, wait forever.
+        'query' if not None, scan the pages of this search instead of
+        the bundle list.  A query matching the pending bundles makes
+        page scans cheaper.
+        'limit' the number of bundles per scanned page.  May be None.
+        'done_statuses' the track status values meaning a track is
+        done."""
+
+        self._timeout = timeout
+        self._query = query
+        self._limit = limit
+        self._done_statuses = done_statuses
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._pending = {}
+        self._thread = None
+
+    def add(self, bundle_href):
+        """Start waiting for a bundle.  May be called before or after
+        start().
+
+        Returns a Future resolving with the bundle's list of tracks."""
+
+        future = Future()
+        with self._lock:
+            self._pending[_normalize(bundle_href)] = {
+                'href': bundle_href, 'future': future,
+                'next': time.time() + MIN_DELAY, 'delay': None}
+        self._wakeup.set()
+        return future
+
+    def get_pending_count(self):
+        """Returns the number of bundles still being waited for."""
+
+        with self._lock:
+            return len(self._pending)
+
+    def start(self):
+        """Start polling in a background thread."""
+
+        assert self._thread == None
+
+        deadline = Deadline.get(self._timeout)
+        self._thread = threading.Thread(target=self._run, args=(deadline,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop polling.  Unfinished futures are left unresolved.
+
+        The waiter also stops by itself when polling fails with an
+        unexpected exception, which then resolves every unfinished
+        future."""
+
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread != None:
+            self._thread.join()
+
+    def _run(self, deadline):
+        while not self._stopped:
+            now = time.time()
+            if deadline != None and deadline.is_expired():
+                self._expire()
+                return
+
+            with self._lock:
+                due = [k for k, p in self._pending.iteritems()
+                       if p['next'] <= now]
+                wait = [p['next'] - now for p in self._pending.itervalues()]
+
+            if len(due) > 0:
+                try:
+                    if len(due) >= PAGE_SCAN_THRESHOLD:
+                        self._scan_pages(due, deadline)
+                    else:
+                        for key in due:
+                            self._check_bundle(key, deadline)
+                except DeadlineExceededException:
+                    # Expired on the next round.
+                    pass
+                except (op3nvoice.APIException,
+                        op3nvoice.APIDataException, httplib.HTTPException,
+                        IOError):
+                    # Try again on the next round.
+                    self._postpone(due)
+                except Exception:
+                    # Another round won't fix it, so don't leave the
+                    # futures waiting.
+                    self._stopped = True
+                    self._fail(sys.exc_info())
+                    return
+                continue
+
+            # Sleep until the next bundle is due, or a bundle is added.
+            if deadline != None:
+                wait.append(deadline.get_remaining())
+            self._wakeup.wait(min(wait) if wait else None)
+            self._wakeup.clear()
+
+    def _scan_pages(self, due, deadline):
+        """Check every pending bundle found in the pages, until all the
+        due ones have been seen or the listing ends."""
+
+        unseen = set(due)
+        if self._query != None:
+            pages = op3nvoice.iter_search_pages(None, self._query, None,
+                                                None, self._limit, True,
+                                                True, None, deadline)
+        else:
+            pages = op3nvoice.iter_bundle_list_pages(None, self._limit,
+                                                     True, True, None,
+                                                     deadline)
+        for page in pages:
+            for item in op3nvoice.get_page_items(page):
+                key = _normalize(op3nvoice.get_self_href(item))
+                self._update(key, op3nvoice.get_bundle_tracks(item))
+                unseen.discard(key)
+            if len(unseen) == 0:
+                return
+
+        # The whole listing was scanned: bundles missing from it are
+        # likely deleted, or don't match the query, so they are checked
+        # individually.
+        for key in unseen:
+            self._check_bundle(key, deadline)
+
+    def _check_bundle(self, key, deadline):
+        with self._lock:
+            p = self._pending.get(key)
+        if p == None:
+            return
+
+        try:
+            bundle = op3nvoice.get_bundle(p['href'], embed_tracks=True,
+                                          timeout=deadline)
+        except op3nvoice.APIException, e:
+            status = e.get_http_response()
+            if not 400 <= status < 500 or status in RETRY_STATUSES:
+                raise
+            # The bundle is gone, or can't be read: checking it again
+            # won't help.
+            with self._lock:
+                self._pending.pop(key, None)
+            p['future'].set_exception()
+            return
+        self._update(key, op3nvoice.get_bundle_tracks(bundle))
+
+    def _update(self, key, tracks):
+        """Resolve the bundle if all of its 'tracks' are done, otherwise
+        schedule its next check."""
+
+        with self._lock:
+            p = self._pending.get(key)
+            if p == None:
+                return
+            if tracks and all(t.get('status') in self._done_statuses
+                              for t in tracks):
+                del self._pending[key]
+            else:
+                p['delay'] = _get_delay(p['delay'], tracks)
+                p['next'] = time.time() + p['delay']
+                return
+        p['future'].set_result(tracks)
+
+    def _postpone(self, keys):
+        with self._lock:
+            for key in keys:
+                p = self._pending.get(key)
+                if p != None:
+                    p['delay'] = min((p['delay'] or MIN_DELAY) * BACKOFF,
+                                     MAX_DELAY)
+                    p['next'] = time.time() + p['delay']
+
+    def _fail(self, exc_info):
+        with self._lock:
+            pending = self._pending.values()
+            self._pending = {}
+        for p in pending:
+            p['future'].set_exception(exc_info)
+
+    def _expire(self):
+        with self._lock:
+            pending = self._pending.values()
+            self._pending = {}
+        for p in pending:
+            try:
+                raise FutureTimeoutException(
+                    'The tracks of ' + p['href'] + ' did not finish in time.')
+            except FutureTimeoutException:
+                p['future'].set_exception()
+
+###
+###  Utility functions.
+###
+
+def _normalize(href):
+    """Returns the path of 'href', so that hrefs differing only by their
+    query string or trailing '/' match."""
+
+    return urlparse.urlparse(href).path.rstrip('/')
+
+def _get_delay(delay, tracks):
+    """Returns the next polling delay of a bundle.
+
+    The first delay is the estimated processing time of the longest
+    track; later delays grow by BACKOFF."""
+
+    if delay != None:
+        return min(delay * BACKOFF, MAX_DELAY)
+
+    seconds = 0.0
+    for track in tracks or []:
+        duration = track.get('duration') or 0
+        if duration <= 0:
+            duration = float(track.get('size') or 0) / BYTES_PER_SECOND
+        seconds = max(seconds, duration)
+
+    return min(max(seconds * PROCESSING_RATIO, MIN_DELAY), MAX_DELAY)
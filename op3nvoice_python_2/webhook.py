@@ -0,0 +1,273 @@
+##
+##  This file contains an embeddable receiver for the notifications the
+##  API sends to a bundle's notify_url, so that applications can wait
+##  for processing to finish without polling.
+##
+
+import json
+import uuid
+import urlparse
+import threading
+import collections
+import BaseHTTPServer
+import SocketServer
+import op3nvoice
+from concurrency import Future
+
+NOTIFY_PATH = 'notify'
+
+# Addresses that listen on every interface, and so can't be handed to
+# the API.
+_WILDCARD_HOSTS = ('', '0.0.0.0', '::')
+
+# This named tuple is the result of a watch future and is passed to
+# watch callbacks.  'data' is the parsed notification body.
+Notification = collections.namedtuple('Notification',
+                                      ['bundle_href', 'data'])
+
+###
+###  The receiver.
+###
+
+class NotificationReceiver(object):
+    """Receives notifications in a background HTTP server thread and
+    dispatches them to the futures and callbacks registered for each
+    bundle.
+
+    Typical use:
+
+        receiver = NotificationReceiver('http://myhost.example.com:8080',
+                                        port=8080)
+        receiver.start()
+        br, future = receiver.create_bundle(media_url=url)
+        notification = future.result()
+        receiver.stop()
+
+    Each registration gets its own notify_url, so notifications are
+    matched to bundles without relying on the notification body."""
+
+    def __init__(self, public_url=None, host='', port=0):
+        """Initializer.
+
+        'public_url' the base URL under which the API can reach this
+        receiver.  If None, the local server address is used, which is
+        only useful when the API can reach this host directly.
+        'host' the interface to listen on.  '' listens on all of them.
+        'port' the port to listen on.  0 picks a free port.
+
+        If 'public_url' is None while listening on all interfaces,
+        throws an APIConfigurationException: there is no single address
+        to give the API."""
+
+        if public_url == None and host in _WILDCARD_HOSTS:
+            raise op3nvoice.APIConfigurationException(
+                'A public_url is required when listening on all interfaces.')
+
+        self._public_url = public_url
+        self._address = (host, port)
+        self._server = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._watches = {}
+
+    def start(self):
+        """Start listening in a background thread."""
+
+        assert self._server == None
+
+        self._server = _Server(self._address, _Handler)
+        self._server.receiver = self
+        if self._public_url == None:
+            host, port = self._server.server_address[:2]
+            self._public_url = 'http://%s:%d' % (host, port)
+
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop listening.  Pending futures are left unresolved."""
+
+        if self._server != None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+
+    def get_server_address(self):
+        """Returns the (host, port) the receiver is listening on."""
+
+        return self._server.server_address[:2]
+
+    def watch(self, bundle_href=None, callback=None):
+        """Register for notifications.
+
+        'bundle_href' the bundle the notifications are about.  May be
+        None if not known yet; see set_bundle_href().
+        'callback' may be None, or a function called with a
+        Notification for every notification received.  If None, the
+        registration is dropped once the first notification arrives.
+
+        Returns (notify_url, future).  Pass notify_url to the API.  The
+        future resolves with the first Notification received."""
+
+        return self._watch(bundle_href, callback, False)
+
+    def _watch(self, bundle_href, callback, hold):
+        """'hold' whether notifications arriving before the bundle href
+        is set are held until set_bundle_href() is called."""
+
+        token = uuid.uuid4().hex
+        future = Future()
+        with self._lock:
+            self._watches[token] = {'href': bundle_href, 'future': future,
+                                    'callback': callback, 'hold': hold,
+                                    'held': []}
+        url = self._public_url.rstrip('/') + '/' + NOTIFY_PATH + '/' + token
+        return url, future
+
+    def set_bundle_href(self, notify_url, bundle_href):
+        """Set the bundle of a registration made before it was known.
+        Notifications held until then are dispatched."""
+
+        token = _get_token(notify_url)
+        with self._lock:
+            watch = self._watches.get(token)
+            if watch == None:
+                return
+            watch['href'] = bundle_href
+            watch['hold'] = False
+            held = watch['held']
+            watch['held'] = []
+        for data in held:
+            self._dispatch(token, data)
+
+    def unwatch(self, notify_url):
+        """Drop a registration."""
+
+        with self._lock:
+            self._watches.pop(_get_token(notify_url), None)
+
+    def get_pending_count(self):
+        """Returns the number of registrations still waiting for their
+        first notification."""
+
+        with self._lock:
+            return len([w for w in self._watches.itervalues()
+                        if not w['future'].done()])
+
+    def create_bundle(self, name=None, media_url=None, audio_channel=None,
+                      metadata=None, callback=None, timeout=None):
+        """Call create_bundle() with a notify_url pointing at this
+        receiver.
+
+        The arguments are those of create_bundle(), plus 'callback' (see
+        watch()).
+
+        Returns (bundle reference, future)."""
+
+        # The API may notify before create_bundle() returns the href.
+        url, future = self._watch(None, callback, True)
+        try:
+            br = op3nvoice.create_bundle(name, media_url, audio_channel,
+                                         metadata, url, timeout)
+        except Exception:
+            self.unwatch(url)
+            raise
+        self.set_bundle_href(url, br['_links']['self']['href'])
+        return br, future
+
+    def update_bundle(self, href=None, name=None, version=None,
+                      callback=None, timeout=None):
+        """Call update_bundle() with a notify_url pointing at this
+        receiver.
+
+        The arguments are those of update_bundle(), plus 'callback' (see
+        watch()).
+
+        Returns (reference, future)."""
+
+        url, future = self.watch(href, callback)
+        try:
+            r = op3nvoice.update_bundle(href, name, url, version, timeout)
+        except Exception:
+            self.unwatch(url)
+            raise
+        return r, future
+
+    def _dispatch(self, token, data):
+        """Returns False if 'token' isn't registered."""
+
+        with self._lock:
+            watch = self._watches.get(token)
+            if watch == None:
+                return False
+            if watch['hold']:
+                watch['held'].append(data)
+                return True
+            if watch['callback'] == None:
+                del self._watches[token]
+
+        notification = Notification(bundle_href=watch['href'], data=data)
+        watch['future'].set_result(notification)
+        if watch['callback'] != None:
+            watch['callback'](notification)
+        return True
+
+###
+###  The HTTP server.
+###
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    receiver = None
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        length = int(self.headers.getheader('Content-Length') or 0)
+        body = self.rfile.read(length)
+        content_type = self.headers.getheader('Content-Type') or ''
+        path = urlparse.urlparse(self.path).path
+
+        status = 404
+        parts = path.strip('/').split('/')
+        if len(parts) == 2 and parts[0] == NOTIFY_PATH:
+            data = _parse_body(body, content_type)
+            if self.server.receiver._dispatch(parts[1], data):
+                status = 200
+
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    do_PUT = do_POST
+
+    def log_message(self, format, *args):
+        # Keep the embedding application's output clean.
+        pass
+
+###
+###  Utility functions.
+###
+
+def _get_token(notify_url):
+    return urlparse.urlparse(notify_url).path.rstrip('/').split('/')[-1]
+
+def _parse_body(body, content_type):
+    """Returns the notification body as a python data structure.  JSON
+    and form-encoded bodies are decoded; anything else is returned as
+    is."""
+
+    if 'json' in content_type:
+        try:
+            return json.loads(body)
+        except ValueError:
+            return body
+    if 'x-www-form-urlencoded' in content_type:
+        data = urlparse.parse_qs(body)
+        for key, values in data.items():
+            if len(values) == 1:
+                data[key] = values[0]
+        return data
+    return body
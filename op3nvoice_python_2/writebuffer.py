@@ -0,0 +1,277 @@
+##
+##  This file contains a write-behind buffer for update_metadata().
+##  Changes to the same metadata arriving within a window are merged
+##  and written with a single PUT, and every caller gets a future that
+##  resolves once that PUT has succeeded.
+##
+##      buffer = MetadataWriteBuffer(window=2.0)
+##      f1 = buffer.update(href, {'language': 'en'}, merge=True)
+##      f2 = buffer.update(href, {'speakers': 3}, merge=True)
+##      f2.result()   # one GET and one PUT for both changes
+##      buffer.close()
+##
+
+import copy
+import json
+import time
+import heapq
+import Queue
+import threading
+import op3nvoice
+from concurrency import Future, FutureTimeoutException
+from deadline import Deadline, DeadlineExceededException, get_remaining
+
+DEFAULT_WINDOW = 1.0
+DEFAULT_CONCURRENCY = 4
+DEFAULT_RETRIES = 3
+
+HTTP_CONFLICT = 409
+
+###
+###  The buffer.
+###
+
+class MetadataWriteBuffer(object):
+    """Coalesces metadata updates per href.  Thread safe.
+
+    A change either replaces the whole metadata, like update_metadata(),
+    or is merged into it (merge=True): its top level keys are set on the
+    current metadata.  When a window holds only merged changes, the
+    current metadata and its version are read first, and the PUT is
+    retried on a version conflict, so that concurrent writers aren't
+    overwritten."""
+
+    def __init__(self, window=DEFAULT_WINDOW, concurrency=DEFAULT_CONCURRENCY,
+                 retries=DEFAULT_RETRIES):
+        """Initializer.
+
+        'window' the number of seconds changes to one href are collected
+        after the first one, before they are written.
+        'concurrency' the number of PUTs in flight, for different hrefs.
+        Writes to one href are never concurrent.
+        'retries' the number of times a merged write is retried after a
+        version conflict."""
+
+        assert window >= 0
+        assert concurrency > 0
+        assert retries >= 0
+
+        self.window = window
+        self.retries = retries
+        self._condition = threading.Condition()
+        # href -> the _Batch collecting changes
+        self._pending = {}
+        # href -> the _Batch being written
+        self._in_flight = {}
+        self._heap = []
+        self._sequence = 0
+        self._closed = False
+        self._work = Queue.Queue()
+        self.updates = 0
+        self.puts = 0
+        self.conflicts = 0
+
+        self._threads = [threading.Thread(target=self._flush_due)]
+        for i in range(concurrency):
+            self._threads.append(threading.Thread(target=self._write))
+        for t in self._threads:
+            t.daemon = True
+            t.start()
+
+    def update(self, href, metadata, version=None, merge=False):
+        """Queue a metadata change.
+
+        'href' the relative href to the metadata.  May not be None.
+        'metadata' the new metadata, or with 'merge' a dictionary of top
+        level keys to set.  It is copied.
+        'version' the metadata version, as for update_metadata().  May
+        be None.  The latest version given in a window is used.
+        'merge' whether to merge 'metadata' into the current metadata
+        rather than replace it.
+
+        Returns a Future resolving with the result of the PUT, or with
+        its APIException.
+
+        If the buffer is closed, throws an APIConfigurationException."""
+
+        assert href != None
+        assert metadata != None
+        assert not merge or isinstance(metadata, dict)
+
+        future = Future()
+        with self._condition:
+            if self._closed:
+                raise op3nvoice.APIConfigurationException(
+                    'The metadata write buffer is closed.')
+            self.updates += 1
+            batch = self._pending.get(href)
+            if batch == None:
+                batch = _Batch()
+                self._pending[href] = batch
+                self._schedule(href, batch, self.window)
+
+            if not merge:
+                batch.data = copy.deepcopy(metadata)
+                batch.merges = {}
+            elif batch.data != None and isinstance(batch.data, dict):
+                batch.data.update(copy.deepcopy(metadata))
+            elif batch.data != None:
+                # Merging into a non-object replaces it.
+                batch.data = copy.deepcopy(metadata)
+            else:
+                batch.merges.update(copy.deepcopy(metadata))
+            if version != None:
+                batch.version = version
+            batch.futures.append(future)
+        return future
+
+    def get_pending_count(self):
+        """Returns the number of hrefs with changes not yet written."""
+
+        with self._condition:
+            return len(self._pending) + len(self._in_flight)
+
+    def flush(self, timeout=None):
+        """Write every pending change now, and wait for the writes.
+
+        'timeout' the maximum number of seconds to wait, or a Deadline.
+        If None, wait until done.
+
+        Returns True if every write completed."""
+
+        with self._condition:
+            for href, batch in self._pending.items():
+                self._schedule(href, batch, 0)
+            self._condition.notify_all()
+
+            futures = []
+            for batch in self._pending.values() + self._in_flight.values():
+                futures.extend(batch.futures)
+        deadline = Deadline.get(timeout)
+        for future in futures:
+            try:
+                future.exception(get_remaining(deadline))
+            except (FutureTimeoutException, DeadlineExceededException):
+                return False
+        return True
+
+    def close(self):
+        """Write every pending change, then stop the background
+        threads."""
+
+        self.flush()
+        with self._condition:
+            self._closed = True
+            # Changes queued since the flush are written now too.
+            for href, batch in self._pending.items():
+                self._schedule(href, batch, 0)
+            self._condition.notify_all()
+        # Every batch has been handed to the writers once this returns.
+        self._threads[0].join()
+        for t in self._threads[1:]:
+            self._work.put(None)
+        for t in self._threads[1:]:
+            t.join()
+
+    def _schedule(self, href, batch, delay):
+        batch.due = time.time() + delay
+        self._sequence += 1
+        heapq.heappush(self._heap, (batch.due, self._sequence, href, batch))
+        self._condition.notify_all()
+
+    def _flush_due(self):
+        """Runs in the background, handing due batches to the writers."""
+
+        with self._condition:
+            while True:
+                now = time.time()
+                while len(self._heap) > 0 and self._heap[0][0] <= now:
+                    due, sequence, href, batch = heapq.heappop(self._heap)
+                    if (self._pending.get(href) is not batch or
+                        batch.due != due):
+                        # Rescheduled, or already written.
+                        continue
+                    if href in self._in_flight:
+                        # Written once the current write completes.
+                        batch.blocked = True
+                        continue
+                    del self._pending[href]
+                    self._in_flight[href] = batch
+                    self._work.put((href, batch))
+                # The heap may still hold the entries of rescheduled
+                # batches, which are skipped.
+                if self._closed and len(self._pending) == 0:
+                    return
+                if len(self._heap) > 0:
+                    self._condition.wait(self._heap[0][0] - now)
+                else:
+                    # Only blocked batches, rescheduled by _write().
+                    self._condition.wait()
+
+    def _write(self):
+        """Runs in the background, writing batches."""
+
+        while True:
+            item = self._work.get()
+            if item == None:
+                return
+            href, batch = item
+            try:
+                result = self._put(href, batch)
+            except Exception:
+                for future in batch.futures:
+                    future.set_exception()
+            else:
+                for future in batch.futures:
+                    future.set_result(result)
+
+            with self._condition:
+                del self._in_flight[href]
+                waiting = self._pending.get(href)
+                if waiting != None and waiting.blocked:
+                    waiting.blocked = False
+                    self._schedule(href, waiting, 0)
+
+    def _put(self, href, batch):
+        if batch.data != None:
+            with self._condition:
+                self.puts += 1
+            return op3nvoice.update_metadata(href, batch.data, batch.version)
+
+        # Only merged changes: apply them to the current metadata.
+        attempt = 0
+        while True:
+            current = op3nvoice.get_metadata(href)
+            data = current.get('data')
+            if isinstance(data, basestring):
+                try:
+                    data = json.loads(data)
+                except ValueError:
+                    pass
+            if not isinstance(data, dict):
+                data = {}
+            data.update(batch.merges)
+            version = current.get('version', batch.version)
+            with self._condition:
+                self.puts += 1
+            try:
+                return op3nvoice.update_metadata(href, data, version)
+            except op3nvoice.APIException, e:
+                if (e.get_http_response() != HTTP_CONFLICT or
+                    attempt >= self.retries):
+                    raise
+                with self._condition:
+                    self.conflicts += 1
+                attempt += 1
+
+class _Batch(object):
+    """The changes to one href collected in a window."""
+
+    def __init__(self):
+        # The replacement metadata, or None if only merges were queued.
+        self.data = None
+        self.merges = {}
+        self.version = None
+        self.futures = []
+        self.due = None
+        self.blocked = False
@@ -33,6 +33,12 @@ setup(
     include_package_data=True,
     install_requires=[
     ],
+    entry_points={
+        'console_scripts': [
+            'op3nvoice = op3nvoice_python_2.cli:main',
+            'op3nvoice-loadgen = op3nvoice_python_2.loadgen:main',
+        ],
+    },
     license="BSD",
     zip_safe=False,
     keywords='op3nvoice_python_2',